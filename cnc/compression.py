@@ -0,0 +1,29 @@
+import zlib
+from django.conf import settings
+
+# --- Mail.content の圧縮 ---
+#
+# MAIL_COMPRESS_MIN_BYTES 以上の本文は zlib で圧縮して Mail.content_zlib に入れ、content は空にする。
+# それより短い本文や、圧縮しても小さくならない本文は content にそのまま入れる（content_zlib は NULL）。
+# 展開するのはクライアントに本文を返すときだけ。受信箱のヘッダーのように本文を含めない
+# 射影は content_zlib を読まないので、展開することもない。
+
+
+def pack_content(text):
+    """本文を (content, content_zlib) にする"""
+    if not settings.MAIL_COMPRESSION_ENABLED:
+        return text, None
+    raw = text.encode('utf8')
+    if len(raw) < settings.MAIL_COMPRESS_MIN_BYTES:
+        return text, None
+    packed = zlib.compress(raw, settings.MAIL_COMPRESS_LEVEL)
+    if len(packed) >= len(raw):
+        return text, None
+    return '', packed
+
+
+def unpack_content(content, content_zlib):
+    """(content, content_zlib) から本文を取り出す（PostgreSQLの bytea は memoryview で返ってくる）"""
+    if content_zlib is None:
+        return content
+    return zlib.decompress(content_zlib).decode('utf8')
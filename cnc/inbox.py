@@ -0,0 +1,84 @@
+from django.db import connection, transaction
+from .models import Mail, Notification
+
+
+def claim_inbox_snapshot(user_uuid):
+    """
+    register時に返す受信箱のスナップショットを1トランザクションで作る。
+    未配信の通知は返すと同時に配信済みにし（claim）、未読メールはヘッダーだけを取得する。
+    """
+    with transaction.atomic():
+        notifications = claim_undelivered_notifications(user_uuid)
+        unread_mails = get_unread_mail_headers(user_uuid)
+
+    snapshot = [
+        {
+            "sender": notif["sender_uuid"],
+            "timestamp": notif["timestamp"].isoformat(),
+            "type": notif["notification_type"]
+        }
+        for notif in notifications
+    ]
+    snapshot.extend(
+        {
+            'type': 'new_mail_notification',
+            'mail_id': str(mail['id']),
+            'sender': mail['sender'],
+            'timestamp': mail['timestamp'].isoformat()
+        }
+        for mail in unread_mails
+    )
+    return snapshot
+
+
+def claim_undelivered_notifications(user_uuid):
+    """未配信の通知を配信済みに更新し、更新した行を古い順に返す"""
+    if connection.vendor == 'postgresql':
+        # UPDATE ... RETURNING で読み取りと更新を1文で行う（他の接続と取り合いにならない）
+        table = connection.ops.quote_name(Notification._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET is_delivered = true "
+                f"WHERE recipient_uuid = %s AND is_delivered = false "
+                f"RETURNING sender_uuid, notification_type, timestamp",
+                [user_uuid]
+            )
+            rows = cursor.fetchall()
+        notifications = [
+            {"sender_uuid": sender_uuid, "notification_type": notification_type, "timestamp": timestamp}
+            for sender_uuid, notification_type, timestamp in rows
+        ]
+        notifications.sort(key=lambda notif: notif["timestamp"])
+        return notifications
+
+    # PostgreSQL以外（ローカルのSQLiteなど）は行をロックして読んでから更新する
+    notifications = list(
+        Notification.objects.select_for_update()
+        .filter(recipient_uuid=user_uuid, is_delivered=False)
+        .order_by('timestamp')
+        .values('id', 'sender_uuid', 'notification_type', 'timestamp')
+    )
+    if notifications:
+        Notification.objects.filter(id__in=[notif['id'] for notif in notifications]).update(is_delivered=True)
+    return notifications
+
+
+def get_unread_mail_headers(user_uuid):
+    """未読メールのヘッダー（本文を除く）をタイムスタンプ順で取得"""
+    return list(
+        Mail.objects.filter(target=user_uuid, is_read=False)
+        .order_by('timestamp')
+        .values('id', 'sender', 'timestamp')
+    )
+
+
+def iter_pending_inbox_uuids():
+    """未配信の通知か未読メールが残っているユーザーのUUIDを列挙する（重複は呼び出し側で許容）"""
+    yield from (
+        Notification.objects.filter(is_delivered=False)
+        .values_list('recipient_uuid', flat=True).distinct().iterator()
+    )
+    yield from (
+        Mail.objects.filter(is_read=False)
+        .values_list('target', flat=True).distinct().iterator()
+    )
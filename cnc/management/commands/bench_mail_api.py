@@ -0,0 +1,146 @@
+import asyncio
+import json
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.http import JsonResponse
+from django.test import AsyncClient
+from django.test.utils import override_settings
+from django.urls import path
+from django.views.decorators.csrf import csrf_exempt
+
+from cnc import views
+from cnc.models import Mail
+from signaling.codecs import frame_event
+from signaling.management.commands.bench_signaling import git_commit
+from signaling.metrics import percentiles
+
+
+# --- 比較用: 非同期化する前の同期ビュー ---
+
+@csrf_exempt
+def legacy_send_mail_api(request):
+    data = json.loads(request.body)
+    mail = Mail.objects.create(
+        id=data['client_id'],
+        sender=data['sender'],
+        target=data['target'],
+        content=data['content'],
+        next_access=data.get('next_access')
+    )
+    notification = {
+        "type": "new_mail_notification",
+        "mail_id": str(mail.id),
+        "sender": mail.sender,
+        "timestamp": mail.timestamp.isoformat()
+    }
+    async_to_sync(get_channel_layer().group_send)(
+        f"user_{data['target']}",
+        frame_event({"type": notification["type"], "payload": notification})
+    )
+    return JsonResponse({'status': 'success', 'mail': {'id': mail.id, 'timestamp': mail.timestamp.isoformat()}})
+
+
+def legacy_get_mail_api(request, mail_id):
+    try:
+        mail = Mail.objects.get(id=mail_id)
+    except Mail.DoesNotExist:
+        return JsonResponse({'error': 'Mail not found'}, status=404)
+    if not mail.is_read:
+        mail.is_read = True
+        mail.save()
+    return JsonResponse({
+        'id': mail.id,
+        'sender': mail.sender,
+        'target': mail.target,
+        'content': mail.text,
+        'nextAccess': mail.next_access,
+        'timestamp': mail.timestamp.isoformat()
+    })
+
+
+# このモジュールを ROOT_URLCONF にして、両方の実装を同じミドルウェアで計測する
+urlpatterns = [
+    path('async/send/', views.send_mail_api),
+    path('async/get/<str:mail_id>/', views.get_mail_api),
+    path('sync/send/', legacy_send_mail_api),
+    path('sync/get/<str:mail_id>/', legacy_get_mail_api),
+]
+
+
+class Command(BaseCommand):
+    help = 'Compares the async mail API views with the previous sync views under concurrent requests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Mails sent (and then fetched) per variant')
+        parser.add_argument('--concurrency', type=int, default=50, help='Requests in flight at the same time')
+        parser.add_argument('--output', default=None, help='Write the results as JSON to this path')
+
+    def handle(self, *args, **options):
+        layers = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(CHANNEL_LAYERS=layers, ROOT_URLCONF=__name__, ALLOWED_HOSTS=['testserver']):
+                results = {variant: asyncio.run(self._run(variant, options)) for variant in ('sync', 'async')}
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results = {
+            'commit': git_commit(),
+            'database': connection.vendor,
+            'config': {k: options[k] for k in ('requests', 'concurrency')},
+            'variants': results,
+        }
+        self._report(results)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+    async def _run(self, variant, options):
+        client = AsyncClient()
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        mail_ids = [f"bench-{variant}-{uuid.uuid4()}" for _ in range(options['requests'])]
+
+        async def timed_request(method, url, **kwargs):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await getattr(client, method)(url, **kwargs)
+                elapsed = time.perf_counter() - start
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} returned {response.status_code}")
+            return elapsed
+
+        async def phase(requests):
+            start = time.perf_counter()
+            latencies = await asyncio.gather(*requests)
+            elapsed = time.perf_counter() - start
+            return {'requests_per_second': round(len(latencies) / elapsed, 1), 'latency_ms': percentiles(latencies, scale=1000)}
+
+        send = await phase([
+            timed_request('post', f'/{variant}/send/', content_type='application/json', data={
+                'client_id': mail_id, 'sender': 'bench-sender', 'target': f'bench-target-{n % 100}',
+                'content': 'x' * 200,
+            })
+            for n, mail_id in enumerate(mail_ids)
+        ])
+        get = await phase([timed_request('get', f'/{variant}/get/{mail_id}/') for mail_id in mail_ids])
+        return {'send': send, 'get': get}
+
+    def _report(self, results):
+        variants = results['variants']
+        for name in ('send', 'get'):
+            for variant in ('sync', 'async'):
+                summary = variants[variant][name]
+                latency = summary['latency_ms']
+                self.stdout.write(
+                    f"{name:4s} {variant:5s} {summary['requests_per_second']:10,.1f} req/s "
+                    f"p50={latency['p50']:.2f}ms p95={latency['p95']:.2f}ms p99={latency['p99']:.2f}ms"
+                )
+            before = variants['sync'][name]['requests_per_second']
+            after = variants['async'][name]['requests_per_second']
+            self.stdout.write(f"     throughput {(after - before) / before:+.1%}")
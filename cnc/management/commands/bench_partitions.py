@@ -0,0 +1,113 @@
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from cnc.inbox import get_unread_mail_headers
+from cnc.models import Mail
+from cnc.partitions import convert_to_partitioned, list_partitions
+from cnc.retention import RetentionPolicy, run_retention
+from cnc.views import MAIL_FIELDS
+from cnc.management.commands.bench_retention import seed_mails
+from signaling.management.commands.bench_signaling import git_commit
+from signaling.metrics import percentiles
+
+
+class Command(BaseCommand):
+    help = 'Compares insert, inbox-query and retention cost of a partitioned and a plain Mail table (PostgreSQL)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help='Synthetic mails per layout, half of them expired')
+        parser.add_argument('--inserts', type=int, default=2000, help='Single-row inserts to time')
+        parser.add_argument('--queries', type=int, default=2000, help='Inbox queries and id lookups to time')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Retention batch size for the leftover rows')
+        parser.add_argument('--output', default=None, help='Write the results as JSON to this path')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Partitioned tables are only available on PostgreSQL.")
+        results = {}
+        for layout in ('plain', 'partitioned'):
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                with override_settings(PARTITIONING_ENABLED=True):
+                    results[layout] = self._run(layout, options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results = {
+            'commit': git_commit(),
+            'database': connection.vendor,
+            'partition_interval': settings.PARTITION_INTERVAL,
+            'config': {k: options[k] for k in ('rows', 'inserts', 'queries', 'batch_size')},
+            'layouts': results,
+        }
+        self._report(results)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+    def _run(self, layout, options):
+        self.stdout.write(f"Seeding {options['rows']:,} mails for the {layout} table...")
+        now = seed_mails(options['rows'], 0.5, 64)
+        summary = {}
+        if layout == 'partitioned':
+            start = time.perf_counter()
+            convert_to_partitioned(Mail, now)
+            summary['convert_seconds'] = round(time.perf_counter() - start, 3)
+            summary['partitions'] = len(list_partitions(Mail))
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {connection.ops.quote_name(Mail._meta.db_table)}")
+
+        # 挿入は send_mail_api と同じく1通ずつ
+        latencies = []
+        for n in range(options['inserts']):
+            start = time.perf_counter()
+            Mail.objects.create(id=f"insert-{n}", sender='bench-sender', target=f"target-{n % 1000}", content='x' * 64)
+            latencies.append(time.perf_counter() - start)
+        summary['insert_ms'] = percentiles(latencies, scale=1000)
+
+        # register時の未読メールのヘッダーと、get_mail_api の id での取得（idではパーティションを絞れない）
+        headers, by_id = [], []
+        for n in range(options['queries']):
+            start = time.perf_counter()
+            get_unread_mail_headers(f"target-{n % 1000}")
+            headers.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            Mail.objects.filter(id=f"bench-{n * 7919 % options['rows']}").values(*MAIL_FIELDS).first()
+            by_id.append(time.perf_counter() - start)
+        summary['unread_headers_ms'] = percentiles(headers, scale=1000)
+        summary['get_by_id_ms'] = percentiles(by_id, scale=1000)
+
+        # 保存期間: 分割した表ではパーティションの DROP と、境界のパーティションに残った行のバッチ削除
+        policy = RetentionPolicy('mails', Mail, 'timestamp', 'RETENTION_DAYS')
+        start = time.perf_counter()
+        deleted = run_retention([policy], batch_size=options['batch_size'], sleep=0, now=now)
+        summary['retention'] = {
+            'seconds': round(time.perf_counter() - start, 3),
+            'partitions_dropped': deleted.get('partitions', 0),
+            'rows_deleted': deleted['mails'],
+        }
+        if Mail.objects.filter(timestamp__lt=now - timedelta(days=settings.RETENTION_DAYS)).exists():
+            raise RuntimeError(f"Retention left expired mails in the {layout} table")
+        return summary
+
+    def _report(self, results):
+        for layout, summary in results['layouts'].items():
+            retention = summary['retention']
+            self.stdout.write(
+                f"{layout:11s} insert p50={summary['insert_ms']['p50']:.2f}ms "
+                f"unread p50={summary['unread_headers_ms']['p50']:.2f}ms "
+                f"by-id p50={summary['get_by_id_ms']['p50']:.2f}ms "
+                f"retention={retention['seconds']:.2f}s "
+                f"({retention['partitions_dropped']} partition(s) dropped, {retention['rows_deleted']:,} rows deleted)"
+            )
+            if 'convert_seconds' in summary:
+                self.stdout.write(
+                    f"{'':11s} converted into {summary['partitions']} partition(s) in {summary['convert_seconds']:.2f}s"
+                )
@@ -0,0 +1,125 @@
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from cnc.models import Mail
+from cnc.retention import RetentionPolicy, run_retention
+from signaling.management.commands.bench_signaling import git_commit, current_rss
+from signaling.metrics import percentiles
+
+
+def seed_mails(rows, expired_ratio, content_size):
+    """
+    期限切れの行が expired_ratio の割合になるよう、timestamp を指定して合成のメールを直接INSERTする。
+    基準にした現在時刻を返す。
+    """
+    now = timezone.now()
+    days = settings.RETENTION_DAYS
+    expired = int(rows * expired_ratio)
+    content = 'x' * content_size
+    table = connection.ops.quote_name(Mail._meta.db_table)
+    columns = ', '.join(
+        connection.ops.quote_name(column)
+        for column in ('id', 'sender', 'target', 'content', 'timestamp', 'is_read')
+    )
+    adapt = connection.ops.adapt_datetimefield_value
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {table}")
+        for start in range(0, rows, 10000):
+            batch = []
+            for n in range(start, min(start + 10000, rows)):
+                # 期限切れの行は期限の1〜30日前、残る行は期限内にばらけさせる
+                if n < expired:
+                    age = timedelta(days=days + 1 + n % 30, seconds=n % 86400)
+                else:
+                    age = timedelta(seconds=n % (days * 86400 - 60))
+                batch.append((
+                    f"bench-{n}", f"sender-{n % 97}", f"target-{n % 1000}", content,
+                    adapt(now - age), n % 2 == 0
+                ))
+            cursor.executemany(f"INSERT INTO {table} ({columns}) VALUES (%s, %s, %s, %s, %s, %s)", batch)
+    return now
+
+
+class Command(BaseCommand):
+    help = 'Compares the batched retention engine with a single unbounded delete on synthetic mails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help='Synthetic mails inserted per variant')
+        parser.add_argument('--expired-ratio', type=float, default=0.5, help='Share of rows past the retention period')
+        parser.add_argument('--content-size', type=int, default=64, help='Characters per mail body')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--output', default=None, help='Write the results as JSON to this path')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = {}
+            for variant in ('unbounded', 'batched'):
+                self.stdout.write(f"Seeding {options['rows']:,} mails for {variant}...")
+                now = seed_mails(options['rows'], options['expired_ratio'], options['content_size'])
+                results[variant] = self._run(variant, now, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results = {
+            'commit': git_commit(),
+            'database': connection.vendor,
+            'config': {k: options[k] for k in ('rows', 'expired_ratio', 'content_size', 'batch_size')},
+            'variants': results,
+        }
+        self._report(results)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+    def _run(self, variant, now, options):
+        cutoff = now - timedelta(days=settings.RETENTION_DAYS)
+        expected = Mail.objects.filter(timestamp__lt=cutoff).count()
+        batch_times = []
+        rss_before = current_rss()
+        start = time.perf_counter()
+        if variant == 'unbounded':
+            # 置き換える前の cleanup_old_data と同じ1回の delete()
+            deleted, _ = Mail.objects.filter(timestamp__lt=cutoff).delete()
+            batch_times.append(time.perf_counter() - start)
+        else:
+            last = [start]
+
+            def progress(policy, total):
+                tick = time.perf_counter()
+                batch_times.append(tick - last[0])
+                last[0] = tick
+
+            policy = RetentionPolicy('mails', Mail, 'timestamp', 'RETENTION_DAYS')
+            deleted = run_retention(
+                [policy], batch_size=options['batch_size'], sleep=0, progress=progress, now=now
+            )['mails']
+        elapsed = time.perf_counter() - start
+        rss_after = current_rss()
+        if deleted != expected or Mail.objects.filter(timestamp__lt=cutoff).exists():
+            raise RuntimeError(f"{variant} deleted {deleted} of {expected} expired mails")
+        return {
+            'deleted': deleted,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(deleted / elapsed, 1),
+            'rss_growth_kb': round((rss_after - rss_before) / 1024, 1) if rss_before and rss_after else None,
+            # 1バッチ（主キーの取得と DELETE）の所要時間。1回の DELETE がロックを持つのはこの範囲内。
+            'batch_ms': percentiles(batch_times, scale=1000),
+        }
+
+    def _report(self, results):
+        for variant, summary in results['variants'].items():
+            batches = summary['batch_ms']
+            self.stdout.write(
+                f"{variant:9s} {summary['deleted']:>10,} rows in {summary['seconds']:8.2f}s "
+                f"({summary['rows_per_second']:12,.1f} rows/s) "
+                f"longest batch={batches['max']:.1f}ms batches={batches['count']} "
+                f"rss growth={summary['rss_growth_kb']}KB"
+            )
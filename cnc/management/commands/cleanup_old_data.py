@@ -1,25 +1,56 @@
-from django.core.management.base import BaseCommand
-from django.utils import timezone
+import time
 from datetime import timedelta
-from cnc.models import Mail, Notification
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from cnc.retention import POLICIES, get_policies, run_retention
 
 class Command(BaseCommand):
-    help = 'Deletes data older than 30 days'
+    help = 'Deletes expired mails, notifications and push subscriptions in small batches'
 
-    def handle(self, *args, **options):
-        retention_period = timezone.now() - timedelta(days=30)
-        self.stdout.write(f"Cleaning up data older than {retention_period}...")
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--policy', action='append', choices=[policy.name for policy in POLICIES],
+            help='Only run this policy (repeatable; defaults to all)'
+        )
+        parser.add_argument('--batch-size', type=int, default=None, help='Rows per DELETE (RETENTION_BATCH_SIZE)')
+        parser.add_argument(
+            '--sleep', type=float, default=None, help='Seconds between batches (RETENTION_BATCH_SLEEP_SECONDS)'
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Count expired rows without deleting them')
 
-        # 古いメールの削除
+    def handle(self, *args, **options):
         try:
-            deleted_mails, _ = Mail.objects.filter(timestamp__lt=retention_period).delete()
-            self.stdout.write(self.style.SUCCESS(f"Deleted {deleted_mails} old mails."))
-        except Exception as e:
-            self.stdout.write(self.style.WARNING(f"Could not delete mails (or model not found): {e}"))
+            policies = get_policies(options['policy'])
+        except ValueError as e:
+            raise CommandError(e)
+        now = timezone.now()
+        verb = "Would delete" if options['dry_run'] else "Deleted"
+        for policy in policies:
+            cutoff = now - timedelta(days=policy.days)
+            self.stdout.write(f"{policy.name}: older than {policy.days} days ({cutoff})")
 
-        # 通知（足跡情報など）の削除
+        totals = {}
+        started = time.monotonic()
+
+        def progress(policy, total):
+            totals[policy.name] = total
+            if options['verbosity'] >= 2:
+                rate = sum(totals.values()) / max(time.monotonic() - started, 1e-6)
+                self.stdout.write(f"  {policy.name}: {total} rows ({rate:,.0f} rows/s)")
+
+        # バッチごとにコミットされるので、中断しても次の実行で残りから続く
         try:
-            deleted_notifications, _ = Notification.objects.filter(timestamp__lt=retention_period).delete()
-            self.stdout.write(self.style.SUCCESS(f"Deleted {deleted_notifications} old notifications."))
-        except Exception as e:
-            self.stdout.write(self.style.WARNING(f"Could not delete notifications: {e}"))
\ No newline at end of file
+            results = run_retention(
+                policies, batch_size=options['batch_size'], sleep=options['sleep'],
+                dry_run=options['dry_run'], progress=progress, now=now
+            )
+        except KeyboardInterrupt:
+            for name, total in totals.items():
+                self.stdout.write(self.style.WARNING(f"{verb} {total} {name} before the interruption."))
+            raise CommandError("Interrupted; run the command again to continue.")
+
+        if results.get('partitions'):
+            self.stdout.write(self.style.SUCCESS(f"{verb} {results['partitions']} expired partition(s)."))
+        for policy in policies:
+            self.stdout.write(self.style.SUCCESS(f"{verb} {results[policy.name]} {policy.name}."))
+        self.stdout.write(f"Finished in {time.monotonic() - started:.1f}s.")
@@ -0,0 +1,57 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models.functions import Length
+
+from cnc.compression import pack_content
+from cnc.models import Mail
+
+
+class Command(BaseCommand):
+    help = 'Compresses the bodies of existing mails that are at least MAIL_COMPRESS_MIN_BYTES long, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Mails read and updated per batch')
+        parser.add_argument('--sleep', type=float, default=0.1, help='Seconds between batches')
+        parser.add_argument('--dry-run', action='store_true', help='Report the savings without writing them')
+
+    def handle(self, *args, **options):
+        if not settings.MAIL_COMPRESSION_ENABLED:
+            self.stdout.write(self.style.WARNING("MAIL_COMPRESSION_ENABLED is off; nothing to do."))
+            return
+        # 文字数で大まかに絞り込み（UTF-8は1文字4バイトまで）、バイト数での判定は pack_content に任せる
+        queryset = (
+            Mail.objects.filter(content_zlib__isnull=True)
+            .annotate(content_length=Length('content'))
+            .filter(content_length__gte=settings.MAIL_COMPRESS_MIN_BYTES // 4)
+            .order_by('pk')
+            .values_list('pk', 'content')
+        )
+        scanned = compressed = raw_bytes = packed_bytes = 0
+        last_pk = None
+        while True:
+            page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            rows = list(page[:options['batch_size']])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+            updates = []
+            for pk, content in rows:
+                packed_content, content_zlib = pack_content(content)
+                if content_zlib is None:
+                    continue
+                raw_bytes += len(content.encode('utf8'))
+                packed_bytes += len(content_zlib)
+                updates.append(Mail(pk=pk, content=packed_content, content_zlib=content_zlib))
+            scanned += len(rows)
+            compressed += len(updates)
+            if updates and not options['dry_run']:
+                Mail.objects.bulk_update(updates, ['content', 'content_zlib'])
+                time.sleep(options['sleep'])
+            if options['verbosity'] >= 2:
+                self.stdout.write(f"  scanned {scanned}, compressed {compressed}")
+
+        verb = "Would compress" if options['dry_run'] else "Compressed"
+        saved = f" ({raw_bytes:,} -> {packed_bytes:,} bytes)" if compressed else ""
+        self.stdout.write(self.style.SUCCESS(f"{verb} {compressed} of {scanned} candidate mail(s){saved}."))
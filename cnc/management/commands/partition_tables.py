@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from cnc.partitions import (
+    PARTITIONED_MODELS, convert_to_partitioned, ensure_partitions, is_partitioned, list_partitions,
+    partitioning_available,
+)
+
+
+class Command(BaseCommand):
+    help = 'Creates upcoming time-range partitions for Mail and Notification (PostgreSQL with PARTITIONING_ENABLED)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--convert', action='store_true',
+            help='Rebuild plain tables as partitioned tables first (locks each table while its rows are copied)'
+        )
+        parser.add_argument('--ahead', type=int, default=None, help='Partitions to create past the current one')
+
+    def handle(self, *args, **options):
+        if not partitioning_available():
+            self.stdout.write(self.style.WARNING(
+                "Partitioning needs PostgreSQL and PARTITIONING_ENABLED; the tables stay plain."
+            ))
+            return
+        now = timezone.now()
+        ahead = options['ahead'] if options['ahead'] is not None else settings.PARTITION_PREMAKE
+
+        if options['convert']:
+            for model in PARTITIONED_MODELS:
+                table = model._meta.db_table
+                if is_partitioned(model):
+                    self.stdout.write(f"{table} is already partitioned.")
+                    continue
+                created = convert_to_partitioned(model, now, ahead=ahead)
+                self.stdout.write(self.style.SUCCESS(f"Converted {table} into {len(created)} partition(s)."))
+
+        created = ensure_partitions(now, ahead=ahead)
+        self.stdout.write(self.style.SUCCESS(f"Created {len(created)} upcoming partition(s)."))
+        for model in PARTITIONED_MODELS:
+            partitions = list_partitions(model)
+            if not partitions:
+                self.stdout.write(self.style.WARNING(
+                    f"{model._meta.db_table} is not partitioned (run with --convert)."
+                ))
+                continue
+            for name, start, end in partitions:
+                self.stdout.write(f"  {name}: {start:%Y-%m-%d} .. {end:%Y-%m-%d}")
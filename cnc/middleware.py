@@ -1,5 +1,10 @@
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.utils.decorators import sync_and_async_middleware
 from django.utils.deprecation import MiddlewareMixin
 from django.conf import settings
+from whitenoise.middleware import WhiteNoiseMiddleware
+from signaling.metrics import HTTP_REQUESTS, HTTP_REQUEST_SECONDS
 # import os # Not needed
 # from django.urls import get_script_prefix # Not needed for simple check
 # from urllib.parse import urljoin # Not needed for simple check
@@ -11,4 +16,64 @@ class ServiceWorkerAllowedHeaderMiddleware(MiddlewareMixin):
 
         if request.path.endswith(expected_sw_path_suffix):
             response['Service-Worker-Allowed'] = '/'
-        return response
\ No newline at end of file
+        return response
+
+
+class AsyncWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    """
+    非同期のミドルウェアチェーンに置ける WhiteNoise。
+    WhiteNoiseMiddleware は同期専用なので、そのままだと非同期ビューへのリクエストも
+    毎回スレッドプールを経由してしまう。静的ファイルを返すときだけスレッドで開く。
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file, thread_sensitive=False)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve, thread_sensitive=False)(static_file, request)
+        return await self.get_response(request)
+
+
+def _observe_request(request, response, start):
+    # URLパターン単位で集計する（パスをそのまま使うとメールIDごとにラベルが増える）
+    match = getattr(request, 'resolver_match', None)
+    if match is not None:
+        route = match.route
+    elif request.path.startswith(settings.STATIC_URL):
+        route = 'static'
+    else:
+        route = 'unmatched'
+    HTTP_REQUEST_SECONDS.labels(route, request.method).observe(time.perf_counter() - start)
+    HTTP_REQUESTS.labels(route, request.method, str(response.status_code)).inc()
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """HTTPリクエストの件数とレイテンシをPrometheusのメトリクスに記録する"""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = time.perf_counter()
+            response = await get_response(request)
+            _observe_request(request, response, start)
+            return response
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            response = get_response(request)
+            _observe_request(request, response, start)
+            return response
+    return middleware
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.4 on 2026-10-18 18:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cnc', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mail',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['target', 'timestamp'], name='cnc_mail_unread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mail',
+            index=models.Index(fields=['timestamp', 'id'], name='cnc_mail_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('is_delivered', False)), fields=['recipient_uuid', 'timestamp'], name='cnc_notif_undelivered_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['timestamp', 'id'], name='cnc_notif_timestamp_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.4 on 2026-10-18 18:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cnc', '0002_inbox_and_retention_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pushsubscription',
+            name='last_seen_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='pushsubscription',
+            index=models.Index(fields=['last_seen_at', 'id'], name='cnc_push_last_seen_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-18 18:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cnc', '0003_retention_batches'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mail',
+            name='content_zlib',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 import uuid
+from .compression import pack_content, unpack_content
 
 # Create your models here.
 
@@ -31,6 +32,15 @@ class Notification(models.Model):
     class Meta:
         # 新しい順で取得できるように設定
         ordering = ['-timestamp']
+        indexes = [
+            # register時の未配信の通知の取得（宛先ごと・古い順）。未配信の行だけを持つ部分インデックス。
+            models.Index(
+                fields=['recipient_uuid', 'timestamp'], condition=models.Q(is_delivered=False),
+                name='cnc_notif_undelivered_idx'
+            ),
+            # 古いデータの削除（timestampの範囲と、(timestamp, id) のキーセットでのバッチ分け）
+            models.Index(fields=['timestamp', 'id'], name='cnc_notif_timestamp_idx'),
+        ]
 
 class PushSubscription(models.Model):
     """
@@ -49,12 +59,19 @@ class PushSubscription(models.Model):
     # 登録日時
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # 最後に保存し直された日時（クライアントは起動のたびに購読を送り直す）。古いものは削除の対象。
+    last_seen_at = models.DateTimeField(auto_now=True)
+
     def __str__(self):
         return f"Push Subscription for {self.user_uuid[:8]}"
 
     class Meta:
         verbose_name = "Push Subscription"
         verbose_name_plural = "Push Subscriptions"
+        indexes = [
+            # 古い購読の削除（(last_seen_at, id) のキーセットでのバッチ分け）
+            models.Index(fields=['last_seen_at', 'id'], name='cnc_push_last_seen_idx'),
+        ]
 
 class StripeCustomer(models.Model):
     """
@@ -86,10 +103,34 @@ class Mail(models.Model):
     id = models.CharField(max_length=100, primary_key=True)
     sender = models.CharField(max_length=100)
     target = models.CharField(max_length=100)
+    # 本文。MAIL_COMPRESS_MIN_BYTES 以上は圧縮して content_zlib に入れ、content は空にする（cnc/compression.py）
     content = models.TextField()
+    content_zlib = models.BinaryField(blank=True, null=True)
     next_access = models.CharField(max_length=100, blank=True, null=True)
     timestamp = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
 
     def __str__(self):
         return f"Mail {self.id} from {self.sender}"
+
+    def save(self, *args, **kwargs):
+        # content に本文が入っていれば（新しい本文）、保存するときに圧縮する
+        if self.content:
+            self.content, self.content_zlib = pack_content(self.content)
+        super().save(*args, **kwargs)
+
+    @property
+    def text(self):
+        """本文（圧縮されていれば、読んだときに展開する）"""
+        return unpack_content(self.content, self.content_zlib)
+
+    class Meta:
+        indexes = [
+            # register時の未読メールの取得（宛先ごと・古い順）。未読の行だけを持つ部分インデックス。
+            models.Index(
+                fields=['target', 'timestamp'], condition=models.Q(is_read=False),
+                name='cnc_mail_unread_idx'
+            ),
+            # 古いデータの削除（timestampの範囲と、(timestamp, id) のキーセットでのバッチ分け）
+            models.Index(fields=['timestamp', 'id'], name='cnc_mail_timestamp_idx'),
+        ]
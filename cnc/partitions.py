@@ -0,0 +1,221 @@
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.db import connection, transaction
+from .models import Mail, Notification
+
+# --- Mail / Notification の時間範囲パーティション（PostgreSQLのみ・任意） ---
+#
+# PARTITIONING_ENABLED のとき、partition_tables --convert で timestamp の範囲ごとに分割した表に作り替える。
+# パーティションは PARTITION_INTERVAL（month / week）ごとの <table>_pYYYYMMDD（範囲の開始日, UTC）で、
+# どの範囲にも入らない行は <table>_default に入り、あとでその範囲のパーティションを作るときに移される。
+# 定期メンテナンスで PARTITION_PREMAKE 個先まで前もって作っておき、保存期間を過ぎたパーティションは
+# 行を消さずに DROP する（cnc/retention.py）。
+# PostgreSQLでは分割した表の主キーに分割キーを含める必要があるので、主キーは (id, timestamp) になり、
+# id だけの一意性はDBでは保証されなくなる（send_mail_api は同じ id の再送を保存し直さない）。
+# SQLite などでは通常の表のままで、このモジュールの関数は何もしない。
+
+PARTITIONED_MODELS = (Mail, Notification)
+PARTITION_COLUMN = 'timestamp'
+
+BOUND_PATTERN = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def partitioning_available():
+    return settings.PARTITIONING_ENABLED and connection.vendor == 'postgresql'
+
+
+def period_start(moment):
+    """moment を含む範囲の開始（UTCの月初または週の月曜日の0時）"""
+    moment = moment.astimezone(dt_timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if settings.PARTITION_INTERVAL == 'week':
+        return moment - timedelta(days=moment.weekday())
+    return moment.replace(day=1)
+
+
+def next_period(start):
+    if settings.PARTITION_INTERVAL == 'week':
+        return start + timedelta(days=7)
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def premake_end(now, ahead):
+    """今の範囲から ahead 個先の範囲の終わり"""
+    end = next_period(period_start(now))
+    for _ in range(ahead):
+        end = next_period(end)
+    return end
+
+
+def partition_name(table, start):
+    return f"{table}_p{start:%Y%m%d}"
+
+
+def is_partitioned(model):
+    if not partitioning_available():
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE c.relname = %s AND n.nspname = current_schema()",
+            [model._meta.db_table]
+        )
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def list_partitions(model):
+    """範囲を持つパーティションの (名前, 開始, 終了) を古い順に返す（default は含めない）"""
+    if not is_partitioned(model):
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) "
+            "FROM pg_inherits i JOIN pg_class child ON child.oid = i.inhrelid WHERE i.inhparent = %s::regclass",
+            [model._meta.db_table]
+        )
+        rows = cursor.fetchall()
+    partitions = []
+    for name, bound in rows:
+        match = BOUND_PATTERN.search(bound)
+        if match:
+            start, end = (datetime.fromisoformat(value) for value in match.groups())
+            partitions.append((name, start, end))
+    partitions.sort(key=lambda partition: partition[1])
+    return partitions
+
+
+def _move_out_of_default(cursor, table, staging, start, end):
+    """
+    <table>_default にある [start, end) の行を一時表 staging に移し、移した件数を返す。
+    範囲の行が default に残っていると、その範囲のパーティションを作れない。
+    """
+    qn = connection.ops.quote_name
+    default = f"{table}_default"
+    cursor.execute("SELECT to_regclass(%s)", [qn(default)])
+    if cursor.fetchone()[0] is None:
+        return 0
+    cursor.execute(f"CREATE TEMPORARY TABLE {qn(staging)} (LIKE {qn(table)}) ON COMMIT DROP")
+    cursor.execute(
+        f"WITH moved AS (DELETE FROM {qn(default)} "
+        f"WHERE {qn(PARTITION_COLUMN)} >= %s AND {qn(PARTITION_COLUMN)} < %s RETURNING *) "
+        f"INSERT INTO {qn(staging)} SELECT * FROM moved",
+        [start, end]
+    )
+    return cursor.rowcount
+
+
+def _create_partitions(cursor, table, start, end, existing):
+    """
+    [start, end) を範囲ごとのパーティションで埋める。既存のパーティションと重なる範囲は飛ばす。
+    default に入っていた範囲の行は、作ったパーティションに移す。
+    """
+    qn = connection.ops.quote_name
+    created = []
+    period = period_start(start)
+    while period < end:
+        period_end = next_period(period)
+        if not any(s < period_end and period < e for _, s, e in existing):
+            name = partition_name(table, period)
+            staging = f"{name}_staging"
+            with transaction.atomic():
+                moved = _move_out_of_default(cursor, table, staging, period, period_end)
+                cursor.execute(
+                    f"CREATE TABLE IF NOT EXISTS {qn(name)} "
+                    f"PARTITION OF {qn(table)} FOR VALUES FROM (%s) TO (%s)",
+                    [period, period_end]
+                )
+                if moved:
+                    cursor.execute(f"INSERT INTO {qn(table)} OVERRIDING SYSTEM VALUE SELECT * FROM {qn(staging)}")
+                cursor.execute(f"DROP TABLE IF EXISTS {qn(staging)}")
+            created.append(name)
+        period = period_end
+    return created
+
+
+def ensure_partitions(now, ahead=None):
+    """今の範囲から ahead 個先までのパーティションを作り、作ったものの名前を返す"""
+    if ahead is None:
+        ahead = settings.PARTITION_PREMAKE
+    created = []
+    for model in PARTITIONED_MODELS:
+        if not is_partitioned(model):
+            continue
+        existing = list_partitions(model)
+        with connection.cursor() as cursor:
+            created += _create_partitions(cursor, model._meta.db_table, now, premake_end(now, ahead), existing)
+    return created
+
+
+def drop_partition(name):
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE {connection.ops.quote_name(name)}")
+
+
+def _carry_over_sequences(cursor, table, old_table):
+    """
+    連番の列を新しい表に引き継ぐ。IDENTITY の列は INCLUDING IDENTITY で新しいシーケンスが1から始まるので、
+    コピーした行の最大値の次から始め直す。serial の列は古い表のシーケンスを DEFAULT で使い続けるので、
+    古い表と一緒に消えないよう持ち主を新しい表の列に移す。
+    """
+    qn = connection.ops.quote_name
+    cursor.execute(
+        "SELECT attname, attidentity, pg_get_serial_sequence(%s, attname) FROM pg_attribute "
+        "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped",
+        [qn(old_table), qn(old_table)]
+    )
+    for name, identity, sequence in cursor.fetchall():
+        if identity:
+            cursor.execute(
+                f"SELECT setval(pg_get_serial_sequence(%s, %s), COALESCE(max({qn(name)}), 0) + 1, false) "
+                f"FROM {qn(table)}",
+                [qn(table), name]
+            )
+        elif sequence:
+            cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {qn(table)}.{qn(name)}")
+
+
+def convert_to_partitioned(model, now, ahead=None):
+    """
+    通常の表を同じ名前の分割した表に作り替える（1トランザクション。実行中は表がロックされる）。
+    既存の行の範囲から ahead 個先までのパーティションを作って行を移し、インデックスを作り直す。
+    """
+    if ahead is None:
+        ahead = settings.PARTITION_PREMAKE
+    table = model._meta.db_table
+    old_table = f"{table}_unpartitioned"
+    qn = connection.ops.quote_name
+    column = qn(PARTITION_COLUMN)
+    with transaction.atomic(), connection.cursor() as cursor:
+        # 主キー以外のインデックスの定義（表の名前を変える前なので、新しい表にそのまま使える）
+        cursor.execute(
+            "SELECT pg_get_indexdef(x.indexrelid) FROM pg_index x "
+            "WHERE x.indrelid = %s::regclass AND NOT x.indisprimary",
+            [table]
+        )
+        index_definitions = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'", [table]
+        )
+        primary_key = cursor.fetchone()[0]
+        cursor.execute(f"SELECT min({column}) FROM {qn(table)}")
+        oldest = cursor.fetchone()[0] or now
+
+        cursor.execute(f"ALTER TABLE {qn(table)} RENAME TO {qn(old_table)}")
+        cursor.execute(f"ALTER TABLE {qn(old_table)} RENAME CONSTRAINT {qn(primary_key)} TO {qn(old_table + '_pkey')}")
+        cursor.execute(
+            f"CREATE TABLE {qn(table)} (LIKE {qn(old_table)} "
+            f"INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING IDENTITY) "
+            f"PARTITION BY RANGE ({column})"
+        )
+        cursor.execute(f"ALTER TABLE {qn(table)} ADD PRIMARY KEY ({qn(model._meta.pk.column)}, {column})")
+        created = _create_partitions(cursor, table, oldest, premake_end(now, ahead), [])
+        cursor.execute(f"CREATE TABLE {qn(table + '_default')} PARTITION OF {qn(table)} DEFAULT")
+
+        cursor.execute(f"INSERT INTO {qn(table)} OVERRIDING SYSTEM VALUE SELECT * FROM {qn(old_table)}")
+        _carry_over_sequences(cursor, table, old_table)
+        cursor.execute(f"DROP TABLE {qn(old_table)}")
+        # 親の表に作ったインデックスは各パーティションにも作られる
+        for definition in index_definitions:
+            cursor.execute(definition)
+    return created
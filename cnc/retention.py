@@ -0,0 +1,134 @@
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .models import Mail, Notification, PushSubscription
+from .partitions import PARTITIONED_MODELS, drop_partition, list_partitions
+
+# --- 古いデータの削除 ---
+#
+# ポリシーごとに、期限切れの行の主キーを (時刻の列, 主キー) のキーセットで batch_size 件ずつ取り出し、
+# その主キーの行だけを DELETE する。1回の DELETE がロックするのは1バッチ分の行だけで、
+# バッチの間には待ち時間を入れるので、トランザクションプーラー越しに長いロックを持ち続けない。
+# バッチはそれぞれ別にコミットされる。途中で止めても消した行は消えたままで、
+# もう一度実行すれば残りの行から続く（消した行は次の実行で対象に出てこない）。
+# 時間範囲で分割した表（cnc/partitions.py）では、範囲全体が期限切れのパーティションを先に DROP し、
+# 残りの行だけをバッチで消す。
+
+
+class RetentionPolicy:
+    """1種類のデータの保存期間（days_setting の日数より古い行を消す）"""
+
+    def __init__(self, name, model, time_field, days_setting, **conditions):
+        self.name = name
+        self.model = model
+        self.time_field = time_field
+        self.days_setting = days_setting
+        self.conditions = conditions
+
+    @property
+    def days(self):
+        return getattr(settings, self.days_setting)
+
+    def expired(self, now):
+        """now の時点で期限切れの行"""
+        cutoff = now - timedelta(days=self.days)
+        return self.model.objects.filter(**{f"{self.time_field}__lt": cutoff}, **self.conditions)
+
+
+# 既読のメールと配信済みの通知は早めに消す（条件が重ならないので、件数はそのまま足せる）
+POLICIES = [
+    RetentionPolicy('read-mails', Mail, 'timestamp', 'RETENTION_READ_MAIL_DAYS', is_read=True),
+    RetentionPolicy('unread-mails', Mail, 'timestamp', 'RETENTION_DAYS', is_read=False),
+    RetentionPolicy(
+        'delivered-notifications', Notification, 'timestamp', 'RETENTION_DELIVERED_NOTIFICATION_DAYS',
+        is_delivered=True
+    ),
+    RetentionPolicy('undelivered-notifications', Notification, 'timestamp', 'RETENTION_DAYS', is_delivered=False),
+    RetentionPolicy('push-subscriptions', PushSubscription, 'last_seen_at', 'RETENTION_PUSH_SUBSCRIPTION_DAYS'),
+]
+
+
+def get_policies(names=None):
+    """名前で選んだポリシー（Noneなら全部）"""
+    if not names:
+        return list(POLICIES)
+    by_name = {policy.name: policy for policy in POLICIES}
+    unknown = [name for name in names if name not in by_name]
+    if unknown:
+        raise ValueError(f"Unknown retention policies: {', '.join(unknown)}")
+    return [by_name[name] for name in names]
+
+
+def iter_expired_batches(policy, now, batch_size):
+    """期限切れの行の主キーを (時刻, 主キー) の順に batch_size 件ずつ返す"""
+    time_field = policy.time_field
+    queryset = policy.expired(now).order_by(time_field, 'pk').values_list(time_field, 'pk')
+    last = None
+    while True:
+        page = queryset
+        if last is not None:
+            last_time, last_pk = last
+            # (時刻, 主キー) > last。時刻のインデックスを last_time から範囲で読める形にする。
+            page = page.filter(**{f"{time_field}__gte": last_time}).exclude(
+                **{time_field: last_time, 'pk__lte': last_pk}
+            )
+        rows = list(page[:batch_size])
+        if not rows:
+            return
+        last = rows[-1]
+        yield [pk for _, pk in rows]
+
+
+def drop_expired_partitions(policies, now, dry_run=False):
+    """
+    policies の対象の表のうち、範囲全体がその表のどのポリシーでも期限切れのパーティションを DROP し、
+    名前のリストを返す。
+    """
+    models = {policy.model for policy in policies}
+    dropped = []
+    for model in PARTITIONED_MODELS:
+        if model not in models:
+            continue
+        # 一部のポリシーだけを実行するときでも、一番長い保存期間より古い範囲しか消さない
+        days = max(policy.days for policy in POLICIES if policy.model is model)
+        cutoff = now - timedelta(days=days)
+        for name, _, end in list_partitions(model):
+            if end <= cutoff:
+                if not dry_run:
+                    drop_partition(name)
+                dropped.append(name)
+    return dropped
+
+
+def run_retention(policies=None, batch_size=None, sleep=None, dry_run=False, progress=None, now=None):
+    """
+    期限切れの行をポリシーごとにバッチで削除し、{ポリシー名: 件数} を返す
+    （パーティションを DROP した場合は 'partitions' にその数も入る）。
+    dry_run では削除せずに数えるだけ。progress(policy, total) はバッチごとに呼ばれる。
+    """
+    if batch_size is None:
+        batch_size = settings.RETENTION_BATCH_SIZE
+    if sleep is None:
+        sleep = settings.RETENTION_BATCH_SLEEP_SECONDS
+    now = now or timezone.now()
+    policies = policies or POLICIES
+    results = {}
+    dropped = drop_expired_partitions(policies, now, dry_run=dry_run)
+    if dropped:
+        results['partitions'] = len(dropped)
+    for policy in policies:
+        total = 0
+        for pks in iter_expired_batches(policy, now, batch_size):
+            if dry_run:
+                total += len(pks)
+            else:
+                # 取り出した後に既読になった行などを消さないよう、期限切れの条件を付け直して消す
+                deleted, _ = policy.expired(now).filter(pk__in=pks).delete()
+                total += deleted
+            if progress:
+                progress(policy, total)
+            if sleep and not dry_run:
+                time.sleep(sleep)
+        results[policy.name] = total
+    return results
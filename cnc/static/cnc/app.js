@@ -42,6 +42,12 @@ const NEGOTIATION_TIMEOUT_MS = 15000;
 let wsReconnectAttempts = 0;
 const MAX_WS_RECONNECT_ATTEMPTS = 10;
 const INITIAL_WS_RECONNECT_DELAY_MS = 2000;
+// サーバー側のプレゼンスのリース(90秒)が切れないよう、送信が途絶えたらheartbeatを送る
+const SIGNALING_HEARTBEAT_INTERVAL_MS = 25000;
+let signalingHeartbeatTimer = null;
+// msgpackライブラリが読み込めていればバイナリのサブプロトコルで接続する（なければJSON）
+const MSGPACK_SUBPROTOCOL = 'cnc.msgpack.v1';
+let lastSignalingSendAt = 0;
 let activeCallFriendId = null; // 現在通話中の友達ID
 let peerCallTypes = {}; // ピアごとの通話タイプ ('private' | 'meeting' | 'data')
 
@@ -104,6 +110,7 @@ function getLang() {
 const MAX_WS_RECONNECT_DELAY_MS = 5000;
 let wsReconnectTimer = null;
 let isAttemptingReconnect = false;
+let signalingResumeToken = null;
 const CHUNK_SIZE = 16384;
 let fileReader;
 const DB_NAME = 'cybernetcall-db';
@@ -302,6 +309,10 @@ async function addFriend(friendId, friendName = null) {
     await tx.store.put({ id: friendId, name: friendName, added: new Date(), lastSeen: null });
     await tx.done;
     updateStatus(`Friend (${friendId.substring(0,6)}) added successfully!`, 'green');
+    // 新しい友達のオンライン/オフライン通知を購読する
+    if (signalingSocket && signalingSocket.readyState === WebSocket.OPEN) {
+        sendSignalingMessage({ type: 'presence-subscribe', payload: { friends: [friendId] } });
+    }
     await displayFriendList();
   } catch (error) {
     updateStatus("Failed to add friend.", 'red');
@@ -704,7 +715,12 @@ async function connectWebSocket() {
   const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
   const wsUrl = `${wsProtocol}//${location.host}/ws/signaling/`;
   updateStatus('Connecting to signaling server...', 'blue');
-  signalingSocket = new WebSocket(wsUrl); // WebSocketインスタンスを再作成
+  if (typeof MessagePack !== 'undefined') {
+    signalingSocket = new WebSocket(wsUrl, [MSGPACK_SUBPROTOCOL]); // WebSocketインスタンスを再作成
+    signalingSocket.binaryType = 'arraybuffer';
+  } else {
+    signalingSocket = new WebSocket(wsUrl); // WebSocketインスタンスを再作成
+  }
   signalingSocket.onopen = async () => { // asyncキーワードを追加
     wsReconnectAttempts = 0;
     isAttemptingReconnect = false;
@@ -719,18 +735,21 @@ async function connectWebSocket() {
     const friendIds = friends.map(f => f.id);
 
     updateStatus(`Connected to signaling server. Registering...`, 'blue');
+    startSignalingHeartbeat();
     sendSignalingMessage({
       type: 'register',
       payload: { 
           uuid: myDeviceId,
           friends: friendIds, // 友達リスト
-          is_subscribed: isSubscribed // 課金状態を送信
+          features: ['ice-batch'], // まとめられたICE候補(ice-candidates)を受け取れる
+          is_subscribed: isSubscribed, // 課金状態を送信
+          resume_token: signalingResumeToken // 直前の接続の再開トークン（すぐに再接続したときだけ有効）
       }
     });
   };
   signalingSocket.onmessage = async (event) => {
     try {
-      const message = JSON.parse(event.data);
+      const message = decodeSignalingFrame(event.data);
       const messageType = message.type;
       const payload = message.payload || {};
       const senderUUID = message.from || message.uuid || payload.uuid;
@@ -740,6 +759,7 @@ async function connectWebSocket() {
             // サーバーからの通知（不在着信や友達のオンライン通知）を処理する
             offlineActivityCache.clear(); // 新しい通知を受け取る前にキャッシュをクリア
             console.log("[DEBUG] Registered payload:", payload);
+            signalingResumeToken = payload.resume_token || null;
 
             // 先にUIをReady状態にする
             updateStatus('Connected to signaling server. Ready.', 'green');
@@ -748,6 +768,11 @@ async function connectWebSocket() {
 
             if (payload.notifications && Array.isArray(payload.notifications)) {
                 console.log("[DEBUG] Notifications:", payload.notifications);
+                // 未読メールの本文は1回のリクエストでまとめて取得しておく
+                prefetchMails(payload.notifications
+                    .filter(n => n.type === 'new_mail_notification')
+                    .map(n => n.mail_id || n.id)
+                    .filter(Boolean));
                 // 通知のDB保存と反映をバックグラウンドで実行
                 (async () => {
                     for (const notification of payload.notifications) {
@@ -854,6 +879,13 @@ async function connectWebSocket() {
                 await handleIceCandidate(senderUUID, payload.candidate);
             }
             break;
+        case 'ice-candidates':
+             if (senderUUID && Array.isArray(payload.candidates)) {
+                for (const candidate of payload.candidates) {
+                    await handleIceCandidate(senderUUID, candidate);
+                }
+            }
+            break;
         case 'call-request':
              if (senderUUID) {
                 handleIncomingCall(senderUUID);
@@ -875,6 +907,12 @@ async function connectWebSocket() {
                 handleCallBusy(senderUUID);
             }
             break;
+        case 'call-timeout':
+             // 応答がないまま呼び出しが終わった（サーバーが送る）
+             if (senderUUID) {
+                handleCallTimeout(senderUUID);
+            }
+            break;
         case 'new_mail_notification': // 変更: 'mail' から 'new_mail_notification' へ
              console.log("[DEBUG] Realtime new mail notification received:", payload);
              if (payload && payload.sender && payload.sender !== myDeviceId) {
@@ -890,6 +928,7 @@ async function connectWebSocket() {
     }
   };
   signalingSocket.onclose = async (event) => {
+    stopSignalingHeartbeat();
     // 接続が意図せず切れた場合のみ再接続を試みる
     // 1000 (Normal Closure) や 1001 (Going Away) はユーザーがページを離れた場合など。
     if (event.code !== 1000 && event.code !== 1001) {
@@ -944,11 +983,56 @@ function handleWebSocketReconnect() {
 }
 function sendSignalingMessage(message) {
   if (signalingSocket && signalingSocket.readyState === WebSocket.OPEN) {
-    signalingSocket.send(JSON.stringify(message));
+    signalingSocket.send(encodeSignalingFrame(message));
+    lastSignalingSendAt = Date.now();
   } else {
     updateStatus('Signaling connection not ready.', 'red');
   }
 }
+function encodeSignalingFrame(message) {
+  if (signalingSocket.protocol === MSGPACK_SUBPROTOCOL) {
+    return MessagePack.encode(toPlainSignalingValue(message));
+  }
+  return JSON.stringify(message);
+}
+function decodeSignalingFrame(data) {
+  if (typeof data === 'string') {
+    return JSON.parse(data);
+  }
+  return MessagePack.decode(new Uint8Array(data));
+}
+// RTCSessionDescription / RTCIceCandidate などはtoJSON()でプレーンなオブジェクトにしてからmsgpackに渡す
+function toPlainSignalingValue(value) {
+  if (value && typeof value.toJSON === 'function') {
+    return value.toJSON();
+  }
+  if (Array.isArray(value)) {
+    return value.map(toPlainSignalingValue);
+  }
+  if (value && typeof value === 'object') {
+    const plain = {};
+    for (const [key, item] of Object.entries(value)) {
+      if (item !== undefined) plain[key] = toPlainSignalingValue(item);
+    }
+    return plain;
+  }
+  return value;
+}
+function startSignalingHeartbeat() {
+  stopSignalingHeartbeat();
+  signalingHeartbeatTimer = setInterval(() => {
+    // 他のメッセージを送っている間はそれがheartbeatを兼ねる
+    if (Date.now() - lastSignalingSendAt >= SIGNALING_HEARTBEAT_INTERVAL_MS) {
+      sendSignalingMessage({ type: 'heartbeat' });
+    }
+  }, SIGNALING_HEARTBEAT_INTERVAL_MS);
+}
+function stopSignalingHeartbeat() {
+  if (signalingHeartbeatTimer) {
+    clearInterval(signalingHeartbeatTimer);
+    signalingHeartbeatTimer = null;
+  }
+}
 function startAutoConnectFriendsTimer() {
   if (autoConnectFriendsTimer) {
       clearInterval(autoConnectFriendsTimer);
@@ -1084,6 +1168,11 @@ async function createPeerConnection(peerUUID, callType = 'data') {
             payload: { target: peerUUID, candidate: event.candidate }
         });
       } else {
+        // 候補の収集終了を知らせる（サーバーはまとめていた候補をすぐに送る）
+        sendSignalingMessage({
+            type: 'ice-candidate',
+            payload: { target: peerUUID, candidate: null }
+        });
       }
     };
     peer.ondatachannel = event => {
@@ -1374,6 +1463,7 @@ function resetConnection() {
             window.html5QrCodeScanner.clear().catch(e => console.warn("Error clearing scanner during reset:", e));
         }
     } catch(e) { console.warn("Error accessing scanner state during reset:", e); }
+    stopSignalingHeartbeat();
     if (signalingSocket) {
         signalingSocket.onclose = null;
         signalingSocket.onerror = null;
@@ -1432,6 +1522,10 @@ function closePeerConnection(peerUUID, silent = false) {
     clearNegotiationTimeout(peerUUID);
     stopPeerReconnect(peerUUID);
     const peer = peers[peerUUID];
+    if (peer && signalingSocket && signalingSocket.readyState === WebSocket.OPEN) {
+        // サーバーの通話セッションを終わらせる（お互いが次の着信を受けられるように）
+        sendSignalingMessage({ type: 'call-ended', payload: { target: peerUUID } });
+    }
     if (peer) {
         peer.onicecandidate = null;
         peer.ondatachannel = null;
@@ -1797,26 +1891,6 @@ async function deleteMailFromDb(mailId) {
     console.error("Error deleting mail from DB:", error);
   }
 }
-async function deleteMailFromServer(mailId) {
-    if (!mailId) return;
-    try {
-        const csrfToken = getCookie('csrftoken');
-        const headers = {
-            'Content-Type': 'application/json'
-        };
-        if (csrfToken) {
-            headers['X-CSRFToken'] = csrfToken;
-        }
-        
-        // サーバー側の削除APIを呼び出す
-        await fetch(`/api/mails/delete/${mailId}/`, {
-            method: 'DELETE',
-            headers: headers
-        });
-    } catch (error) {
-        console.error("Error deleting mail from server:", error);
-    }
-}
 async function performMailDeletion(mailId) {
     console.log("[DEBUG] performMailDeletion called for:", mailId);
     if (!mailId) return;
@@ -1831,7 +1905,8 @@ async function performMailDeletion(mailId) {
         notificationElement.remove();
     }
     await deleteMailFromDb(mailId);
-    await deleteMailFromServer(mailId);
+    // サーバーからの削除は少し待ってから他のメールとまとめて送る
+    queueMailAck('delete', mailId);
 }
 async function handleDeleteMail(event) {
     event.stopPropagation(); // 親要素へのイベント伝播を停止
@@ -1941,12 +2016,7 @@ function displayNewMailNotification(notification) {
     deleteButton.style.fontSize = '1.2em';
     deleteButton.onclick = async (e) => {
         e.stopPropagation();
-        try {
-            // 削除前にサーバーから取得（クリックして表示ボタンを押したのと同じ効果を与える）
-            await fetch(`/api/mails/get/${mailId}/`);
-        } catch (error) {
-            console.error("Pre-delete fetch failed:", error);
-        }
+        prefetchedMails.delete(mailId);
         await performMailDeletion(mailId);
     };
     div.appendChild(deleteButton);
@@ -1958,6 +2028,66 @@ function displayNewMailNotification(notification) {
     updateStatus(`${i18n[lang].newMailNotification} ${senderName}`, 'purple');
 }
 
+// --- メールのまとめ取得と既読・削除のまとめ送信 ---
+const MAIL_BATCH_LIMIT = 100; // サーバーの MAIL_BATCH_LIMIT と合わせる
+const MAIL_ACK_DELAY_MS = 1000;
+const prefetchedMails = new Map(); // mailId -> mail（まだ既読にしていないもの）
+const pendingMailAcks = { read: new Set(), delete: new Set() };
+let mailAckTimer = null;
+
+async function postMailApi(url, body) {
+    const headers = { 'Content-Type': 'application/json' };
+    const csrfToken = getCookie('csrftoken');
+    if (csrfToken) headers['X-CSRFToken'] = csrfToken;
+    const response = await fetch(url, { method: 'POST', headers: headers, body: JSON.stringify(body) });
+    if (!response.ok) throw new Error(`${url} returned ${response.status}`);
+    return response.json();
+}
+async function prefetchMails(mailIds) {
+    const ids = [...new Set(mailIds)].filter(id => !prefetchedMails.has(id));
+    for (let i = 0; i < ids.length; i += MAIL_BATCH_LIMIT) {
+        try {
+            const result = await postMailApi('/api/mails/batch/', { ids: ids.slice(i, i + MAIL_BATCH_LIMIT) });
+            for (const mail of result.mails || []) {
+                prefetchedMails.set(mail.id, mail);
+            }
+        } catch (error) {
+            // 取得できなかったものは表示するときに1件ずつ取得する
+            console.error("Error prefetching mails:", error);
+        }
+    }
+}
+function queueMailAck(action, mailId) {
+    pendingMailAcks[action].add(mailId);
+    if (!mailAckTimer) {
+        mailAckTimer = setTimeout(flushMailAcks, MAIL_ACK_DELAY_MS);
+    }
+}
+async function flushMailAcks() {
+    mailAckTimer = null;
+    for (const action of ['read', 'delete']) {
+        const ids = [...pendingMailAcks[action]];
+        pendingMailAcks[action].clear();
+        for (let i = 0; i < ids.length; i += MAIL_BATCH_LIMIT) {
+            try {
+                await postMailApi('/api/mails/ack/', {
+                    uuid: myDeviceId, action: action, ids: ids.slice(i, i + MAIL_BATCH_LIMIT)
+                });
+            } catch (error) {
+                console.error(`Error acknowledging mails (${action}):`, error);
+            }
+        }
+    }
+}
+
+// 待っている既読・削除は、ページが隠れたら（閉じる前も含む）すぐに送る
+document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'hidden' && mailAckTimer) {
+        clearTimeout(mailAckTimer);
+        flushMailAcks();
+    }
+});
+
 async function fetchAndDisplayMail(mailId) {
     if (!mailId) return;
     const notificationElement = document.getElementById(`mail-notification-${mailId}`);
@@ -1968,12 +2098,18 @@ async function fetchAndDisplayMail(mailId) {
     }
 
     try {
-        // このAPIはサーバー側で実装する必要があります
-        const response = await fetch(`/api/mails/get/${mailId}/`);
-        if (!response.ok) {
-            throw new Error('Failed to fetch mail from server.');
+        let mail = prefetchedMails.get(mailId);
+        if (mail) {
+            // まとめて取得済み。既読は少し待ってから他のメールとまとめて送る
+            prefetchedMails.delete(mailId);
+            queueMailAck('read', mailId);
+        } else {
+            const response = await fetch(`/api/mails/get/${mailId}/`);
+            if (!response.ok) {
+                throw new Error('Failed to fetch mail from server.');
+            }
+            mail = await response.json();
         }
-        const mail = await response.json();
         if (!mail.id) mail.id = mailId; // IDがない場合は補完
 
         if (dbPromise) {
@@ -2802,6 +2938,18 @@ async function handleCallBusy(peerId) {
     setInteractionUiEnabled(false);
     await displayFriendList();
 }
+async function handleCallTimeout(peerId) {
+    if (currentCallerId === peerId) {
+        // 着信側: 出ないまま呼び出しが終わったので着信画面を閉じる
+        if (incomingCallModal) incomingCallModal.style.display = 'none';
+        currentCallerId = null;
+        return;
+    }
+    updateStatus(`No answer from ${peerId.substring(0, 6)}.`, 'orange');
+    currentAppState = AppState.INITIAL;
+    setInteractionUiEnabled(false);
+    await displayFriendList();
+}
 
 function getCookie(name) {
     let cookieValue = null;
@@ -2858,6 +3006,27 @@ async function subscribeToPushNotifications() {
 // 適切なタイミングで呼び出す。例：ボタンクリック時や、初回アクセス時など。
 // subscribeToPushNotifications();
 
+// 通知が許可済みなら、起動のたびに今の購読を送り直す（サーバーは長く送り直されない購読を削除する）
+async function refreshPushSubscription() {
+    if (!('PushManager' in window) || !('serviceWorker' in navigator)) return;
+    if (window.Notification?.permission !== 'granted') return;
+    try {
+        const registration = await navigator.serviceWorker.ready;
+        const subscription = await registration.pushManager.getSubscription();
+        if (!subscription) return;
+        await fetch('/api/save_push_subscription/', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': getCookie('csrftoken')
+            },
+            body: JSON.stringify({ subscription: subscription, user_id: myDeviceId })
+        });
+    } catch (error) {
+        console.warn('Could not refresh push subscription:', error);
+    }
+}
+
 
 // 適切なタイミングで呼び出す。例：ボタンクリック時や、初回アクセス時など。
 let unreadCount = 0;
@@ -3265,6 +3434,7 @@ async function main() {
 
   // 5. WebSocket接続
   await connectWebSocket();
+  refreshPushSubscription(); // 待たない（Service Workerの準備を待つことがある）
 
   // 6. URLパラメータ（友達追加リンク）の処理
   const urlParams = new URLSearchParams(window.location.search);
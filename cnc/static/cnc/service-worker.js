@@ -2,7 +2,7 @@
 // Service worker with pre-caching for local assets and external libraries
 
 // Define a unique name for the cache, including a version number
-const CACHE_NAME = 'cybernetcall-cache-v5'; // Keep or increment version as needed
+const CACHE_NAME = 'cybernetcall-cache-v6'; // Keep or increment version as needed
 
 // List of URLs to pre-cache when the service worker installs
 const urlsToCache = [
@@ -20,7 +20,8 @@ const urlsToCache = [
   'https://cdnjs.cloudflare.com/ajax/libs/dompurify/3.0.8/purify.min.js',
   'https://cdnjs.cloudflare.com/ajax/libs/qrious/4.0.2/qrious.min.js',
   'https://unpkg.com/idb@7/build/umd.js',
-  'https://unpkg.com/html5-qrcode' // Note:unpkg might redirect, consider specific version URL if issues arise
+  'https://unpkg.com/html5-qrcode', // Note:unpkg might redirect, consider specific version URL if issues arise
+  'https://unpkg.com/@msgpack/msgpack@2.8.0/dist.es5+umd/msgpack.min.js' // シグナリングのmsgpackモード用
 ];
 
 // Event listener for the 'install' event
@@ -1,3 +1,216 @@
-from django.test import TestCase
+import re
+import subprocess
+import sys
+from datetime import timedelta
 
-# Create your tests here.
+from django.conf import settings
+from django.core.management import get_commands
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Mail, Notification
+from .partitions import convert_to_partitioned, ensure_partitions, next_period, period_start
+
+
+class HotQueryPlanTests(TestCase):
+    """
+    register時の受信箱の取得と古いデータの削除で使うクエリが、インデックスを使うことをEXPLAINで確かめる。
+    PostgreSQLでは行数が少ないとシーケンシャルスキャンの方が安くなるので、
+    enable_seqscan を切って「インデックスで実行できるか」を見る（使えなければ Seq Scan が残る）。
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        Mail.objects.bulk_create([
+            Mail(id=f"mail-{n}", sender=f"sender-{n % 7}", target=f"user-{n % 20}", content="x", is_read=n % 3 == 0)
+            for n in range(200)
+        ])
+        Notification.objects.bulk_create([
+            Notification(
+                recipient_uuid=f"user-{n % 20}", sender_uuid=f"sender-{n % 7}",
+                notification_type='missed_call', is_delivered=n % 3 == 0
+            )
+            for n in range(200)
+        ])
+        cls.cutoff = now - timedelta(days=30)
+
+    def setUp(self):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        elif connection.vendor != 'sqlite':
+            self.skipTest(f"No query plan assertions for {connection.vendor}")
+
+    def assertUsesIndex(self, queryset, ordered=False):
+        plan = queryset.explain()
+        if connection.vendor == 'postgresql':
+            self.assertNotIn('Seq Scan', plan, plan)
+            if ordered:
+                self.assertNotRegex(plan, r'\bSort\b', plan)
+            return
+        # SQLite: "SCAN <table>" だけの行はテーブル全体のスキャン（インデックスを使うと "USING ..." が付く）
+        for line in plan.splitlines():
+            self.assertFalse(re.search(r'\bSCAN \w+\s*$', line), plan)
+        if ordered:
+            self.assertNotIn('USE TEMP B-TREE FOR ORDER BY', plan, plan)
+
+    def test_unread_mail_headers(self):
+        self.assertUsesIndex(
+            Mail.objects.filter(target='user-1', is_read=False).order_by('timestamp').values('id', 'sender', 'timestamp'),
+            ordered=True
+        )
+
+    def test_undelivered_notifications(self):
+        self.assertUsesIndex(
+            Notification.objects.filter(recipient_uuid='user-1', is_delivered=False).order_by('timestamp'),
+            ordered=True
+        )
+
+    def test_pending_inbox_uuids(self):
+        self.assertUsesIndex(Mail.objects.filter(is_read=False).values_list('target', flat=True).distinct())
+        self.assertUsesIndex(
+            Notification.objects.filter(is_delivered=False).values_list('recipient_uuid', flat=True).distinct()
+        )
+
+    def test_retention_range_scans(self):
+        self.assertUsesIndex(Mail.objects.filter(timestamp__lt=self.cutoff))
+        self.assertUsesIndex(Notification.objects.filter(timestamp__lt=self.cutoff))
+
+    def test_mail_batch_lookup(self):
+        self.assertUsesIndex(Mail.objects.filter(id__in=['mail-1', 'mail-2', 'mail-3']))
+
+    def test_claim_undelivered_update(self):
+        """PostgreSQLで使う UPDATE ... RETURNING（claim_undelivered_notifications）"""
+        if connection.vendor != 'postgresql':
+            self.skipTest("The UPDATE ... RETURNING path only runs on PostgreSQL")
+        table = connection.ops.quote_name(Notification._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"EXPLAIN UPDATE {table} SET is_delivered = true "
+                f"WHERE recipient_uuid = %s AND is_delivered = false "
+                f"RETURNING sender_uuid, notification_type, timestamp",
+                ['user-1']
+            )
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        self.assertNotIn('Seq Scan', plan, plan)
+
+
+class SendMailTests(TestCase):
+    """send_mail_api はクライアントの再送で同じ id のメールを2通にしない"""
+
+    def send(self, **overrides):
+        data = {'client_id': 'mail-retry', 'sender': 'alice', 'target': 'bob', 'content': 'hello', **overrides}
+        return self.client.post(reverse('send_mail_api'), data, content_type='application/json')
+
+    def test_retry_is_not_stored_twice(self):
+        first = self.send()
+        second = self.send()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertTrue(second.json()['duplicate'])
+        self.assertEqual(second.json()['mail']['timestamp'], first.json()['mail']['timestamp'])
+        self.assertEqual(Mail.objects.filter(id='mail-retry').count(), 1)
+
+    def test_id_of_another_conversation_is_rejected(self):
+        self.send()
+        self.assertEqual(self.send(sender='mallory').status_code, 409)
+        self.assertEqual(Mail.objects.get(id='mail-retry').sender, 'alice')
+
+    @override_settings(PARTITIONING_ENABLED=True)
+    def test_retry_on_partitioned_table(self):
+        """分割した表の主キーは (id, timestamp) なので、重複はDBではなく send_mail_api が防ぐ"""
+        if connection.vendor != 'postgresql':
+            self.skipTest("Partitioned tables are only available on PostgreSQL")
+        convert_to_partitioned(Mail, timezone.now())
+        self.send()
+        self.send()
+        self.assertEqual(Mail.objects.filter(id='mail-retry').count(), 1)
+
+
+class AckMailsTests(TestCase):
+    """ack_mails_api は呼び出したユーザー宛てのメールだけを既読にする・削除する"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Mail.objects.bulk_create([
+            Mail(id='to-bob', sender='alice', target='bob', content='x'),
+            Mail(id='to-carol', sender='alice', target='carol', content='x'),
+        ])
+
+    def ack(self, **data):
+        return self.client.post(reverse('ack_mails_api'), data, content_type='application/json')
+
+    def test_read_and_delete_only_own_mails(self):
+        response = self.ack(uuid='bob', action='read', ids=['to-bob', 'to-carol'])
+        self.assertEqual(response.json()['count'], 1)
+        self.assertFalse(Mail.objects.get(id='to-carol').is_read)
+        response = self.ack(uuid='bob', action='delete', ids=['to-bob', 'to-carol'])
+        self.assertEqual(response.json()['count'], 1)
+        self.assertEqual(list(Mail.objects.values_list('id', flat=True)), ['to-carol'])
+
+    def test_uuid_is_required(self):
+        self.assertEqual(self.ack(action='delete', ids=['to-carol']).status_code, 400)
+        self.assertTrue(Mail.objects.filter(id='to-carol').exists())
+
+
+@override_settings(PARTITIONING_ENABLED=True)
+class PartitionTests(TestCase):
+
+    def setUp(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest("Partitioned tables are only available on PostgreSQL")
+
+    def test_rows_in_default_move_to_new_partition(self):
+        now = timezone.now()
+        convert_to_partitioned(Mail, now, ahead=0)
+        # 作ってある範囲より先のメールは default に入る（timestamp は auto_now_add なので保存後に動かす）
+        later = next_period(period_start(now))
+        Mail.objects.create(id='mail-later', sender='alice', target='bob', content='x')
+        Mail.objects.filter(id='mail-later').update(timestamp=later)
+        created = ensure_partitions(now, ahead=1)
+        self.assertEqual(created, [f"{Mail._meta.db_table}_p{later:%Y%m%d}"])
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT tableoid::regclass::text FROM {Mail._meta.db_table} WHERE id = 'mail-later'")
+            self.assertEqual(cursor.fetchone()[0], created[0])
+
+
+# ベンチマークを最小の規模で1回ずつ動かす引数（bench_* のコマンドを足したらここにも足す）
+BENCH_SMOKE_ARGS = {
+    'bench_broadcast': ['--subscribers', '20', '--workers', '2', '--broadcasts', '2', '--msgpack-ratio', '0.5'],
+    'bench_codec': ['--number', '100'],
+    'bench_ice': ['--calls', '2'],
+    'bench_mail_api': ['--requests', '20', '--concurrency', '5'],
+    'bench_partitions': ['--rows', '100', '--inserts', '10', '--queries', '10'],
+    'bench_presence': ['--connections', '50', '--friends', '5', '--joins', '5'],
+    'bench_push': ['--pushes', '10', '--service-latency', '0.001'],
+    'bench_relay': ['--messages', '50', '--background-users', '10'],
+    'bench_retention': ['--rows', '200', '--batch-size', '50'],
+    'bench_signaling': ['--clients', '20', '--candidates', '2', '--concurrency', '10', '--timeout', '10'],
+}
+
+
+class BenchCommandSmokeTests(SimpleTestCase):
+    """
+    ベンチマークのコマンドがコンシューマーなどの変更で壊れていないことを、最小の規模で実行して確かめる。
+    各コマンドは自分でテスト用DBを作って消すので、別プロセスで、SQLite（メモリ上のDB）のときだけ動かす。
+    """
+
+    def test_every_bench_command_runs(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest("The bench commands would replace this run's test database")
+        benches = sorted(name for name in get_commands() if name.startswith('bench_'))
+        self.assertEqual(benches, sorted(BENCH_SMOKE_ARGS))
+        for name in benches:
+            with self.subTest(name):
+                result = subprocess.run(
+                    [sys.executable, 'manage.py', name, *BENCH_SMOKE_ARGS[name]],
+                    cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=300
+                )
+                if name == 'bench_partitions':
+                    # PostgreSQLでしか測れないので、分かるエラーで止まることだけを見る
+                    self.assertIn("only available on PostgreSQL", result.stderr)
+                    continue
+                self.assertEqual(result.returncode, 0, result.stderr)
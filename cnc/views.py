@@ -1,15 +1,20 @@
 import json
-from django.http import JsonResponse, HttpResponseBadRequest
+from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest
 from django.views.generic import View, TemplateView
 from django.shortcuts import render
 from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
+from django.db import IntegrityError, connection, transaction
+from asgiref.sync import sync_to_async
 from .models import PushSubscription, Mail
+from .compression import unpack_content
 from datetime import datetime, timezone
 from .models import StripeCustomer
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from signaling.codecs import frame_event
+from signaling.inbox_flags import get_inbox_flags
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 import stripe
 
 
@@ -187,6 +192,15 @@ class StripeWebhookView(View):
         return JsonResponse({'status': 'success'})
 
 
+class MetricsView(View):
+    """Prometheus形式のメトリクスを返すビュー（このプロセスの値のみ）"""
+    def get(self, request, *args, **kwargs):
+        token = settings.METRICS_TOKEN
+        if token and request.headers.get('Authorization') != f"Bearer {token}":
+            return HttpResponse(status=401)
+        return HttpResponse(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
+
 class LegalDisclosureView(TemplateView):
     template_name = "cnc/legal_disclosure.html"
 
@@ -195,33 +209,72 @@ class LegalDisclosureEnView(TemplateView):
     template_name = "cnc/legal_disclosure_en.html"
 
 
+# メールのAPIはDaphneのイベントループ上で動く非同期ビュー。
+# ORMは非同期API（acreate/aupdateなど）、チャネルレイヤーへの通知はそのままawaitする。
+
+def store_mail(data):
+    """
+    client_id を id にしてメールを保存し、(mail, 新しく保存したか) を返す。
+    クライアントの再送で同じ id のメールが2通にならないよう、保存済みならそれを返す。
+    分割した表（cnc/partitions.py）の主キーは (id, timestamp) で id の重複を弾けないので、
+    PostgreSQLでは id ごとのアドバイザリーロックで確認と保存を直列にする。
+    """
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [data['client_id']])
+        existing = Mail.objects.filter(id=data['client_id']).first()
+        if existing is not None:
+            return existing, False
+        try:
+            with transaction.atomic():
+                mail = Mail.objects.create(
+                    id=data['client_id'],
+                    sender=data['sender'],
+                    target=data['target'],
+                    content=data['content'],
+                    next_access=data.get('next_access')
+                )
+        except IntegrityError:
+            # ロックのないDBで同じ id が同時に保存された
+            return Mail.objects.get(id=data['client_id']), False
+    return mail, True
+
+
 @csrf_exempt
-def send_mail_api(request):
+async def send_mail_api(request):
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
-            # DBにメールを保存
-            mail = Mail.objects.create(
-                id=data['client_id'],
-                sender=data['sender'],
-                target=data['target'],
-                content=data['content'],
-                next_access=data.get('next_access')
-            )
+            # DBにメールを保存（同じ client_id の再送なら保存済みのメールを返し、通知もしない）
+            mail, created = await sync_to_async(store_mail)(data)
+            if not created:
+                if (mail.sender, mail.target) != (data['sender'], data['target']):
+                    return JsonResponse({'error': 'Mail ID already in use'}, status=409)
+                return JsonResponse({'status': 'success', 'duplicate': True, 'mail': {
+                    'id': mail.id,
+                    'timestamp': mail.timestamp.isoformat()
+                }})
+            # 相手が次にregisterしたときに受信箱をDBから読むようにする
+            inbox_flags = get_inbox_flags()
+            if inbox_flags:
+                await inbox_flags.mark([mail.target])
             
             # 相手にWebSocketで通知を送る
+            # フレームはここで一度だけエンコードし、受信側のコンシューマーはそのまま送るだけにする
+            notification = {
+                "type": "new_mail_notification",
+                "mail_id": str(mail.id),
+                "sender": mail.sender,
+                "timestamp": mail.timestamp.isoformat()
+            }
             channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
+            await channel_layer.group_send(
                 f"user_{data['target']}", # 相手のグループ名 (consumers.pyの実装に合わせる)
-                {
-                    "type": "send_notification", # consumers.pyのハンドラ名
-                    "notification": {
-                        "type": "new_mail_notification",
-                        "mail_id": str(mail.id),
-                        "sender": mail.sender,
-                        "timestamp": mail.timestamp.isoformat()
-                    }
-                }
+                frame_event({
+                    "type": notification["type"],
+                    "payload": notification
+                })
             )
             
             return JsonResponse({'status': 'success', 'mail': {
@@ -233,21 +286,96 @@ def send_mail_api(request):
     return JsonResponse({'error': 'Invalid method'}, status=405)
 
 
-def get_mail_api(request, mail_id):
+# 1回のbatch/ackで扱えるメールの上限
+MAIL_BATCH_LIMIT = 100
+
+MAIL_FIELDS = ('id', 'sender', 'target', 'content', 'content_zlib', 'next_access', 'timestamp', 'is_read')
+
+
+def mail_to_json(mail):
+    """values(*MAIL_FIELDS) の行をクライアントに返す形にする"""
+    return {
+        'id': mail['id'],
+        'sender': mail['sender'],
+        'target': mail['target'],
+        'content': unpack_content(mail['content'], mail['content_zlib']),
+        'nextAccess': mail['next_access'],
+        'timestamp': mail['timestamp'].isoformat()
+    }
+
+
+def parse_mail_request(request):
+    """リクエストボディ（JSONオブジェクト）と、その "ids" から重複を除いたリストを返す。不正ならidsはNone。"""
     try:
-        mail = Mail.objects.get(id=mail_id)
-        # メールを既読にする
-        if not mail.is_read:
-            mail.is_read = True
-            mail.save()
-
-        return JsonResponse({
-            'id': mail.id,
-            'sender': mail.sender,
-            'target': mail.target,
-            'content': mail.content,
-            'nextAccess': mail.next_access,
-            'timestamp': mail.timestamp.isoformat()
-        })
-    except Mail.DoesNotExist:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return {}, None
+    if not isinstance(data, dict):
+        return {}, None
+    return data, clean_mail_ids(data.get('ids'))
+
+
+def clean_mail_ids(ids):
+    if not isinstance(ids, list) or not all(isinstance(mail_id, str) and mail_id for mail_id in ids):
+        return None
+    ids = list(dict.fromkeys(ids))
+    if not ids or len(ids) > MAIL_BATCH_LIMIT:
+        return None
+    return ids
+
+
+async def get_mail_api(request, mail_id):
+    mail = await Mail.objects.filter(id=mail_id).values(*MAIL_FIELDS).afirst()
+    if mail is None:
         return JsonResponse({'error': 'Mail not found'}, status=404)
+    # メールを既読にする（行全体は保存せず、未読のときだけ is_read を更新する）
+    if not mail['is_read']:
+        await Mail.objects.filter(id=mail_id, is_read=False).aupdate(is_read=True)
+
+    return JsonResponse(mail_to_json(mail))
+
+
+@csrf_exempt
+async def batch_mail_api(request):
+    """複数のメールを1回のクエリで返す（既読にはしない。既読は ack_mails_api で知らせる）"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid method'}, status=405)
+    _, ids = parse_mail_request(request)
+    if ids is None:
+        return JsonResponse({'error': f'Expected "ids": a list of 1 to {MAIL_BATCH_LIMIT} mail IDs'}, status=400)
+    mails = [
+        mail_to_json(mail)
+        async for mail in Mail.objects.filter(id__in=ids).values(*MAIL_FIELDS).order_by('timestamp')
+    ]
+    found = {mail['id'] for mail in mails}
+    return JsonResponse({'mails': mails, 'missing': [mail_id for mail_id in ids if mail_id not in found]})
+
+
+async def acknowledge_mails(action, ids, user_uuid):
+    """
+    user_uuid 宛てのメールだけを、既読にする・削除するを1回の UPDATE / DELETE ... WHERE id IN (...) で行い、
+    件数を返す（他人宛てのIDは数えずに無視する）
+    """
+    mails = Mail.objects.filter(id__in=ids, target=user_uuid)
+    if action == 'read':
+        return await mails.filter(is_read=False).aupdate(is_read=True)
+    deleted, _ = await mails.adelete()
+    return deleted
+
+
+@csrf_exempt
+async def ack_mails_api(request):
+    """{"uuid": 受信者, "action": "read" | "delete", "ids": [...]} をまとめて処理する"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid method'}, status=405)
+    data, ids = parse_mail_request(request)
+    action = data.get('action')
+    user_uuid = data.get('uuid')
+    if ids is None or action not in ('read', 'delete') or not isinstance(user_uuid, str) or not user_uuid:
+        return JsonResponse(
+            {'error': 'Expected "uuid", "action": "read" or "delete" and '
+                      f'"ids": a list of 1 to {MAIL_BATCH_LIMIT} mail IDs'},
+            status=400
+        )
+    count = await acknowledge_mails(action, ids, user_uuid)
+    return JsonResponse({'status': 'success', 'action': action, 'count': count})
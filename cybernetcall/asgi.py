@@ -11,8 +11,10 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from channels.auth import AuthMiddlewareStack
 import signaling.routing # signaling アプリのルーティングをインポート
+from cybernetcall.maintenance import MaintenanceLifespan
 
-application = ProtocolTypeRouter({
+# 古いデータの削除などの定期メンテナンスもこのアプリと一緒に動かす
+application = MaintenanceLifespan(ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AllowedHostsOriginValidator(
         AuthMiddlewareStack(
@@ -21,4 +23,4 @@ application = ProtocolTypeRouter({
             )
         )
     ),
-})
+}))
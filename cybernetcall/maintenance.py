@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+
+from cnc.inbox import iter_pending_inbox_uuids
+from cnc.partitions import ensure_partitions
+from cnc.retention import POLICIES, get_policies, run_retention
+from signaling.metrics import MAINTENANCE_RUNS, MAINTENANCE_SECONDS, timer
+from signaling.inbox_flags import rebuild_inbox_flags
+from signaling.presence import sweep_presence
+from signaling.redis_pool import get_redis_connection, get_sync_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# --- ASGIアプリと一緒に動く定期メンテナンス ---
+#
+# Render の無料プランには cron がないので、古いデータの削除などをワーカーの中で定期的に実行する。
+# maintenance:lock:<job> をジョブごとのリースとして取れたワーカーだけが実行する（リーダー選出）。
+# リースは実行間隔より少し長く、実行中は延長し、終わっても外さない。リーダーは次の回もそのまま実行し、
+# リーダーのワーカーが落ちたときだけ、リースが切れた後に別のワーカーが引き継ぐ。
+# 同期処理（ORM）は専用のスレッドプールで実行し、WebSocketを処理するイベントループを止めない。
+
+LOCK_KEY_PREFIX = "maintenance:lock:"
+
+# 空いているか自分のものならリースを取る（延長する）
+# KEYS[1]=lock / ARGV: owner, ttl(ms)
+ACQUIRE_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+
+
+class MaintenanceJob:
+    """定期ジョブ。blocking なら func は同期関数としてスレッドプールで実行する。"""
+
+    def __init__(self, name, interval_setting, func, blocking=False):
+        self.name = name
+        self.interval_setting = interval_setting
+        self.func = func
+        self.blocking = blocking
+
+    @property
+    def interval(self):
+        return getattr(settings, self.interval_setting)
+
+
+def expire_old_data():
+    return run_retention([policy for policy in POLICIES if policy.name != 'push-subscriptions'])
+
+
+def prune_push_subscriptions():
+    return run_retention(get_policies(['push-subscriptions']))
+
+
+def create_future_partitions():
+    return ensure_partitions(timezone.now())
+
+
+def reconcile_inbox_flags():
+    """受信箱の未処理フラグをDBから作り直す（Redisのフラッシュやフラグを立てられなかった後の復旧）"""
+    redis_conn = get_sync_redis_connection()
+    if redis_conn is None:
+        return 0
+    return rebuild_inbox_flags(redis_conn, iter_pending_inbox_uuids())
+
+
+async def sweep_stale_presence():
+    return len(await sweep_presence(get_channel_layer()))
+
+
+# 間隔の設定が0以下のジョブは動かさない
+JOBS = [
+    MaintenanceJob('retention', 'MAINTENANCE_RETENTION_INTERVAL_SECONDS', expire_old_data, blocking=True),
+    MaintenanceJob(
+        'push-subscriptions', 'MAINTENANCE_PUSH_PRUNE_INTERVAL_SECONDS', prune_push_subscriptions, blocking=True
+    ),
+    MaintenanceJob(
+        'partitions', 'MAINTENANCE_PARTITION_INTERVAL_SECONDS', create_future_partitions, blocking=True
+    ),
+    MaintenanceJob(
+        'inbox-flags', 'MAINTENANCE_INBOX_RECONCILE_INTERVAL_SECONDS', reconcile_inbox_flags, blocking=True
+    ),
+    MaintenanceJob('presence-sweep', 'PRESENCE_SWEEP_INTERVAL_SECONDS', sweep_stale_presence),
+]
+
+
+class RedisMaintenanceLock:
+    """ジョブのリースをRedisに置く（本番用。全ワーカーで1つ）"""
+
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+        self._acquire = redis_conn.register_script(ACQUIRE_SCRIPT)
+
+    async def acquire(self, job_name, owner, ttl):
+        """リースが空いているか owner のものなら ttl 秒に延ばしてTrue"""
+        return bool(await self._acquire(keys=[LOCK_KEY_PREFIX + job_name], args=[owner, int(ttl * 1000)]))
+
+
+class LocalMaintenanceLock:
+    """プロセス内の辞書にリースを置く（ローカル開発用: DEBUG=True）"""
+
+    def __init__(self):
+        self.leases = {}  # job -> (owner, expires_at)
+
+    async def acquire(self, job_name, owner, ttl):
+        now = time.time()
+        entry = self.leases.get(job_name)
+        if entry is not None and entry[0] != owner and entry[1] > now:
+            return False
+        self.leases[job_name] = (owner, now + ttl)
+        return True
+
+
+def jittered(seconds):
+    """seconds を ±MAINTENANCE_JITTER の割合でずらす"""
+    jitter = settings.MAINTENANCE_JITTER
+    return seconds * random.uniform(1 - jitter, 1 + jitter)
+
+
+class MaintenanceScheduler:
+    """イベントループ上でジョブごとのループを回す"""
+
+    def __init__(self, jobs, lock):
+        self.jobs = jobs
+        self.lock = lock
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.MAINTENANCE_THREADS, thread_name_prefix='maintenance'
+        )
+        self.tasks = []
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(self._loop(job)) for job in self.jobs]
+        logger.info(f"Maintenance scheduler started with {', '.join(job.name for job in self.jobs)}.")
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _loop(self, job):
+        # 起動直後に全ワーカーが一斉に取りに行かないよう、最初の実行もずらす
+        await asyncio.sleep(random.uniform(0, job.interval * settings.MAINTENANCE_JITTER))
+        while True:
+            try:
+                await self.run_once(job)
+            except Exception as e:
+                logger.exception(f"Maintenance job {job.name} failed: {e}")
+            await asyncio.sleep(jittered(job.interval))
+
+    async def run_once(self, job):
+        """リースが取れればジョブを1回実行する。実行したらTrue。"""
+        # 次の回（最長で間隔の 1 + JITTER 倍後）までリーダーが持ち続けられる長さ
+        ttl = job.interval * (1 + settings.MAINTENANCE_JITTER) + 1
+        if not await self.lock.acquire(job.name, self.owner, ttl):
+            MAINTENANCE_RUNS.labels(job.name, 'skipped').inc()
+            return False
+        keeper = asyncio.get_running_loop().create_task(self._keep_lease(job, ttl))
+        try:
+            with timer(MAINTENANCE_SECONDS.labels(job.name)):
+                if job.blocking:
+                    result = await database_sync_to_async(
+                        job.func, thread_sensitive=False, executor=self.executor
+                    )()
+                else:
+                    result = await job.func()
+        except Exception:
+            MAINTENANCE_RUNS.labels(job.name, 'error').inc()
+            raise
+        finally:
+            keeper.cancel()
+        # 終わった時点から次の回まで持つように延ばし直す
+        await self.lock.acquire(job.name, self.owner, ttl)
+        MAINTENANCE_RUNS.labels(job.name, 'ok').inc()
+        logger.info(f"Maintenance job {job.name} finished: {result}")
+        return True
+
+    async def _keep_lease(self, job, ttl):
+        """実行が長引いてもリースが切れないよう延長し続ける"""
+        while True:
+            await asyncio.sleep(ttl / 3)
+            try:
+                if not await self.lock.acquire(job.name, self.owner, ttl):
+                    logger.warning(f"Lost the maintenance lease for {job.name} while it was running.")
+                    return
+            except Exception as e:
+                logger.warning(f"Could not extend the maintenance lease for {job.name}: {e}")
+
+
+local_maintenance_lock = LocalMaintenanceLock()
+redis_maintenance_lock = None
+
+
+def get_maintenance_lock():
+    """環境に応じたリースの置き場所を返す。Redisが使えない場合はプロセス内（ワーカーごと）で代用する。"""
+    global redis_maintenance_lock
+    if settings.DEBUG:
+        return local_maintenance_lock
+    if redis_maintenance_lock is None:
+        redis_conn = get_redis_connection()
+        if redis_conn is None:
+            logger.warning("Redis is not available; every worker runs its own maintenance jobs.")
+            return local_maintenance_lock
+        redis_maintenance_lock = RedisMaintenanceLock(redis_conn)
+    return redis_maintenance_lock
+
+
+_schedulers = {}
+
+
+def start_maintenance():
+    """実行中のイベントループにスケジューラがなければ起動する"""
+    if not settings.MAINTENANCE_ENABLED:
+        return None
+    loop = asyncio.get_running_loop()
+    scheduler = _schedulers.get(loop)
+    if scheduler is None:
+        # 閉じられたループのスケジューラは捨てる
+        for old_loop in [l for l in _schedulers if l.is_closed()]:
+            del _schedulers[old_loop]
+        jobs = [job for job in JOBS if job.interval > 0]
+        scheduler = _schedulers[loop] = MaintenanceScheduler(jobs, get_maintenance_lock())
+        scheduler.start()
+    return scheduler
+
+
+async def stop_maintenance():
+    scheduler = _schedulers.pop(asyncio.get_running_loop(), None)
+    if scheduler is not None:
+        await scheduler.stop()
+
+
+class MaintenanceLifespan:
+    """
+    ASGIアプリを包み、定期メンテナンスを起動する。
+    Daphne は lifespan を送らないので、最初のリクエスト（ヘルスチェックなど）で起動する。
+    lifespan に対応したサーバーでは起動時に始め、終了時に止める。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        try:
+            start_maintenance()
+        except Exception as e:
+            logger.exception(f"Could not start the maintenance scheduler: {e}")
+        return await self.app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                start_maintenance()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await stop_maintenance()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
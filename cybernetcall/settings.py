@@ -55,8 +55,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'cnc.middleware.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'cnc.middleware.AsyncWhiteNoiseMiddleware',
     'cnc.middleware.ServiceWorkerAllowedHeaderMiddleware', 
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -108,6 +109,21 @@ else:
         },
     }
 
+# チャネルレイヤー用のRedisを複数指定すると、グループとチャネルをコンシステントハッシュで分散する
+# (例: CHANNEL_REDIS_URLS=redis://a:6379/0,redis://b:6379/0)。ホストを増やした後は
+# rebalance_channel_layer で既存のグループを移す。全体通知用のグループは先頭のホストに固定する。
+CHANNEL_REDIS_URLS = env.list("CHANNEL_REDIS_URLS", default=[REDIS_URL])
+if not DEBUG and len(CHANNEL_REDIS_URLS) > 1:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "signaling.sharded_layer.ShardedRedisChannelLayer",
+            "CONFIG": {
+                "hosts": CHANNEL_REDIS_URLS,
+                "pinned_groups": {"signaling_broadcast": 0},
+            },
+        },
+    }
+
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
@@ -199,6 +215,100 @@ SUPERUSER_PASSWORD = env("SUPERUSER_PASSWORD", default=None)
 VAPID_PUBLIC_KEY = env("VAPID_PUBLIC_KEY", default=None)
 VAPID_PRIVATE_KEY = env("VAPID_PRIVATE_KEY", default=None)
 
+# Web Push 配信ディスパッチャ (signaling/push.py)
+PUSH_MAX_CONCURRENCY = env.int("PUSH_MAX_CONCURRENCY", default=16)
+PUSH_QUEUE_SIZE = env.int("PUSH_QUEUE_SIZE", default=1000)
+PUSH_TIMEOUT_SECONDS = env.float("PUSH_TIMEOUT_SECONDS", default=10.0)
+PUSH_MAX_RETRIES = env.int("PUSH_MAX_RETRIES", default=3)
+PUSH_BACKOFF_BASE_SECONDS = env.float("PUSH_BACKOFF_BASE_SECONDS", default=0.5)
+PUSH_KEEPALIVE_SECONDS = env.float("PUSH_KEEPALIVE_SECONDS", default=60.0)
+PUSH_TTL_SECONDS = env.int("PUSH_TTL_SECONDS", default=0)
+
+# プレゼンス配信モード: "subscription"(友達のみに配信) / "broadcast"(旧来の全体配信)
+SIGNALING_PRESENCE_MODE = env("SIGNALING_PRESENCE_MODE", default="subscription")
+PRESENCE_MAX_SUBSCRIPTIONS = env.int("PRESENCE_MAX_SUBSCRIPTIONS", default=1000)
+# 接続ごとのプレゼンスのリース。クライアントは HEARTBEAT 間隔で何かを送ってリースを延長する。
+PRESENCE_LEASE_SECONDS = env.int("PRESENCE_LEASE_SECONDS", default=90)
+PRESENCE_HEARTBEAT_SECONDS = env.int("PRESENCE_HEARTBEAT_SECONDS", default=30)
+PRESENCE_SWEEP_INTERVAL_SECONDS = env.int("PRESENCE_SWEEP_INTERVAL_SECONDS", default=60)
+PRESENCE_SWEEP_BATCH = env.int("PRESENCE_SWEEP_BATCH", default=500)
+# ワーカー内のプレゼンスのニアキャッシュ（Redisのpub/subで無効化。TTLは無効化を取りこぼしたときの上限）
+PRESENCE_CACHE_ENABLED = env.bool("PRESENCE_CACHE_ENABLED", default=True)
+PRESENCE_CACHE_MAX_ENTRIES = env.int("PRESENCE_CACHE_MAX_ENTRIES", default=50000)
+PRESENCE_CACHE_TTL_SECONDS = env.float("PRESENCE_CACHE_TTL_SECONDS", default=30.0)
+
+# 転送時にuser_<uuid>グループを経由せず、リースから分かるチャネルに直接送る
+# （ルートキャッシュはプレゼンスのニアキャッシュと同じpub/subで無効化するので、ニアキャッシュが無効なら使わない）
+SIGNALING_DIRECT_ROUTING = env.bool("SIGNALING_DIRECT_ROUTING", default=True)
+ROUTE_CACHE_TTL_SECONDS = env.float("ROUTE_CACHE_TTL_SECONDS", default=2.0)
+ROUTE_CACHE_MAX_ENTRIES = env.int("ROUTE_CACHE_MAX_ENTRIES", default=10000)
+
+# ICE候補を送信者・宛先ごとに時間窓(ミリ秒)でまとめて転送する。0で無効。
+SIGNALING_ICE_COALESCE_MS = env.int("SIGNALING_ICE_COALESCE_MS", default=0)
+SIGNALING_ICE_COALESCE_MAX_BATCH = env.int("SIGNALING_ICE_COALESCE_MAX_BATCH", default=32)
+
+# 通話開始（call-request から最後のICE候補まで）の所要時間の計測
+CALL_TRACE_ENABLED = env.bool("CALL_TRACE_ENABLED", default=True)
+# answer の後にICE候補がこの秒数途切れたら接続完了とみなす
+CALL_TRACE_ICE_IDLE_SECONDS = env.float("CALL_TRACE_ICE_IDLE_SECONDS", default=2.0)
+# 応答がないまま経過したら放棄として記録する
+CALL_TRACE_TIMEOUT_SECONDS = env.float("CALL_TRACE_TIMEOUT_SECONDS", default=60.0)
+CALL_TRACE_BUFFER_SIZE = env.int("CALL_TRACE_BUFFER_SIZE", default=1000)
+
+# 通話セッション（呼び出し中・通話中の状態）。応答がないまま RING_TIMEOUT 経つと不在着信になる。
+CALL_RING_TIMEOUT_SECONDS = env.float("CALL_RING_TIMEOUT_SECONDS", default=30.0)
+# call-ended が届かなかったときに「通話中」を解除するまでの上限
+CALL_ACCEPTED_TTL_SECONDS = env.int("CALL_ACCEPTED_TTL_SECONDS", default=4 * 3600)
+# 終わったセッションの状態を残す秒数（この間の call-request の再送は無視する）
+CALL_SESSION_LINGER_SECONDS = env.int("CALL_SESSION_LINGER_SECONDS", default=10)
+CALL_RING_SWEEP_INTERVAL_SECONDS = env.int("CALL_RING_SWEEP_INTERVAL_SECONDS", default=15)
+CALL_RING_SWEEP_BATCH = env.int("CALL_RING_SWEEP_BATCH", default=200)
+
+# 接続が1つもない相手へのシグナリングを溜めておき、再接続（register）時に送り直す
+SIGNAL_BUFFER_ENABLED = env.bool("SIGNAL_BUFFER_ENABLED", default=True)
+SIGNAL_BUFFER_TTL_SECONDS = env.int("SIGNAL_BUFFER_TTL_SECONDS", default=30)
+SIGNAL_BUFFER_MAX_MESSAGES = env.int("SIGNAL_BUFFER_MAX_MESSAGES", default=200)
+
+# 切断から RESUME_GRACE_SECONDS 以内に再開トークン付きで再接続したら、受信箱の読み込みや
+# user_joined の配信を省く。切断側も同じ秒数だけ user_left を遅らせる。0で無効。
+RESUME_GRACE_SECONDS = env.int("RESUME_GRACE_SECONDS", default=15)
+
+# 古いデータの削除 (cnc/retention.py)。種類ごとの保存日数。
+RETENTION_DAYS = env.int("RETENTION_DAYS", default=30)
+RETENTION_READ_MAIL_DAYS = env.int("RETENTION_READ_MAIL_DAYS", default=7)
+RETENTION_DELIVERED_NOTIFICATION_DAYS = env.int("RETENTION_DELIVERED_NOTIFICATION_DAYS", default=7)
+# 起動時に送り直されないまま（アプリを開かないまま）この日数が経った購読
+RETENTION_PUSH_SUBSCRIPTION_DAYS = env.int("RETENTION_PUSH_SUBSCRIPTION_DAYS", default=90)
+# 1回の DELETE で消す行数と、次のバッチまでの待ち時間
+RETENTION_BATCH_SIZE = env.int("RETENTION_BATCH_SIZE", default=1000)
+RETENTION_BATCH_SLEEP_SECONDS = env.float("RETENTION_BATCH_SLEEP_SECONDS", default=0.1)
+
+# Mail.content の圧縮。MIN_BYTES 以上の本文を zlib で圧縮して保存する（既存の行は compress_mail_content で移す）
+MAIL_COMPRESSION_ENABLED = env.bool("MAIL_COMPRESSION_ENABLED", default=True)
+MAIL_COMPRESS_MIN_BYTES = env.int("MAIL_COMPRESS_MIN_BYTES", default=1024)
+MAIL_COMPRESS_LEVEL = env.int("MAIL_COMPRESS_LEVEL", default=6)
+
+# Mail / Notification を timestamp の範囲（month / week）で分割する（PostgreSQLのみ）。
+# 有効にしたら partition_tables --convert で表を作り替える。PREMAKE 個先のパーティションまで前もって作る。
+PARTITIONING_ENABLED = env.bool("PARTITIONING_ENABLED", default=False)
+PARTITION_INTERVAL = env("PARTITION_INTERVAL", default="month")
+PARTITION_PREMAKE = env.int("PARTITION_PREMAKE", default=3)
+
+# ASGIアプリと一緒に動く定期メンテナンス (cybernetcall/maintenance.py)。間隔が0のジョブは動かさない。
+# プレゼンスの掃除は PRESENCE_SWEEP_INTERVAL_SECONDS の間隔で動く。
+MAINTENANCE_ENABLED = env.bool("MAINTENANCE_ENABLED", default=True)
+MAINTENANCE_RETENTION_INTERVAL_SECONDS = env.int("MAINTENANCE_RETENTION_INTERVAL_SECONDS", default=3600)
+MAINTENANCE_PUSH_PRUNE_INTERVAL_SECONDS = env.int("MAINTENANCE_PUSH_PRUNE_INTERVAL_SECONDS", default=24 * 3600)
+MAINTENANCE_PARTITION_INTERVAL_SECONDS = env.int("MAINTENANCE_PARTITION_INTERVAL_SECONDS", default=24 * 3600)
+# 受信箱の未処理フラグ（signaling/inbox_flags.py）をDBから作り直す間隔
+MAINTENANCE_INBOX_RECONCILE_INTERVAL_SECONDS = env.int("MAINTENANCE_INBOX_RECONCILE_INTERVAL_SECONDS", default=900)
+# 実行間隔をこの割合の範囲でずらす（ワーカーが同時にリースを取りに行かないように）
+MAINTENANCE_JITTER = env.float("MAINTENANCE_JITTER", default=0.1)
+MAINTENANCE_THREADS = env.int("MAINTENANCE_THREADS", default=1)
+
+# /metrics を保護するトークン（設定時は "Authorization: Bearer <token>" が必要）
+METRICS_TOKEN = env("METRICS_TOKEN", default=None)
+
 STRIPE_PUBLISHABLE_KEY = env("STRIPE_PUBLISHABLE_KEY", default=None)
 STRIPE_SECRET_KEY = env("STRIPE_SECRET_KEY", default=None)
 STRIPE_PRICE_ID_USD = env("STRIPE_PRICE_ID_USD", default=None)
@@ -0,0 +1,278 @@
+import logging
+import time
+from django.conf import settings
+from .redis_pool import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# --- 通話セッションの状態 ---
+#
+# 発信者と着信者の組ごとに1つのセッションを持ち、状態は次のように遷移する。
+#   (なし) -> ringing -> accepted / rejected / busy / timed-out
+#   ringing / accepted -> ended （call-ended や切断）
+# ringing と accepted の間は両者の「通話中」キーがこのセッションを指し、
+# どちらかが別のセッションに入っている call-request にはサーバーが call-busy を返す（相手の端末は鳴らさない）。
+# 相手からこちらへの呼び出しが鳴っている間にこちらからも呼び出した（同時発信）ときは、
+# 同じ通話として相手の呼び出しにこちらが応答したことにする。
+# 状態の遷移は1回の操作で行うので、複数のワーカーが同時にタイムアウトさせても
+# 不在着信を記録するのは遷移に成功した1か所だけになる。
+
+STATE_RINGING = 'ringing'
+STATE_ACCEPTED = 'accepted'
+STATE_REJECTED = 'rejected'
+STATE_BUSY = 'busy'
+STATE_TIMED_OUT = 'timed-out'
+STATE_ENDED = 'ended'
+
+# request() の結果
+REQUEST_RINGING = 'ringing'      # 新しく呼び出しを始めた（相手に転送する）
+REQUEST_DUPLICATE = 'duplicate'  # 同じ組の呼び出しが進行中（再送なので何もしない）
+REQUEST_BUSY = 'busy'            # 相手（またはこちら）が別の通話中
+REQUEST_GLARE = 'glare'          # 相手からこちらへの呼び出しが鳴っている（同時発信）
+
+# 応答メッセージの種類と遷移先の状態
+ANSWER_STATES = {
+    'call-accepted': STATE_ACCEPTED,
+    'call-rejected': STATE_REJECTED,
+    'call-busy': STATE_BUSY,
+}
+
+SESSION_KEY_PREFIX = "call:session:"
+ACTIVE_KEY_PREFIX = "call:active:"
+RINGING_KEY = "call:ringing"  # ZSET member=session id, score=呼び出しの期限
+
+
+def session_id(caller_uuid, callee_uuid):
+    return f"{caller_uuid}:{callee_uuid}"
+
+
+def split_session_id(sid):
+    caller_uuid, _, callee_uuid = sid.partition(':')
+    return caller_uuid, callee_uuid
+
+
+def ringing_ttl():
+    """
+    呼び出し中のキーのTTL。担当のワーカーが落ちても掃除で拾えるよう、呼び出しの期限より長く残す。
+    """
+    return int(settings.CALL_RING_TIMEOUT_SECONDS * 2) + settings.CALL_SESSION_LINGER_SECONDS
+
+
+# KEYS: session, active(callee), active(caller), ringing, 逆向きのsession / ARGV: sid, deadline, ring ttl
+REQUEST_SCRIPT = """
+local state = redis.call('HGET', KEYS[1], 'state')
+if state == 'ringing' or state == 'accepted' or state == 'timed-out' then
+    return 'duplicate'
+end
+if redis.call('HGET', KEYS[5], 'state') == 'ringing' then
+    return 'glare'
+end
+for i = 2, 3 do
+    local active = redis.call('GET', KEYS[i])
+    if active and active ~= ARGV[1] then
+        return 'busy'
+    end
+end
+redis.call('HSET', KEYS[1], 'state', 'ringing', 'deadline', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[3])
+redis.call('SET', KEYS[3], ARGV[1], 'EX', ARGV[3])
+redis.call('ZADD', KEYS[4], ARGV[2], ARGV[1])
+return 'ringing'
+"""
+
+# 状態が ARGV[2] のいずれかなら ARGV[3] に遷移し、遷移前の状態を返す（しなければ false）。
+# ringing でないセッションが期限のリストに残っていれば（キーの期限切れなど）ここで外す。
+# accepted は通話中キーを残し、それ以外は通話中キーを外して ARGV[5] 秒だけ状態を残す。
+# KEYS: session, active(callee), active(caller), ringing / ARGV: sid, from states, to state, accepted ttl, linger
+TRANSITION_SCRIPT = """
+local state = redis.call('HGET', KEYS[1], 'state')
+if state ~= 'ringing' then
+    redis.call('ZREM', KEYS[4], ARGV[1])
+end
+if not state or not string.find(',' .. ARGV[2] .. ',', ',' .. state .. ',', 1, true) then
+    return false
+end
+redis.call('HSET', KEYS[1], 'state', ARGV[3])
+redis.call('ZREM', KEYS[4], ARGV[1])
+if ARGV[3] == 'accepted' then
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[4])
+    redis.call('SET', KEYS[3], ARGV[1], 'EX', ARGV[4])
+    return state
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+for i = 2, 3 do
+    if redis.call('GET', KEYS[i]) == ARGV[1] then
+        redis.call('DEL', KEYS[i])
+    end
+end
+return state
+"""
+
+
+class RedisCallSessionRegistry:
+    """通話セッションをRedisで管理する（本番用）"""
+
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+        self._request = redis_conn.register_script(REQUEST_SCRIPT)
+        self._transition = redis_conn.register_script(TRANSITION_SCRIPT)
+
+    @staticmethod
+    def _keys(caller_uuid, callee_uuid):
+        return [
+            SESSION_KEY_PREFIX + session_id(caller_uuid, callee_uuid),
+            ACTIVE_KEY_PREFIX + callee_uuid,
+            ACTIVE_KEY_PREFIX + caller_uuid,
+            RINGING_KEY,
+        ]
+
+    async def request(self, caller_uuid, callee_uuid):
+        """call-request を受けたときに呼ぶ。REQUEST_* のいずれかを返す。"""
+        ring = settings.CALL_RING_TIMEOUT_SECONDS
+        return await self._request(
+            keys=self._keys(caller_uuid, callee_uuid) + [SESSION_KEY_PREFIX + session_id(callee_uuid, caller_uuid)],
+            args=[session_id(caller_uuid, callee_uuid), time.time() + ring, ringing_ttl()],
+        )
+
+    async def _move(self, caller_uuid, callee_uuid, from_states, to_state):
+        result = await self._transition(
+            keys=self._keys(caller_uuid, callee_uuid),
+            args=[
+                session_id(caller_uuid, callee_uuid), ','.join(from_states), to_state,
+                settings.CALL_ACCEPTED_TTL_SECONDS, settings.CALL_SESSION_LINGER_SECONDS,
+            ],
+        )
+        return result or None
+
+    async def answer(self, caller_uuid, callee_uuid, state):
+        """着信側の応答で ringing から遷移させる。遷移したらTrue。"""
+        return await self._move(caller_uuid, callee_uuid, (STATE_RINGING,), state) is not None
+
+    async def time_out(self, caller_uuid, callee_uuid):
+        """まだ ringing なら timed-out にする。Trueを返した呼び出し元だけが不在着信を記録する。"""
+        return await self._move(caller_uuid, callee_uuid, (STATE_RINGING,), STATE_TIMED_OUT) is not None
+
+    async def end(self, caller_uuid, callee_uuid):
+        """ringing / accepted のセッションを終了し、終了前の状態を返す（なければNone）"""
+        return await self._move(caller_uuid, callee_uuid, (STATE_RINGING, STATE_ACCEPTED), STATE_ENDED)
+
+    async def active_session(self, user_uuid):
+        """user_uuid が参加している進行中のセッションの (caller, callee)。なければNone。"""
+        sid = await self.redis_conn.get(ACTIVE_KEY_PREFIX + user_uuid)
+        return split_session_id(sid) if sid else None
+
+    async def expired_rings(self, limit=None):
+        """呼び出しの期限を過ぎたセッションの (caller, callee) のリスト（担当したワーカーが落ちた分）"""
+        sids = await self.redis_conn.zrangebyscore(
+            RINGING_KEY, '-inf', time.time(), start=0, num=limit or settings.CALL_RING_SWEEP_BATCH
+        )
+        return [split_session_id(sid) for sid in sids]
+
+
+class LocalCallSessionRegistry:
+    """プロセス内の辞書で通話セッションを管理する（ローカル開発用: DEBUG=True）"""
+
+    def __init__(self):
+        self.sessions = {}  # sid -> (state, expires_at, deadline)
+        self.active = {}    # uuid -> (sid, expires_at)
+
+    def _state(self, sid, now):
+        entry = self.sessions.get(sid)
+        if entry is None or entry[1] <= now:
+            self.sessions.pop(sid, None)
+            return None
+        return entry[0]
+
+    def _active(self, user_uuid, now):
+        entry = self.active.get(user_uuid)
+        if entry is None or entry[1] <= now:
+            self.active.pop(user_uuid, None)
+            return None
+        return entry[0]
+
+    async def request(self, caller_uuid, callee_uuid):
+        now = time.time()
+        sid = session_id(caller_uuid, callee_uuid)
+        if self._state(sid, now) in (STATE_RINGING, STATE_ACCEPTED, STATE_TIMED_OUT):
+            return REQUEST_DUPLICATE
+        if self._state(session_id(callee_uuid, caller_uuid), now) == STATE_RINGING:
+            return REQUEST_GLARE
+        for user_uuid in (callee_uuid, caller_uuid):
+            active = self._active(user_uuid, now)
+            if active and active != sid:
+                return REQUEST_BUSY
+        ring = settings.CALL_RING_TIMEOUT_SECONDS
+        expires_at = now + ringing_ttl()
+        self.sessions[sid] = (STATE_RINGING, expires_at, now + ring)
+        self.active[callee_uuid] = self.active[caller_uuid] = (sid, expires_at)
+        return REQUEST_RINGING
+
+    def _move(self, caller_uuid, callee_uuid, from_states, to_state):
+        now = time.time()
+        sid = session_id(caller_uuid, callee_uuid)
+        state = self._state(sid, now)
+        if state not in from_states:
+            return None
+        if to_state == STATE_ACCEPTED:
+            expires_at = now + settings.CALL_ACCEPTED_TTL_SECONDS
+            self.active[callee_uuid] = self.active[caller_uuid] = (sid, expires_at)
+        else:
+            expires_at = now + settings.CALL_SESSION_LINGER_SECONDS
+            for user_uuid in (caller_uuid, callee_uuid):
+                if self._active(user_uuid, now) == sid:
+                    del self.active[user_uuid]
+        self.sessions[sid] = (to_state, expires_at, None)
+        return state
+
+    async def answer(self, caller_uuid, callee_uuid, state):
+        return self._move(caller_uuid, callee_uuid, (STATE_RINGING,), state) is not None
+
+    async def time_out(self, caller_uuid, callee_uuid):
+        return self._move(caller_uuid, callee_uuid, (STATE_RINGING,), STATE_TIMED_OUT) is not None
+
+    async def end(self, caller_uuid, callee_uuid):
+        return self._move(caller_uuid, callee_uuid, (STATE_RINGING, STATE_ACCEPTED), STATE_ENDED)
+
+    async def active_session(self, user_uuid):
+        sid = self._active(user_uuid, time.time())
+        return split_session_id(sid) if sid else None
+
+    async def expired_rings(self, limit=None):
+        now = time.time()
+        expired = [
+            split_session_id(sid) for sid, (state, _, deadline) in list(self.sessions.items())
+            if state == STATE_RINGING and deadline <= now
+        ]
+        return expired[:limit or settings.CALL_RING_SWEEP_BATCH]
+
+
+_last_ring_sweep_at = 0.0
+
+
+def ring_sweep_due():
+    """前回から CALL_RING_SWEEP_INTERVAL_SECONDS 以上経っていればTrue（プロセスごと）"""
+    global _last_ring_sweep_at
+    now = time.time()
+    if now - _last_ring_sweep_at < settings.CALL_RING_SWEEP_INTERVAL_SECONDS:
+        return False
+    _last_ring_sweep_at = now
+    return True
+
+
+local_call_sessions = LocalCallSessionRegistry()
+redis_call_sessions = None
+
+
+def get_call_sessions():
+    """環境に応じた通話セッションのレジストリを返す。Redisが使えない場合はNone。"""
+    global redis_call_sessions
+    if settings.DEBUG:
+        return local_call_sessions
+    if redis_call_sessions is None:
+        redis_conn = get_redis_connection()
+        if redis_conn is None:
+            return None
+        redis_call_sessions = RedisCallSessionRegistry(redis_conn)
+    return redis_call_sessions
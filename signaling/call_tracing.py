@@ -0,0 +1,226 @@
+import asyncio
+import collections
+import json
+import logging
+import time
+from django.conf import settings
+from .redis_pool import get_redis_connection
+from .metrics import CALL_SETUP_SECONDS, CALL_SETUP_OUTCOMES, CALL_SETUP_SIGNALING_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# --- 通話開始までの時間の計測 ---
+#
+# 発信側の接続から見ると、通話開始までのメッセージはすべて自分の接続を通る。
+#   送信: call-request, offer, ice-candidate
+#   受信: call-accepted / call-rejected / call-busy / call-timeout, answer, ice-candidate(s)
+# そこで発信側のコンシューマーが1通話分のスパンを持ち、各フェーズの時刻を記録する。
+# answer の後にICE候補が CALL_TRACE_ICE_IDLE_SECONDS 途切れたら接続完了とみなす。
+#
+# call-request はサーバーが転送するかどうかを決めるので、handle_call_request から直接記録する。
+#
+# signaling_ms はサーバー内でかかった時間の合計（送信はチャネルレイヤーへの転送、
+# 受信は相手のワーカーが転送してからこの接続に届くまで）。残りはクライアント側の時間。
+
+PHASES = ('accepted', 'offer', 'answer', 'first_ice', 'last_ice')
+
+OUTCOME_CONNECTED = 'connected'
+OUTCOME_REJECTED = 'rejected'
+OUTCOME_BUSY = 'busy'
+OUTCOME_TIMED_OUT = 'timed-out'
+OUTCOME_ABANDONED = 'abandoned'
+
+ICE_TYPES = frozenset({'ice-candidate', 'ice-candidates'})
+# クライアントが送るメッセージのうちスパンに関係するもの
+TRACED_OUTGOING_TYPES = frozenset({'offer', 'ice-candidate'})
+
+# 完了したスパンのリングバッファ（Redisのリスト。新しいものが先頭）
+SPANS_KEY = "calltrace:spans"
+
+
+class CallSetupSpan:
+    """1回の発信の各フェーズの時刻（call-requestからの経過秒）"""
+    __slots__ = ('caller', 'callee', 'started_at', 'started_wall', 'marks', 'signaling_seconds', 'messages')
+
+    def __init__(self, caller, callee):
+        self.caller = caller
+        self.callee = callee
+        self.started_at = time.monotonic()
+        self.started_wall = time.time()
+        self.marks = {}
+        self.signaling_seconds = 0.0
+        self.messages = 1
+
+    def mark(self, phase):
+        self.marks.setdefault(phase, time.monotonic() - self.started_at)
+
+    def mark_ice(self):
+        offset = time.monotonic() - self.started_at
+        self.marks.setdefault('first_ice', offset)
+        self.marks['last_ice'] = offset
+
+    def to_dict(self, outcome):
+        phases_ms = {phase: round(self.marks[phase] * 1000, 1) for phase in PHASES if phase in self.marks}
+        connected_at = phases_ms.get('last_ice', phases_ms.get('answer')) if outcome == OUTCOME_CONNECTED else None
+        return {
+            'caller': self.caller,
+            'callee': self.callee,
+            'started_at': self.started_wall,
+            'outcome': outcome,
+            'phases_ms': phases_ms,
+            'time_to_connect_ms': connected_at,
+            'signaling_ms': round(self.signaling_seconds * 1000, 1),
+            'messages': self.messages,
+        }
+
+
+class CallSetupRecorder:
+    """完了したスパンをヒストグラムとリングバッファに記録する（プロセスに1つ）"""
+
+    def __init__(self, redis_conn=None, size=1000):
+        self.redis_conn = redis_conn
+        self.size = size
+        self.local = collections.deque(maxlen=size)
+        self._pending = set()
+
+    def record(self, span_dict):
+        CALL_SETUP_OUTCOMES.labels(span_dict['outcome']).inc()
+        phases = span_dict['phases_ms']
+        for phase in ('accepted', 'answer'):
+            if phase in phases:
+                CALL_SETUP_SECONDS.labels(phase).observe(phases[phase] / 1000)
+        if span_dict['time_to_connect_ms'] is not None:
+            CALL_SETUP_SECONDS.labels('connected').observe(span_dict['time_to_connect_ms'] / 1000)
+        CALL_SETUP_SIGNALING_SECONDS.observe(span_dict['signaling_ms'] / 1000)
+
+        if self.redis_conn is None:
+            self.local.appendleft(span_dict)
+            return
+        # 呼び出し元（タイマーのコールバックなど）を待たせないよう、書き込みは別タスクで行う
+        task = asyncio.get_running_loop().create_task(self._push(span_dict))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _push(self, span_dict):
+        try:
+            pipe = self.redis_conn.pipeline(transaction=False)
+            pipe.lpush(SPANS_KEY, json.dumps(span_dict))
+            pipe.ltrim(SPANS_KEY, 0, self.size - 1)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not store call setup span: {e}")
+
+
+_recorder = None
+
+
+def get_call_setup_recorder():
+    global _recorder
+    if _recorder is None:
+        _recorder = CallSetupRecorder(
+            redis_conn=None if settings.DEBUG else get_redis_connection(),
+            size=settings.CALL_TRACE_BUFFER_SIZE,
+        )
+    return _recorder
+
+
+class CallSetupTracker:
+    """
+    1つの接続が発信した通話のスパンを追跡する。
+    outgoing() は受信したフレーム（＝クライアントが送ったもの）、incoming() はこの接続に届けるフレームで呼ぶ。
+    """
+
+    def __init__(self, user_uuid, recorder, ice_idle, timeout):
+        self.user_uuid = user_uuid
+        self.recorder = recorder
+        self.ice_idle = ice_idle
+        self.timeout = timeout
+        self.span = None
+        self._timer = None
+
+    def outgoing(self, message_type, payload, elapsed=0.0):
+        """elapsed はこのメッセージの転送にかかった時間（秒）"""
+        target_uuid = payload.get('target')
+        if message_type == 'call-request':
+            if self.span:
+                self.finish(OUTCOME_ABANDONED)
+            self.span = CallSetupSpan(self.user_uuid, target_uuid)
+            self.span.signaling_seconds += elapsed
+            self._schedule(self.timeout)
+            return
+        span = self.span
+        if span is None or target_uuid != span.callee:
+            return
+        span.messages += 1
+        span.signaling_seconds += elapsed
+        if message_type == 'offer':
+            span.mark('offer')
+        elif message_type in ICE_TYPES and payload.get('candidate', payload.get('candidates')) is not None:
+            self._ice()
+
+    def incoming(self, message_type, from_uuid, sent_at=None):
+        """sent_at は相手側のワーカーが転送した時刻（time.time()）"""
+        span = self.span
+        if span is None or from_uuid != span.callee:
+            return
+        span.messages += 1
+        if sent_at is not None:
+            span.signaling_seconds += max(time.time() - sent_at, 0.0)
+        if message_type == 'call-accepted':
+            span.mark('accepted')
+        elif message_type == 'call-rejected':
+            self.finish(OUTCOME_REJECTED)
+        elif message_type == 'call-busy':
+            self.finish(OUTCOME_BUSY)
+        elif message_type == 'call-timeout':
+            self.finish(OUTCOME_TIMED_OUT)
+        elif message_type == 'answer':
+            span.mark('answer')
+            self._schedule(self.ice_idle)
+        elif message_type in ICE_TYPES:
+            self._ice()
+
+    def _ice(self):
+        self.span.mark_ice()
+        if 'answer' in self.span.marks:
+            self._schedule(self.ice_idle)
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._expire)
+
+    def _expire(self):
+        self._timer = None
+        if self.span is None:
+            return
+        self.finish(OUTCOME_CONNECTED if 'answer' in self.span.marks else OUTCOME_ABANDONED)
+
+    def finish(self, outcome):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        span, self.span = self.span, None
+        if span is None:
+            return
+        try:
+            self.recorder.record(span.to_dict(outcome))
+        except Exception as e:
+            logger.warning(f"Could not record call setup span: {e}")
+
+    def close(self):
+        """切断時に呼ぶ。answer まで進んでいれば接続済みとして記録する。"""
+        if self.span is not None:
+            self.finish(OUTCOME_CONNECTED if 'answer' in self.span.marks else OUTCOME_ABANDONED)
+
+
+def phase_breakdown(span_dict):
+    """スパンを区間ごとの所要時間（ミリ秒）に分ける。どこで時間がかかっているかを見るため。"""
+    phases = span_dict['phases_ms']
+    breakdown = {}
+    previous = 0.0
+    for name, phase in (('ringing', 'accepted'), ('offer', 'offer'), ('answer', 'answer'), ('ice', 'last_ice')):
+        if phase in phases:
+            breakdown[name] = round(max(phases[phase] - previous, 0.0), 1)
+            previous = phases[phase]
+    return breakdown
@@ -0,0 +1,69 @@
+import time
+from django.conf import settings
+from .presence import get_presence_registry
+
+
+class ChannelRouteCache:
+    """
+    UUID -> 有効なチャネル名のリスト を短時間だけ覚えておくプロセス内キャッシュ。
+    ICE候補のように同じ相手への送信が続くとき、毎回レジストリを引かずに済む。
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}  # uuid -> (expires_at, channel_names)
+        # 無効化の回数。レジストリを読んでいる間に無効化が来たら、読んだ値はキャッシュしない。
+        self.epoch = 0
+
+    def get(self, user_uuid):
+        entry = self.entries.get(user_uuid)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.entries[user_uuid]
+            return None
+        return entry[1]
+
+    def set(self, user_uuid, channel_names, epoch=None):
+        if epoch is not None and epoch != self.epoch:
+            return
+        if user_uuid not in self.entries and len(self.entries) >= self.max_entries:
+            # 一番古いエントリを捨てる（dictは挿入順）
+            del self.entries[next(iter(self.entries))]
+        self.entries[user_uuid] = (time.monotonic() + self.ttl, list(channel_names))
+
+    def invalidate(self, user_uuid):
+        self.epoch += 1
+        self.entries.pop(user_uuid, None)
+
+    def clear(self):
+        self.epoch += 1
+        self.entries.clear()
+
+
+route_cache = ChannelRouteCache(
+    ttl=settings.ROUTE_CACHE_TTL_SECONDS,
+    max_entries=settings.ROUTE_CACHE_MAX_ENTRIES,
+)
+
+
+async def resolve_channels(user_uuid, registry=None):
+    """
+    user_uuid宛てに直接送れるチャネル名のリストを返す。
+    分からない場合（レジストリなし・リースなし）は空リストを返し、呼び出し側はグループ送信に戻る。
+    他のワーカーでの接続・切断は presence:changes で届くので、その購読中だけキャッシュを使う。
+    """
+    registry = registry or get_presence_registry()
+    if registry is None:
+        return []
+    if not registry.watch_routes(route_cache):
+        return await registry.channels_for(user_uuid)
+    channel_names = route_cache.get(user_uuid)
+    if channel_names is not None:
+        return channel_names
+    epoch = route_cache.epoch
+    channel_names = await registry.channels_for(user_uuid)
+    if channel_names:
+        route_cache.set(user_uuid, channel_names, epoch)
+    return channel_names
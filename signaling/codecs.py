@@ -0,0 +1,87 @@
+import json
+import msgpack
+
+# WebSocketのサブプロトコルで使うフレーム形式を決める。
+# クライアントが要求しなければ従来通りJSONのテキストフレームを使う。
+MSGPACK_SUBPROTOCOL = "cnc.msgpack.v1"
+# 1フレームの上限（SDPでも数十KB程度なので十分）
+MAX_FRAME_BYTES = 1024 * 1024
+
+
+class CodecError(ValueError):
+    """フレームをデコードできなかった"""
+
+
+class JsonCodec:
+    """従来のJSONテキストフレーム"""
+    subprotocol = None
+
+    def decode(self, text_data=None, bytes_data=None):
+        if text_data is None:
+            raise CodecError("Expected a text frame")
+        try:
+            return json.loads(text_data)
+        except json.JSONDecodeError as e:
+            raise CodecError(str(e)) from e
+
+    def encode(self, message):
+        """self.send() に渡すキーワード引数を返す"""
+        return {'text_data': json.dumps(message)}
+
+    def frame(self, event):
+        """render_frames() 済みのイベントから self.send() の引数を取り出す"""
+        return {'text_data': event['text']}
+
+
+class MsgpackCodec:
+    """msgpackのバイナリフレーム"""
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            # 念のためテキストフレームはJSONとして受け付ける
+            return JSON_CODEC.decode(text_data=text_data)
+        if len(bytes_data) > MAX_FRAME_BYTES:
+            raise CodecError(f"Frame too large ({len(bytes_data)} bytes)")
+        try:
+            return msgpack.unpackb(bytes_data, raw=False)
+        except (msgpack.ExtraData, msgpack.FormatError, msgpack.StackError, ValueError) as e:
+            raise CodecError(str(e)) from e
+
+    def encode(self, message):
+        return {'bytes_data': msgpack.packb(message, use_bin_type=True)}
+
+    def frame(self, event):
+        return {'bytes_data': event['bytes']}
+
+
+JSON_CODEC = JsonCodec()
+MSGPACK_CODEC = MsgpackCodec()
+
+
+def render_frames(message):
+    """
+    メッセージを送信側で一度だけ両方の形式にエンコードしておく。
+    受信側の各コンシューマーはエンコードし直さずにそのまま送るだけになる。
+    受信者が多いとき（ブロードキャスト、プレゼンス、メールの通知）に使う。
+    1人宛ての転送では使わない方の形式を運ぶだけになるので使わない。
+    """
+    return {
+        'text': json.dumps(message),
+        'bytes': msgpack.packb(message, use_bin_type=True),
+    }
+
+
+def frame_event(message, sender_channel=None):
+    """チャネルレイヤーで送る 'signal_frame' イベントを作る"""
+    event = {'type': 'signal_frame', **render_frames(message)}
+    if sender_channel:
+        event['sender_channel'] = sender_channel
+    return event
+
+
+def negotiate_codec(subprotocols):
+    """クライアントが要求したサブプロトコルから使うコーデックを選ぶ"""
+    if MSGPACK_SUBPROTOCOL in (subprotocols or []):
+        return MSGPACK_CODEC
+    return JSON_CODEC
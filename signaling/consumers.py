@@ -1,47 +1,62 @@
-import json
+import asyncio
 import logging
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
 from django.conf import settings
-from pywebpush import webpush, WebPushException
-import redis.asyncio as redis
-from cnc.models import Notification, PushSubscription, Mail
+from cnc.models import Notification
+from cnc.inbox import claim_inbox_snapshot
+from .push import get_push_dispatcher
+from .presence import (
+    BROADCAST_GROUP_NAME, presence_group_name, use_broadcast_presence, clean_friend_uuids,
+    publish_presence_event, get_presence_registry, maybe_sweep_presence,
+)
+from .redis_pool import get_redis_connection
+from .inbox_flags import get_inbox_flags
+from .signal_buffer import get_signal_buffer, BUFFERED_TYPES
+from .resume import get_resume_tokens, new_resume_token
+from .channel_routes import resolve_channels, route_cache
+from .ice import IceCandidateCoalescer, ICE_BATCH_FEATURE, is_end_of_candidates
+from .codecs import CodecError, negotiate_codec, frame_event
+from .call_tracing import CallSetupTracker, TRACED_OUTGOING_TYPES, get_call_setup_recorder
+from .call_sessions import (
+    get_call_sessions, ring_sweep_due, ANSWER_STATES, REQUEST_BUSY, REQUEST_DUPLICATE, REQUEST_GLARE,
+    STATE_ACCEPTED,
+)
+from . import metrics
+from .metrics import timed, timer, DB_SECONDS, HANDLER_SECONDS
 
 logger = logging.getLogger(__name__)
 
-# --- Global Redis Connection Pool for Production ---
-# This is created once when the Daphne worker process starts.
-redis_pool = None
-if not settings.DEBUG:
-    try:
-        # from_url is a synchronous method that creates a pool.
-        redis_pool = redis.ConnectionPool.from_url(
-            settings.REDIS_URL,
-            max_connections=20,
-            decode_responses=True # This is important for getting strings back
-        )
-        logger.info("Successfully created Redis connection pool.")
-    except Exception as e:
-        # If this fails, the app will still run, but Redis features will be disabled.
-        # The error will be in the logs.
-        logger.exception(f"CRITICAL: Failed to create Redis connection pool: {e}")
-        redis_pool = None
-
-# ローカル開発用（DEBUG=True）のインメモリオンラインユーザー管理
-local_online_users = set()
-
 class SignalingConsumer(AsyncWebsocketConsumer):
-    ONLINE_USERS_REDIS_KEY = "online_users_set"
     async def connect(self):
         self.user_uuid = None
-        self.broadcast_group_name = "signaling_broadcast"
+        self.broadcast_group_name = BROADCAST_GROUP_NAME
+        self.presence_subscriptions = set()
+        self.presence_renewed_at = 0.0
         self.redis_conn = None
+        self.presence_registry = get_presence_registry()
+        self.client_features = set()
+        self.ice_coalescer = None
+        self.call_tracker = None
+        self.call_sessions = get_call_sessions()
+        self.ring_timers = set()
+        self.signal_buffer = get_signal_buffer()
+        self.resume_tokens = get_resume_tokens()
+        self.resume_token = None
+        self.offline_tasks = set()
+        if settings.SIGNALING_ICE_COALESCE_MS > 0:
+            self.ice_coalescer = IceCandidateCoalescer(
+                window=settings.SIGNALING_ICE_COALESCE_MS / 1000,
+                max_batch=settings.SIGNALING_ICE_COALESCE_MAX_BATCH,
+                flush_callback=self.forward_ice_candidates
+            )
 
         # In production, get a connection from the pool.
         if not settings.DEBUG:
-            if redis_pool:
-                # Creating the client from the pool is synchronous.
-                self.redis_conn = redis.Redis(connection_pool=redis_pool)
+            self.redis_conn = get_redis_connection()
+            if self.redis_conn:
                 logger.info("Acquired Redis connection from pool.")
             else:
                 # Log an error if the pool wasn't created.
@@ -51,51 +66,119 @@ class SignalingConsumer(AsyncWebsocketConsumer):
         # The original code had a bug here: `await redis.from_url(...)` which raises a TypeError.
         # By moving connection logic out, we avoid the crash. The original code also closed
         # the connection if Redis failed. Now, we accept the connection regardless of Redis status.
-        await self.accept()
+        # クライアントがmsgpackのサブプロトコルを要求していればバイナリフレームで通信する
+        self.codec = negotiate_codec(self.scope.get('subprotocols'))
+        await self.accept(subprotocol=self.codec.subprotocol)
+        metrics.SIGNALING_CONNECTIONS.inc()
+        self.counted_connection = True
         logger.info(f"WebSocket connection accepted from {self.channel_name}")
 
     async def disconnect(self, close_code):
         logger.info(f"WebSocket connection closed for {self.channel_name} (UUID: {self.user_uuid}), code: {close_code}")
+        if getattr(self, 'counted_connection', False):
+            self.counted_connection = False
+            metrics.SIGNALING_CONNECTIONS.dec()
+            if self.user_uuid:
+                metrics.SIGNALING_REGISTERED_CONNECTIONS.dec()
+        if self.call_tracker:
+            self.call_tracker.close()
+        # 閉じた接続からは call-timeout を送れないので、呼び出しのタイマーは止める。
+        # 期限を過ぎた呼び出しは、生きている接続の heartbeat や call-request で動く掃除がタイムアウトさせる。
+        for task in list(self.ring_timers):
+            task.cancel()
         if self.user_uuid:
-            await self.channel_layer.group_discard(self.broadcast_group_name, self.channel_name)
-            await self.remove_online_user_from_redis(self.user_uuid)
+            if self.ice_coalescer:
+                await self.ice_coalescer.flush_all()
+            if use_broadcast_presence():
+                await self.channel_layer.group_discard(self.broadcast_group_name, self.channel_name)
+            await self.unsubscribe_presence(self.presence_subscriptions)
+            remaining = await self.release_presence_lease()
             await self.channel_layer.group_discard(f"user_{self.user_uuid}", self.channel_name)
-            
-            await self.broadcast({
-                'type': 'user_left',
-                'uuid': self.user_uuid
-            }, exclude_self=True)
+
+            # 同じUUIDの別の接続（別タブ・別端末）が残っていればオフラインにしない
+            if remaining == 0:
+                if self.resume_tokens and self.resume_token:
+                    # すぐに再接続してくることが多いので、猶予の間は再開を待つ
+                    await self.resume_tokens.park(self.resume_token, self.user_uuid)
+                    task = asyncio.get_running_loop().create_task(self.went_offline_after_grace())
+                    self.offline_tasks.add(task)
+                    task.add_done_callback(self.offline_tasks.discard)
+                else:
+                    await self.went_offline()
 
         # With a connection pool, we don't need to manually close the connection.
         # The connection is returned to the pool when the client object is garbage collected.
         self.redis_conn = None
         logger.debug("Redis connection released to pool (on disconnect).")
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        start = time.perf_counter()
+        message_type = None
+        payload = None
         try:
-            message = json.loads(text_data)
+            message = self.codec.decode(text_data=text_data, bytes_data=bytes_data)
+            if not isinstance(message, dict):
+                logger.warning(f"Ignoring non-object frame from {self.channel_name}.")
+                return
             message_type = message.get('type')
             payload = message.get('payload', {})
             logger.debug(f"Received message type '{message_type}' from {self.channel_name} (UUID: {self.user_uuid})")
 
-            if message_type == 'register':
+            # 受信のたびに（一定間隔で）プレゼンスのリースを延長する
+            if self.user_uuid:
+                await self.renew_presence_lease()
+
+            if message_type == 'heartbeat':
+                # リース延長のためだけのメッセージ。上で処理済み。
+                # ついでに（プロセスごとに一定間隔で）期限を過ぎた呼び出しを掃除する
+                if self.user_uuid:
+                    await self.maybe_expire_rings()
+                return
+
+            elif message_type == 'register':
                 uuid_from_payload = payload.get('uuid')
                 if uuid_from_payload:
                     await self.handle_register(payload)
                 else:
                     logger.warning("Registration message received without UUID.")
 
+            elif message_type == 'presence-subscribe' and self.user_uuid:
+                # 登録後に追加された友達のプレゼンスを購読する
+                await self.subscribe_presence(payload.get('friends', []))
+
             elif message_type == 'call-request':
                 # call-requestを特別に処理
                 await self.handle_call_request(payload)
 
+            elif message_type == 'call-ended' and self.user_uuid:
+                # 通話が終わったことをサーバーに知らせるだけのメッセージ（相手には転送しない）
+                target_uuid = payload.get('target')
+                if target_uuid and self.call_sessions:
+                    await self.end_call_session(self.user_uuid, target_uuid)
+
             elif self.user_uuid:
                 # その他のメッセージはそのまま転送
                 target_uuid = payload.get('target')
                 if not target_uuid:
                     logger.warning(f"Received message type '{message_type}' without target from {self.user_uuid}. Ignoring.")
                     return
-                
+
+                if message_type == 'ice-candidate' and is_end_of_candidates(payload) and not self.ice_coalescer:
+                    # 終了マーカーは相手には不要なので転送しない
+                    return
+
+                if self.ice_coalescer:
+                    if message_type == 'ice-candidate':
+                        # 短い時間窓でまとめてから転送する
+                        await self.ice_coalescer.add(target_uuid, payload)
+                        return
+                    # 他のメッセージが溜まっている候補を追い越さないよう、先に送る
+                    await self.ice_coalescer.flush(target_uuid)
+
+                if message_type in ANSWER_STATES and self.call_sessions:
+                    # 着信側の応答で呼び出し中のセッションを遷移させる（応答そのものは転送する）
+                    await self.call_sessions.answer(target_uuid, self.user_uuid, ANSWER_STATES[message_type])
+
                 # ユーザー固有のグループにメッセージを転送する
                 await self.forward_message_to_target(target_uuid, message_type, payload)
                 # 注: 相手がオフラインでもエラーにはならない。メッセージが破棄されるだけ。
@@ -103,13 +186,21 @@ class SignalingConsumer(AsyncWebsocketConsumer):
             else:
                  logger.warning(f"Received message type '{message_type}' from unregistered channel {self.channel_name}. Ignoring.")
 
-        except json.JSONDecodeError:
-            logger.error(f"Could not decode JSON from {self.channel_name}: {text_data}")
+        except CodecError:
+            metrics.DECODE_ERRORS.inc()
+            logger.error(f"Could not decode frame from {self.channel_name}: {text_data if text_data is not None else bytes_data[:64]!r}")
         except Exception as e:
+            metrics.HANDLER_ERRORS.inc()
             logger.exception(f"Error processing message from {self.channel_name}: {e}")
             import traceback
             traceback.print_exc()
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe_message(message_type, elapsed)
+            if self.call_tracker and message_type in TRACED_OUTGOING_TYPES and isinstance(payload, dict):
+                self.call_tracker.outgoing(message_type, payload, elapsed)
 
+    @timed(HANDLER_SECONDS, 'register')
     async def handle_register(self, payload):
         """ユーザー登録と通知の送信を処理"""
         user_uuid = payload.get('uuid')
@@ -119,98 +210,254 @@ class SignalingConsumer(AsyncWebsocketConsumer):
                 await self.close(code=4000)
                 return
 
+            # 直前の接続の再開トークンが有効なら、受信箱やプレゼンスの通知を省く
+            resume_token = payload.get('resume_token')
+            resumed = bool(
+                self.resume_tokens and isinstance(resume_token, str)
+                and await self.resume_tokens.claim(resume_token, user_uuid)
+            )
+            (metrics.REGISTER_RESUMED if resumed else metrics.REGISTER_FULL).inc()
+
+            if self.user_uuid is None and getattr(self, 'counted_connection', False):
+                metrics.SIGNALING_REGISTERED_CONNECTIONS.inc()
             self.user_uuid = user_uuid
+            features = payload.get('features')
+            self.client_features = set(features) if isinstance(features, list) else set()
+            if settings.CALL_TRACE_ENABLED:
+                if self.call_tracker:
+                    self.call_tracker.close()
+                self.call_tracker = CallSetupTracker(
+                    self.user_uuid,
+                    get_call_setup_recorder(),
+                    ice_idle=settings.CALL_TRACE_ICE_IDLE_SECONDS,
+                    timeout=settings.CALL_TRACE_TIMEOUT_SECONDS
+                )
 
-            # ユーザー固有のグループと、全体通知用のグループに参加
+            # ユーザー固有のグループに参加し、友達のプレゼンスを購読する
+            # (legacyモードでは全体通知用のグループに参加する)
             await self.channel_layer.group_add(f"user_{self.user_uuid}", self.channel_name)
-            await self.channel_layer.group_add(self.broadcast_group_name, self.channel_name)
-            # Redisにオンラインユーザーとして追加
-            await self.add_online_user_to_redis(self.user_uuid)
-
-            logger.info(f"Registered user {self.user_uuid} and added to groups.")
-
-            # 未配信の通知を取得
-            notifications = await self.get_undelivered_notifications(self.user_uuid)
-
-            # 未読メールの通知を取得
-            unread_mails = await self.get_unread_mails(self.user_uuid)
-            for mail in unread_mails:
-                notifications.append({
-                    'type': 'new_mail_notification',
-                    'mail_id': str(mail.id),
-                    'sender': mail.sender,
-                    'timestamp': mail.timestamp.isoformat()
-                })
+            if use_broadcast_presence():
+                await self.channel_layer.group_add(self.broadcast_group_name, self.channel_name)
+            else:
+                await self.subscribe_presence(payload.get('friends', []))
+            # この接続のプレゼンスのリースを取得
+            lease_count = await self.acquire_presence_lease()
+
+            logger.info(f"Registered user {self.user_uuid} and added to groups{' (resumed)' if resumed else ''}.")
 
-            # 登録完了メッセージを送信（通知も含む）
-            await self.send(text_data=json.dumps({
+            # 未配信の通知（配信済みにclaimされる）と未読メールを取得（何もなければDBは読まない）
+            # 再開時も、切断している間に届いた通知があれば未処理フラグが立っているので配る
+            notifications = await self.get_pending_inbox()
+
+            # 登録完了メッセージを送信（通知と、次に再接続するときの再開トークンも含む）
+            registered_payload = {
+                "uuid": self.user_uuid,
+                "notifications": notifications  # 通知データをペイロードに追加
+            }
+            if self.resume_tokens:
+                self.resume_token = new_resume_token()
+                registered_payload["resume_token"] = self.resume_token
+            await self.send_message({
                 "type": "registered",
-                "payload": {
-                    "uuid": self.user_uuid,
-                    "notifications": notifications  # 通知データをペイロードに追加
-                }
-            }))
-
-            # 配信済みにマーク
-            if notifications:
-                await self.mark_notifications_as_delivered(self.user_uuid)
-
-            # 他のユーザーに 'user_joined' をブロードキャスト
-            await self.broadcast({
-                'type': 'user_joined',
-                'uuid': self.user_uuid
-            }, exclude_self=True)
+                "payload": registered_payload
+            })
+
+            # 切断している間に届かなかったシグナリングを順番通りに送り直す
+            await self.replay_buffered_signals()
+
+            if resumed:
+                # 友達から見るとオフラインになっていない（user_left は猶予中で配信されていない）
+                return
+
+            # 購読している友達（legacyモードでは全員）に 'user_joined' を通知
+            await self.publish_presence('user_joined')
 
         # --- オフラインの友達に自分がオンラインになったことをPush通知で知らせる ---
         # 注: この機能は、クライアントが自分の友達リストをサーバーに送ることで実現できます。
         #     今回はクライアント側の改修を最小限にするため、コメントアウトしています。
         #     この機能を有効にするには、app.jsのregisterメッセージに友達リストを含める改修が必要です。
-            friends_list = payload.get('friends', [])
-            await self.notify_offline_friends_of_my_online_status(self.user_uuid, friends_list)
+            # 既に別の接続でオンラインなら友達には通知済み
+            if lease_count <= 1:
+                friends_list = payload.get('friends', [])
+                await self.notify_offline_friends_of_my_online_status(self.user_uuid, friends_list)
+
+            # ついでに期限切れのリースと呼び出しを掃除する（プロセスごとに一定間隔）
+            await maybe_sweep_presence(self.channel_layer)
+            await self.maybe_expire_rings()
         except Exception as e:
             logger.exception(f"Error during registration for user {user_uuid}: {e}")
             await self.close(code=4001) # Use a custom error code
 
 
-    async def handle_call_request(self, payload):
-        """着信リクエストを処理し、オフラインならDBに保存"""
-        target_uuid = payload.get('target')
-        sender_uuid = payload.get('uuid')
-
-        if not target_uuid or not sender_uuid:
-            return
-
-        # RedisなどのChannel Layerに問い合わせて、相手のグループが存在するか（オンラインか）を間接的に確認
-        # ここでは簡略化のため、常に転送を試みる。相手がオフラインならメッセージは破棄される。
-        # より確実なオンラインチェックが必要な場合は、別途オンライン状態をRedisに保存するなどの仕組みが必要。
-        # is_onlineがTrueの場合でも、相手がグループにいない（オフライン）可能性がある
-        # group_sendは失敗しないので、まず転送を試みる
-        await self.forward_message_to_target(target_uuid, 'call-request', payload)
-
-        is_online = await self.is_user_online(target_uuid) # 転送を試みた後でオンライン状態を再チェック
-        if not is_online:
-            # 相手がオンラインなら、そのまま転送
-            # 相手がオフラインなら、DBに通知を保存
-            await self.create_missed_call_notification(recipient_uuid=target_uuid, sender_uuid=sender_uuid)
-            # さらに、Push通知を送信
-            await self.send_push_notification_to_user(
-                recipient_uuid=target_uuid,
-                payload={"title": "Missed Call", "body": f"You have a missed call from {sender_uuid[:6]}"}
-            )
-            logger.info(f"User {target_uuid[:8]} is offline. Saved missed call notification from {sender_uuid[:8]}.")
-
+    @timed(HANDLER_SECONDS, 'call_request')
+    async def handle_call_request(self, payload):
+        """
+        着信リクエストを処理する。呼び出し中の重複は無視し、相手が通話中ならサーバーが call-busy を返す。
+        相手からの呼び出しが鳴っている間の呼び出し（同時発信）は、相手の呼び出しへの応答として扱う。
+        """
+        start = time.perf_counter()
+        target_uuid = payload.get('target')
+        sender_uuid = payload.get('uuid')
+
+        if not target_uuid or not sender_uuid or target_uuid == sender_uuid:
+            return
+
+        if self.call_sessions:
+            result = await self.call_sessions.request(sender_uuid, target_uuid)
+            if result == REQUEST_GLARE:
+                if await self.call_sessions.answer(target_uuid, sender_uuid, STATE_ACCEPTED):
+                    # 相手の発信側は call-accepted を受けて、いつも通りオファーを送ってくる
+                    await self.forward_message_to_target(target_uuid, 'call-accepted', {'target': target_uuid})
+                    if self.call_tracker:
+                        self.call_tracker.outgoing('call-request', payload, time.perf_counter() - start)
+                    logger.info(f"Calls between {sender_uuid[:8]} and {target_uuid[:8]} crossed. Joined them.")
+                    return
+                # 応答する前に相手の呼び出しが終わった。こちらからの呼び出しとしてやり直す
+                result = await self.call_sessions.request(sender_uuid, target_uuid)
+            if result == REQUEST_DUPLICATE:
+                # クライアントの再送。転送も不在着信の記録もしない。
+                logger.debug(f"Ignoring repeated call-request from {sender_uuid[:8]} to {target_uuid[:8]}.")
+                return
+            if result in (REQUEST_BUSY, REQUEST_GLARE):
+                # 相手の端末は鳴らさず、相手の代わりに call-busy を返す
+                if self.call_tracker:
+                    self.call_tracker.outgoing('call-request', payload, time.perf_counter() - start)
+                    self.call_tracker.incoming('call-busy', target_uuid)
+                await self.send_message({'type': 'call-busy', 'payload': {'target': sender_uuid}, 'from': target_uuid})
+                logger.info(f"User {target_uuid[:8]} is in another call. Answered busy to {sender_uuid[:8]}.")
+                return
+
+        if not await self.is_user_online(target_uuid):
+            # 鳴らせる端末がないので、その場でタイムアウトさせる
+            if self.call_tracker:
+                self.call_tracker.outgoing('call-request', payload, time.perf_counter() - start)
+            if self.call_sessions is None or await self.call_sessions.time_out(sender_uuid, target_uuid):
+                await self.finish_timed_out_call(sender_uuid, target_uuid)
+                logger.info(f"User {target_uuid[:8]} is offline. Saved missed call notification from {sender_uuid[:8]}.")
+            return
+
+        await self.forward_message_to_target(target_uuid, 'call-request', payload)
+        if self.call_tracker:
+            self.call_tracker.outgoing('call-request', payload, time.perf_counter() - start)
+        if self.call_sessions:
+            task = asyncio.get_running_loop().create_task(self.ring_timeout(sender_uuid, target_uuid))
+            self.ring_timers.add(task)
+            task.add_done_callback(self.ring_timers.discard)
+            await self.maybe_expire_rings()
+
+    async def went_offline(self):
+        """最後の接続が切れたユーザーの通話を終わらせ、購読者に 'user_left' を配信する"""
+        await self.end_call_sessions()
+        await self.publish_presence('user_left')
+
+    async def went_offline_after_grace(self):
+        """RESUME_GRACE_SECONDS 待ってもどの接続も戻らなければオフラインとして扱う"""
+        await asyncio.sleep(settings.RESUME_GRACE_SECONDS)
+        try:
+            if await self.is_user_online(self.user_uuid):
+                return
+            await self.went_offline()
+        except Exception as e:
+            logger.exception(f"Error publishing user_left for {self.user_uuid[:8]}: {e}")
+
+    async def ring_timeout(self, caller_uuid, callee_uuid):
+        """CALL_RING_TIMEOUT_SECONDS 経っても応答がなければ不在着信にする"""
+        await asyncio.sleep(settings.CALL_RING_TIMEOUT_SECONDS)
+        try:
+            if await self.call_sessions.time_out(caller_uuid, callee_uuid):
+                await self.finish_timed_out_call(caller_uuid, callee_uuid)
+                logger.info(f"Call from {caller_uuid[:8]} to {callee_uuid[:8]} timed out.")
+        except Exception as e:
+            logger.exception(f"Error timing out call from {caller_uuid[:8]} to {callee_uuid[:8]}: {e}")
+
+    async def maybe_expire_rings(self):
+        """担当のワーカーが落ちて期限を過ぎた呼び出しを（プロセスごとに一定間隔で）タイムアウトさせる"""
+        if not self.call_sessions or not ring_sweep_due():
+            return
+        expired = await self.call_sessions.expired_rings()
+        for caller_uuid, callee_uuid in expired:
+            if await self.call_sessions.time_out(caller_uuid, callee_uuid):
+                await self.finish_timed_out_call(caller_uuid, callee_uuid)
+        if expired:
+            logger.info(f"Ring sweeper expired {len(expired)} stale call(s).")
+
+    async def finish_timed_out_call(self, caller_uuid, callee_uuid):
+        """
+        timed-out への遷移に成功した呼び出し元だけが呼ぶ。不在着信を1件記録してPush通知し、
+        両者の端末に call-timeout を送る（発信側は呼び出しを止め、着信側は着信画面を閉じる）。
+        """
+        await self.create_missed_call_notification(recipient_uuid=callee_uuid, sender_uuid=caller_uuid)
+        await self.mark_inbox_dirty([callee_uuid])
+        await self.send_push_notification_to_user(
+            recipient_uuid=callee_uuid,
+            payload={"title": "Missed Call", "body": f"You have a missed call from {caller_uuid[:6]}"}
+        )
+        await self.forward_message_to_target(caller_uuid, 'call-timeout', {'target': caller_uuid}, sender_uuid=callee_uuid)
+        await self.forward_message_to_target(callee_uuid, 'call-timeout', {'target': callee_uuid}, sender_uuid=caller_uuid)
+
+    async def end_call_session(self, user_uuid, peer_uuid):
+        """user_uuid と peer_uuid の間のセッションを（どちらが発信したかに関わらず）終了する"""
+        if await self.call_sessions.end(user_uuid, peer_uuid) is None:
+            await self.call_sessions.end(peer_uuid, user_uuid)
+
+    async def end_call_sessions(self):
+        """最後の接続が切れたときに呼ぶ。呼び出し中なら不在着信にし、通話中なら終了する。"""
+        if not self.call_sessions:
+            return
+        session = await self.call_sessions.active_session(self.user_uuid)
+        if session is None:
+            return
+        caller_uuid, callee_uuid = session
+        if await self.call_sessions.time_out(caller_uuid, callee_uuid):
+            await self.finish_timed_out_call(caller_uuid, callee_uuid)
+        else:
+            await self.call_sessions.end(caller_uuid, callee_uuid)
+
     async def broadcast(self, message, exclude_self=True):
         logger.debug(f"Broadcasting message: {message}")
         # 全体通知用グループに送信
         await self.channel_layer.group_send(
             self.broadcast_group_name,
-            {
-                'type': 'signal_message',
-                'message': message,
-                'sender_channel': self.channel_name if exclude_self else None
-            }
+            frame_event(message, sender_channel=self.channel_name if exclude_self else None)
         )
 
+    async def publish_presence(self, event_type):
+        """自分の 'user_joined' / 'user_left' を購読者に配信する"""
+        await publish_presence_event(self.channel_layer, self.user_uuid, event_type, sender_channel=self.channel_name)
+
+    async def subscribe_presence(self, friends_list):
+        """友達ごとのプレゼンスグループに参加する"""
+        friend_uuids = clean_friend_uuids(friends_list, self.user_uuid)
+        new_uuids = [uuid for uuid in friend_uuids if uuid not in self.presence_subscriptions]
+        room = settings.PRESENCE_MAX_SUBSCRIPTIONS - len(self.presence_subscriptions)
+        if len(new_uuids) > room:
+            logger.warning(f"User {self.user_uuid[:8]} exceeded presence subscription limit. Ignoring {len(new_uuids) - room} friend(s).")
+            new_uuids = new_uuids[:max(room, 0)]
+        if not new_uuids:
+            return
+        # 失敗した group_add があっても他は待ち、成功したものだけを記録する（切断時に抜けるのはそれだけ）
+        results = await asyncio.gather(*[
+            self.channel_layer.group_add(presence_group_name(uuid), self.channel_name)
+            for uuid in new_uuids
+        ], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        subscribed = [uuid for uuid, result in zip(new_uuids, results) if not isinstance(result, BaseException)]
+        self.presence_subscriptions.update(subscribed)
+        if errors:
+            logger.warning(f"User {self.user_uuid[:8]} could not subscribe to {len(errors)} presence group(s): {errors[0]}")
+        logger.debug(f"User {self.user_uuid[:8]} subscribed to presence of {len(subscribed)} friend(s).")
+
+    async def unsubscribe_presence(self, friend_uuids):
+        """プレゼンスグループから抜ける"""
+        friend_uuids = list(friend_uuids)
+        if not friend_uuids:
+            return
+        await asyncio.gather(*[
+            self.channel_layer.group_discard(presence_group_name(uuid), self.channel_name)
+            for uuid in friend_uuids
+        ])
+        self.presence_subscriptions.difference_update(friend_uuids)
+
     # `signal_message`ハンドラを修正して、自分自身へのブロードキャストをスキップ
     async def signal_message(self, event):
         message = event['message']
@@ -218,63 +465,138 @@ class SignalingConsumer(AsyncWebsocketConsumer):
         if sender_channel and self.channel_name == sender_channel:
             return
         logger.debug(f"Sending signal message to {self.channel_name} (UUID: {self.user_uuid}): {message.get('type')}")
-        await self.send(text_data=json.dumps(message))
+        if self.call_tracker:
+            self.call_tracker.incoming(message.get('type'), message.get('from'), event.get('sent_at'))
+        if message.get('type') == 'ice-candidates' and ICE_BATCH_FEATURE not in self.client_features:
+            # まとめた形式を知らない古いクライアントには1件ずつ送る
+            payload = message.get('payload', {})
+            for candidate in payload.get('candidates', []):
+                await self.send_message({
+                    'type': 'ice-candidate',
+                    'payload': {'target': payload.get('target'), 'candidate': candidate},
+                    'from': message.get('from')
+                })
+            return
+        await self.send_message(message)
 
-    async def forward_message_to_target(self, target_uuid, message_type, payload):
-        """特定の宛先にメッセージを転送する"""
-        logger.debug(f"Forwarding message type '{message_type}' from {self.user_uuid} to target user {target_uuid}")
+    async def signal_frame(self, event):
+        """送信側でエンコード済みのフレームをそのままクライアントに送る"""
+        sender_channel = event.get('sender_channel')
+        if sender_channel and self.channel_name == sender_channel:
+            return
+        await self.send(**self.codec.frame(event))
+
+    async def replay_buffered_signals(self):
+        """バッファに溜まっていたメッセージを、転送されてきたときと同じ経路でクライアントに送る"""
+        if not self.signal_buffer:
+            return
+        messages = await self.signal_buffer.drain(self.user_uuid)
+        for message in messages:
+            await self.signal_message({'message': message})
+        if messages:
+            metrics.SIGNAL_BUFFER_REPLAYED.inc(len(messages))
+            logger.info(f"Replayed {len(messages)} buffered signaling message(s) to {self.user_uuid[:8]}.")
+
+    async def send_message(self, message):
+        """接続時に決めたコーデック（JSON / msgpack）でクライアントに送る"""
+        await self.send(**self.codec.encode(message))
+
+    async def forward_ice_candidates(self, target_uuid, candidates):
+        """まとめたICE候補を1つのメッセージとして転送する"""
+        if len(candidates) == 1:
+            await self.forward_message_to_target(
+                target_uuid, 'ice-candidate', {'target': target_uuid, 'candidate': candidates[0]}
+            )
+            return
+        await self.forward_message_to_target(
+            target_uuid, 'ice-candidates', {'target': target_uuid, 'candidates': candidates}
+        )
+
+    async def forward_message_to_target(self, target_uuid, message_type, payload, sender_uuid=None):
+        """特定の宛先にメッセージを転送する（sender_uuid はサーバーが相手の代わりに送るときに指定）"""
+        sender_uuid = sender_uuid or self.user_uuid
+        logger.debug(f"Forwarding message type '{message_type}' from {sender_uuid} to target user {target_uuid}")
         forward_message = {
             'type': message_type,
             'payload': payload,
-            'from': self.user_uuid  # 送信者情報を付与
+            'from': sender_uuid  # 送信者情報を付与
+        }
+        # 1人宛ての転送は辞書のまま送り、受信側が自分のコーデックで1回だけエンコードする
+        # （両方の形式を作り置く frame_event は受信者が多いときだけ。ICE候補のまとめは受信側で分け直すこともある）
+        event = {
+            'type': 'signal_message',
+            'message': forward_message
         }
+        if settings.CALL_TRACE_ENABLED:
+            event['sent_at'] = time.time()
+        # 相手の接続をリースから調べる（直接送信と、オフラインの相手へのバッファのため）
+        channel_names = None
+        if self.presence_registry and (settings.SIGNALING_DIRECT_ROUTING or self.signal_buffer):
+            channel_names = await resolve_channels(target_uuid, self.presence_registry)
+            if not channel_names and self.signal_buffer and message_type in BUFFERED_TYPES:
+                # 接続が1つもないので捨てずに溜めておき、相手が再接続したら送り直す
+                await self.signal_buffer.append(target_uuid, forward_message)
+                return
+        # 相手のチャネルが分かっていれば直接送る（グループのメンバー検索を省く）
+        if settings.SIGNALING_DIRECT_ROUTING:
+            if channel_names:
+                with timer(metrics.CHANNEL_SEND):
+                    results = await asyncio.gather(
+                        *[self.channel_layer.send(channel_name, event) for channel_name in channel_names],
+                        return_exceptions=True
+                    )
+                for channel_name, result in zip(channel_names, results):
+                    if isinstance(result, ChannelFull):
+                        logger.warning(f"Channel {channel_name} for user {target_uuid[:8]} is full. Dropping '{message_type}'.")
+                    elif isinstance(result, Exception):
+                        raise result
+                return
         # ユーザー固有のグループに送信
-        await self.channel_layer.group_send(
-            f"user_{target_uuid}",
-            {
-                'type': 'signal_message',
-                'message': forward_message
-            }
-        )
+        with timer(metrics.CHANNEL_GROUP_SEND):
+            await self.channel_layer.group_send(f"user_{target_uuid}", event)
 
     # --- データベース操作 (非同期) ---
 
     async def send_notification(self, event):
         """
         views.pyから呼び出され、リアルタイムで通知を送信するハンドラ
+        (現在のviews.pyは signal_frame を送る。デプロイ直後に残っている旧形式のイベント用)
         """
         notification_data = event["notification"]
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             "type": notification_data.get("type"),
             "payload": notification_data
-        }))
+        })
 
+    async def get_pending_inbox(self):
+        """Redisの未処理フラグが立っているとき（または不明なとき）だけDBから受信箱を読む"""
+        inbox_flags = get_inbox_flags()
+        if inbox_flags and not await inbox_flags.claim(self.user_uuid):
+            return []
+        try:
+            notifications = await self.get_inbox_snapshot(self.user_uuid)
+        except Exception:
+            if inbox_flags:
+                await inbox_flags.mark([self.user_uuid])
+            raise
+        # 未読メールは既読になるまで毎回返すので、残っていればフラグを立て直す
+        if inbox_flags and any(n['type'] == 'new_mail_notification' for n in notifications):
+            await inbox_flags.mark([self.user_uuid])
+        return notifications
+
+    @timed(DB_SECONDS, 'get_inbox_snapshot')
     @database_sync_to_async
-    def get_undelivered_notifications(self, recipient_uuid):
-        """未配信の通知を取得してシリアライズする"""
-        notifications = Notification.objects.filter(
-            recipient_uuid=recipient_uuid,
-            is_delivered=False
-        ).order_by('timestamp') # 古い順に取得
-        return [
-            {
-                "sender": notif.sender_uuid,
-                "timestamp": notif.timestamp.isoformat(),
-                "type": notif.notification_type
-            }
-            for notif in notifications
-        ]
+    def get_inbox_snapshot(self, user_uuid):
+        """未配信の通知と未読メールのヘッダーを1トランザクションで取得する"""
+        return claim_inbox_snapshot(user_uuid)
 
-    @database_sync_to_async
-    def get_unread_mails(self, user_uuid):
-        """ユーザー宛の未読メールをタイムスタンプ順で取得"""
-        return list(Mail.objects.filter(target=user_uuid, is_read=False).order_by('timestamp'))
-
-    @database_sync_to_async
-    def mark_notifications_as_delivered(self, recipient_uuid):
-        """通知を配信済みに更新する"""
-        Notification.objects.filter(recipient_uuid=recipient_uuid, is_delivered=False).update(is_delivered=True)
+    async def mark_inbox_dirty(self, user_uuids):
+        """DBに保存した後に、相手の受信箱の未処理フラグを立てる（DBのスレッドではなくイベントループから）"""
+        inbox_flags = get_inbox_flags()
+        if inbox_flags:
+            await inbox_flags.mark(user_uuids)
 
+    @timed(DB_SECONDS, 'create_missed_call_notification')
     @database_sync_to_async
     def create_missed_call_notification(self, recipient_uuid, sender_uuid):
         """不在着信の通知をDBに作成する"""
@@ -284,106 +606,94 @@ class SignalingConsumer(AsyncWebsocketConsumer):
             notification_type='missed_call'
         )
 
+    @timed(DB_SECONDS, 'create_friend_online_notifications')
     @database_sync_to_async
-    def create_friend_online_notification(self, recipient_uuid, sender_uuid):
-        """友達がオンラインになったことを通知するレコードをDBに作成する"""
-        Notification.objects.create(
-            recipient_uuid=recipient_uuid,
-            sender_uuid=sender_uuid,
-            notification_type='friend_online'
-        )
-
-    @database_sync_to_async
-    def get_subscriptions_for_user(self, user_uuid):
-        """指定されたユーザーのPush購読情報をDBから取得する"""
-        return list(PushSubscription.objects.filter(user_uuid=user_uuid))
+    def create_friend_online_notifications(self, recipient_uuids, sender_uuid):
+        """友達がオンラインになったことを通知するレコードをまとめてDBに作成する"""
+        Notification.objects.bulk_create([
+            Notification(
+                recipient_uuid=recipient_uuid,
+                sender_uuid=sender_uuid,
+                notification_type='friend_online'
+            )
+            for recipient_uuid in recipient_uuids
+        ])
 
     async def send_push_notification_to_user(self, recipient_uuid, payload):
-        """特定のユーザーにPush通知を送信する"""
-        try:
-            subscriptions = await self.get_subscriptions_for_user(recipient_uuid)
-            if not subscriptions:
-                logger.info(f"No push subscriptions found for user {recipient_uuid[:8]}.")
-                return
-
-            vapid_claims = {
-                "sub": "mailto:admin@example.com" # 適切なメールアドレスに変更してください
-            }
-
-            for sub in subscriptions:
-                subscription_info = {
-                    "endpoint": sub.endpoint,
-                    "keys": {"p256dh": sub.p256dh, "auth": sub.auth}
-                }
-                webpush(subscription_info, json.dumps(payload), vapid_private_key=settings.VAPID_PRIVATE_KEY, vapid_claims=vapid_claims)
-            
-            logger.info(f"Sent push notification to {len(subscriptions)} device(s) for user {recipient_uuid[:8]}.")
-
-        except WebPushException as ex:
-            logger.error(f"WebPushException for user {recipient_uuid[:8]}: {ex}")
-        except Exception as e:
-            logger.exception(f"An unexpected error occurred while sending push notification to {recipient_uuid[:8]}: {e}")
-
-    # --- Redisを使ったオンラインユーザー管理 ---
-
-    async def add_online_user_to_redis(self, user_uuid):
-        """ユーザーをオンラインリストにRedisに追加する"""
-        if settings.DEBUG:
-            local_online_users.add(user_uuid)
-            logger.debug(f"Added {user_uuid[:8]} to local online users set (InMemory).")
+        """特定のユーザーへのPush通知をキューに積む（送信完了は待たない）"""
+        if get_push_dispatcher().enqueue([recipient_uuid], payload):
+            logger.info(f"Queued push notification for user {recipient_uuid[:8]}.")
+
+    # --- リースによるオンラインユーザー管理 (signaling/presence.py) ---
+
+    async def acquire_presence_lease(self):
+        """この接続のリースを登録し、同じUUIDの有効な接続数を返す"""
+        if not self.presence_registry:
+            logger.warning("Cannot acquire presence lease: no presence registry.")
+            return 1
+        with timer(metrics.PRESENCE_ACQUIRE):
+            lease_count = await self.presence_registry.acquire(self.user_uuid, self.channel_name)
+        route_cache.invalidate(self.user_uuid)
+        self.presence_renewed_at = time.monotonic()
+        logger.debug(f"Acquired presence lease for {self.user_uuid[:8]} ({lease_count} connection(s)).")
+        return lease_count
+
+    async def renew_presence_lease(self):
+        """前回の延長から PRESENCE_HEARTBEAT_SECONDS 以上経っていればリースを延長する"""
+        if not self.presence_registry:
             return
-
-        if self.redis_conn:
-            await self.redis_conn.sadd(self.ONLINE_USERS_REDIS_KEY, user_uuid)
-            logger.debug(f"Added {user_uuid[:8]} to Redis online users set.")
-        else:
-            if not settings.DEBUG:
-                logger.warning("Cannot add online user to Redis: no connection.")
-
-    async def remove_online_user_from_redis(self, user_uuid):
-        """ユーザーをオンラインリストからRedisで削除する"""
-        if settings.DEBUG:
-            local_online_users.discard(user_uuid)
-            logger.debug(f"Removed {user_uuid[:8]} from local online users set (InMemory).")
+        if time.monotonic() - self.presence_renewed_at < settings.PRESENCE_HEARTBEAT_SECONDS:
             return
-
-        if self.redis_conn:
-            await self.redis_conn.srem(self.ONLINE_USERS_REDIS_KEY, user_uuid)
-            logger.debug(f"Removed {user_uuid[:8]} from Redis online users set.")
-        else:
-            if not settings.DEBUG:
-                logger.warning("Cannot remove online user from Redis: no connection.")
-
-    async def get_all_online_user_uuids(self):
-        """Redisから現在オンラインの全ユーザーのUUIDリストを取得する"""
-        if settings.DEBUG:
-            return local_online_users.copy()
-
-        if self.redis_conn:
-            # decode_responses=True in the pool means we get strings directly
-            return await self.redis_conn.smembers(self.ONLINE_USERS_REDIS_KEY)
-
-        logger.warning("Cannot get online users from Redis: no connection.")
+        with timer(metrics.PRESENCE_RENEW):
+            await self.presence_registry.renew(self.user_uuid, self.channel_name)
+        self.presence_renewed_at = time.monotonic()
+
+    async def release_presence_lease(self):
+        """この接続のリースを返却し、残っている接続数を返す"""
+        if not self.presence_registry:
+            logger.warning("Cannot release presence lease: no presence registry.")
+            return 0
+        with timer(metrics.PRESENCE_RELEASE):
+            remaining = await self.presence_registry.release(self.user_uuid, self.channel_name)
+        route_cache.invalidate(self.user_uuid)
+        logger.debug(f"Released presence lease for {self.user_uuid[:8]} ({remaining} connection(s) left).")
+        return remaining
+
+    async def filter_online_users(self, user_uuids):
+        """指定されたUUIDのうちオンラインのものだけを返す（1回の問い合わせで判定）"""
+        if self.presence_registry:
+            with timer(metrics.PRESENCE_FILTER_ONLINE):
+                return await self.presence_registry.filter_online(user_uuids)
+
+        logger.warning("Cannot check online users: no presence registry.")
         return set()
 
     async def is_user_online(self, user_uuid):
-        """Redisを使ってユーザーがオンラインかどうかをチェックする"""
-        if settings.DEBUG:
-            return user_uuid in local_online_users
-
-        if self.redis_conn:
-            return await self.redis_conn.sismember(self.ONLINE_USERS_REDIS_KEY, user_uuid)
+        """有効なリースがあるかどうかでユーザーがオンラインかをチェックする"""
+        if self.presence_registry:
+            with timer(metrics.PRESENCE_IS_ONLINE):
+                return await self.presence_registry.is_online(user_uuid)
 
-        logger.warning(f"Cannot check online status for {user_uuid[:8]} from Redis: no connection.")
+        logger.warning(f"Cannot check online status for {user_uuid[:8]}: no presence registry.")
         return False
 
     async def notify_offline_friends_of_my_online_status(self, my_uuid, friends_list):
         """自分がオンラインになったことをオフラインの友達に通知する"""
-        online_users = await self.get_all_online_user_uuids()
-        for friend_uuid in friends_list:
-            if friend_uuid not in online_users:
-                await self.create_friend_online_notification(recipient_uuid=friend_uuid, sender_uuid=my_uuid)
-                await self.send_push_notification_to_user(
-                    recipient_uuid=friend_uuid,
-                    payload={"title": "Friend Online", "body": f"User {my_uuid[:6]} is now online."}
-                )
+        # 重複と自分自身を除いた友達だけを対象にする
+        friend_uuids = clean_friend_uuids(friends_list, my_uuid)
+        if not friend_uuids:
+            return
+
+        online_users = await self.filter_online_users(friend_uuids)
+        offline_friends = [uuid for uuid in friend_uuids if uuid not in online_users]
+        if not offline_friends:
+            return
+
+        await self.create_friend_online_notifications(offline_friends, sender_uuid=my_uuid)
+        await self.mark_inbox_dirty(offline_friends)
+        # 購読情報の取得と送信はディスパッチャがまとめて並行に行う
+        get_push_dispatcher().enqueue(
+            offline_friends,
+            {"title": "Friend Online", "body": f"User {my_uuid[:6]} is now online."}
+        )
+        logger.info(f"Notified {len(offline_friends)} offline friend(s) that {my_uuid[:8]} is online.")
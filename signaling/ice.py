@@ -0,0 +1,59 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 受信側クライアントがまとめた形式を理解できることを示す register の features の値
+ICE_BATCH_FEATURE = "ice-batch"
+
+
+def is_end_of_candidates(payload):
+    """candidate が null の ice-candidate は候補収集の終了を表す"""
+    return payload.get('candidate') is None
+
+
+class IceCandidateCoalescer:
+    """
+    同じ送信者から同じ相手への ice-candidate を短い時間窓でまとめる。
+    窓の終わり・終了マーカー・上限件数のいずれかで flush_callback(target, candidates) を呼ぶ。
+    """
+
+    def __init__(self, window, max_batch, flush_callback):
+        self.window = window
+        self.max_batch = max_batch
+        self.flush_callback = flush_callback
+        self.batches = {}  # target_uuid -> list of candidate
+        self.timers = {}  # target_uuid -> asyncio.Task
+
+    async def add(self, target_uuid, payload):
+        if is_end_of_candidates(payload):
+            await self.flush(target_uuid)
+            return
+        batch = self.batches.setdefault(target_uuid, [])
+        batch.append(payload.get('candidate'))
+        if len(batch) >= self.max_batch:
+            await self.flush(target_uuid)
+        elif target_uuid not in self.timers:
+            self.timers[target_uuid] = asyncio.create_task(self._flush_later(target_uuid))
+
+    async def _flush_later(self, target_uuid):
+        await asyncio.sleep(self.window)
+        # 自分自身をキャンセルしないよう、先にタイマーを外してから送る
+        self.timers.pop(target_uuid, None)
+        try:
+            await self.flush(target_uuid)
+        except Exception as e:
+            logger.exception(f"Failed to flush ICE candidates for {target_uuid[:8]}: {e}")
+
+    async def flush(self, target_uuid):
+        """target_uuid宛ての溜まっている候補をすぐに送る"""
+        timer = self.timers.pop(target_uuid, None)
+        if timer is not None:
+            timer.cancel()
+        candidates = self.batches.pop(target_uuid, None)
+        if candidates:
+            await self.flush_callback(target_uuid, candidates)
+
+    async def flush_all(self):
+        for target_uuid in list(self.batches):
+            await self.flush(target_uuid)
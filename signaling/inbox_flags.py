@@ -0,0 +1,104 @@
+import logging
+from .redis_pool import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# --- 受信箱の未処理フラグ ---
+#
+# inbox:dirty  SET  未配信の通知か未読メールがあるかもしれないユーザーのUUID。
+#                   READY_MEMBER は reconcile_inbox_flags（定期メンテナンスでも実行）が入れる印で、
+#                   これがない間（Redisのフラッシュ後、キーの追い出し後、フラグを立てられなかった後）は
+#                   全員を「未処理あり」とみなしてDBを読む。印をセットの中に置くので、セットだけが消えて
+#                   印が残ることはない。
+#
+# 書き込み側は「DBに保存してからフラグを立てる」、register側は「フラグを落としてからDBを読む」。
+# この順序なら並行して届いた通知がフラグごと失われることはない（余分に立っているのは無害）。
+
+DIRTY_KEY = "inbox:dirty"
+# UUIDとは重ならない値
+READY_MEMBER = "!ready"
+
+# KEYS[1]=dirty key / ARGV: ready member, uuid
+CLAIM_SCRIPT = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+    return 1
+end
+return redis.call('SREM', KEYS[1], ARGV[2])
+"""
+
+
+class RedisInboxFlags:
+    """Redisのセットで受信箱の未処理フラグを管理する"""
+
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+        self._claim = redis_conn.register_script(CLAIM_SCRIPT)
+
+    async def mark(self, user_uuids):
+        """通知やメールをDBに保存した後に呼び、フラグを立てる"""
+        if not user_uuids:
+            return
+        try:
+            await self.redis_conn.sadd(DIRTY_KEY, *user_uuids)
+        except Exception as e:
+            logger.warning(f"Could not mark inbox dirty for {len(user_uuids)} user(s): {e}")
+            await self.invalidate()
+
+    async def invalidate(self):
+        """フラグを立てられなかったときに印を外し、次の reconcile まで全員がDBを読むようにする"""
+        try:
+            await self.redis_conn.srem(DIRTY_KEY, READY_MEMBER)
+        except Exception as e:
+            logger.error(
+                f"Could not invalidate inbox flags; registers may skip pending items until the next reconcile: {e}"
+            )
+
+    async def claim(self, user_uuid):
+        """
+        フラグを落とし、DBを読む必要があるかを返す。
+        フラグが立っていた・フラグが信用できない・Redisに届かない場合はTrue。
+        """
+        try:
+            return bool(await self._claim(keys=[DIRTY_KEY], args=[READY_MEMBER, user_uuid]))
+        except Exception as e:
+            logger.warning(f"Could not check inbox flag for {user_uuid}, reading the database: {e}")
+            return True
+
+
+redis_inbox_flags = None
+
+
+def get_inbox_flags():
+    """Redisの未処理フラグを返す。Redisが使えない（ローカル開発など）場合はNoneで、毎回DBを読む。"""
+    global redis_inbox_flags
+    if redis_inbox_flags is None:
+        redis_conn = get_redis_connection()
+        if redis_conn is None:
+            return None
+        redis_inbox_flags = RedisInboxFlags(redis_conn)
+    return redis_inbox_flags
+
+
+def rebuild_inbox_flags(redis_conn, user_uuids, batch_size=1000):
+    """
+    DBから集めたUUIDでフラグを作り直し、READY_MEMBER を入れる。フラグを立てたユーザー数を返す。
+    既存のフラグには和集合で足すので、作り直している間に立ったフラグも消えない。
+    """
+    tmp_key = f"{DIRTY_KEY}:rebuild"
+    redis_conn.delete(tmp_key)
+    count = 0
+    batch = []
+    for user_uuid in user_uuids:
+        batch.append(user_uuid)
+        if len(batch) >= batch_size:
+            count += redis_conn.sadd(tmp_key, *batch)
+            batch = []
+    if batch:
+        count += redis_conn.sadd(tmp_key, *batch)
+
+    pipe = redis_conn.pipeline(transaction=True)
+    pipe.sunionstore(DIRTY_KEY, [DIRTY_KEY, tmp_key])
+    pipe.delete(tmp_key)
+    pipe.sadd(DIRTY_KEY, READY_MEMBER)
+    pipe.execute()
+    return count
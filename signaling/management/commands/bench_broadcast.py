@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+from channels_redis.core import RedisChannelLayer
+from django.core.management.base import BaseCommand
+
+from signaling.codecs import JSON_CODEC, MSGPACK_CODEC, frame_event
+from signaling.consumers import SignalingConsumer
+
+
+async def discard(message):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Measures CPU time per broadcast with per-receiver encoding and with serialize-once frames'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscribers', type=int, default=5000)
+        parser.add_argument('--workers', type=int, default=4, help='Daphne processes the subscribers are spread over')
+        parser.add_argument('--msgpack-ratio', type=float, default=0.0, help='Share of subscribers using the msgpack subprotocol')
+        parser.add_argument('--broadcasts', type=int, default=20)
+
+    def handle(self, *args, **options):
+        # 接続はしない。シリアライザを使うためだけに作る。
+        layer = RedisChannelLayer(hosts=["redis://localhost:6379/0"])
+        consumers = []
+        msgpack_count = int(options['subscribers'] * options['msgpack_ratio'])
+        for i in range(options['subscribers']):
+            consumer = SignalingConsumer()
+            consumer.channel_name = f"specific.worker{i % options['workers']}!{i:08d}"
+            consumer.user_uuid = f"user-{i:08d}"
+            consumer.client_features = set()
+            consumer.call_tracker = None
+            consumer.codec = MSGPACK_CODEC if i < msgpack_count else JSON_CODEC
+            consumer.base_send = discard
+            consumers.append(consumer)
+
+        message = {'type': 'user_joined', 'uuid': 'a1b2c3d4-e5f6-4789-8abc-def012345678'}
+
+        def legacy_event():
+            return {'type': 'signal_message', 'message': message, 'sender_channel': 'specific.sender!x'}
+
+        def framed_event():
+            return frame_event(message, sender_channel='specific.sender!x')
+
+        for name, make_event, handler in (
+            ("per-receiver json.dumps", legacy_event, SignalingConsumer.signal_message),
+            ("serialize-once frame", framed_event, SignalingConsumer.signal_frame),
+        ):
+            cpu = asyncio.run(self._run(layer, consumers, make_event, handler, options))
+            self.stdout.write(f"{name:24s} cpu={cpu * 1000:8.2f}ms/broadcast ({cpu / len(consumers) * 1e6:.2f}us/subscriber)")
+
+    async def _run(self, layer, consumers, make_event, handler, options):
+        start = time.process_time()
+        for _ in range(options['broadcasts']):
+            event = make_event()
+            # channels_redis はワーカー(プロセス)ごとに1回シリアライズ・デシリアライズする
+            for _ in range(options['workers']):
+                event = layer.deserialize(layer.serialize(event))
+            for consumer in consumers:
+                await handler(consumer, event)
+        return (time.process_time() - start) / options['broadcasts']
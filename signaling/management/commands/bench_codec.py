@@ -0,0 +1,140 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from signaling.codecs import JSON_CODEC, MSGPACK_CODEC
+
+# Chromeが生成する音声+映像+データチャネルのofferに近いSDP
+SDP_OFFER = "\r\n".join([
+    "v=0",
+    "o=- 4611731400430051336 2 IN IP4 127.0.0.1",
+    "s=-",
+    "t=0 0",
+    "a=group:BUNDLE 0 1 2",
+    "a=extmap-allow-mixed",
+    "a=msid-semantic: WMS 7b5f4e0e-3c1d-4f8e-9a55-2d8c7b1f0a11",
+    "m=audio 9 UDP/TLS/RTP/SAVPF 111 63 9 0 8 13 110 126",
+    "c=IN IP4 0.0.0.0",
+    "a=rtcp:9 IN IP4 0.0.0.0",
+    "a=ice-ufrag:Xk2P",
+    "a=ice-pwd:Q8v1w0dFvPjz3gYgH1n3Kc5c",
+    "a=ice-options:trickle",
+    "a=fingerprint:sha-256 3C:4A:9E:2B:7F:11:D0:56:8A:EE:41:90:2C:6B:FA:73:1D:05:B8:CC:62:94:E7:3A:0F:58:D2:19:AB:46:C3:8E",
+    "a=setup:actpass",
+    "a=mid:0",
+    "a=extmap:1 urn:ietf:params:rtp-hdrext:ssrc-audio-level",
+    "a=extmap:2 http://www.webrtc.org/experiments/rtp-hdrext/abs-send-time",
+    "a=extmap:3 http://www.ietf.org/id/draft-holmer-rmcat-transport-wide-cc-extensions-01",
+    "a=extmap:4 urn:ietf:params:rtp-hdrext:sdes:mid",
+    "a=sendrecv",
+    "a=msid:7b5f4e0e-3c1d-4f8e-9a55-2d8c7b1f0a11 1f0c9a5e-8d2b-4c71-b6e3-5a9d0e7f2c44",
+    "a=rtcp-mux",
+    "a=rtpmap:111 opus/48000/2",
+    "a=rtcp-fb:111 transport-cc",
+    "a=fmtp:111 minptime=10;useinbandfec=1",
+    "a=rtpmap:63 red/48000/2",
+    "a=fmtp:63 111/111",
+    "a=rtpmap:9 G722/8000",
+    "a=rtpmap:0 PCMU/8000",
+    "a=rtpmap:8 PCMA/8000",
+    "a=rtpmap:13 CN/8000",
+    "a=rtpmap:110 telephone-event/48000",
+    "a=rtpmap:126 telephone-event/8000",
+    "a=ssrc:3735928559 cname:Zx1yW2vU3tS4rQ5p",
+    "a=ssrc:3735928559 msid:7b5f4e0e-3c1d-4f8e-9a55-2d8c7b1f0a11 1f0c9a5e-8d2b-4c71-b6e3-5a9d0e7f2c44",
+    "m=video 9 UDP/TLS/RTP/SAVPF 96 97 102 103 104 105 106 107 108 109 127 125 39 40 45 46 98 99 100 101 112 113 116 117 118",
+    "c=IN IP4 0.0.0.0",
+    "a=rtcp:9 IN IP4 0.0.0.0",
+    "a=ice-ufrag:Xk2P",
+    "a=ice-pwd:Q8v1w0dFvPjz3gYgH1n3Kc5c",
+    "a=ice-options:trickle",
+    "a=fingerprint:sha-256 3C:4A:9E:2B:7F:11:D0:56:8A:EE:41:90:2C:6B:FA:73:1D:05:B8:CC:62:94:E7:3A:0F:58:D2:19:AB:46:C3:8E",
+    "a=setup:actpass",
+    "a=mid:1",
+    "a=extmap:14 urn:ietf:params:rtp-hdrext:toffset",
+    "a=extmap:2 http://www.webrtc.org/experiments/rtp-hdrext/abs-send-time",
+    "a=extmap:13 urn:3gpp:video-orientation",
+    "a=extmap:3 http://www.ietf.org/id/draft-holmer-rmcat-transport-wide-cc-extensions-01",
+    "a=extmap:5 http://www.webrtc.org/experiments/rtp-hdrext/playout-delay",
+    "a=extmap:6 http://www.webrtc.org/experiments/rtp-hdrext/video-content-type",
+    "a=extmap:7 http://www.webrtc.org/experiments/rtp-hdrext/video-timing",
+    "a=extmap:8 http://www.webrtc.org/experiments/rtp-hdrext/color-space",
+    "a=extmap:4 urn:ietf:params:rtp-hdrext:sdes:mid",
+    "a=extmap:10 urn:ietf:params:rtp-hdrext:sdes:rtp-stream-id",
+    "a=extmap:11 urn:ietf:params:rtp-hdrext:sdes:repaired-rtp-stream-id",
+    "a=sendrecv",
+    "a=msid:7b5f4e0e-3c1d-4f8e-9a55-2d8c7b1f0a11 9c3e1b7a-2f4d-4e86-a0c5-6d1b8e3f7a22",
+    "a=rtcp-mux",
+    "a=rtcp-rsize",
+] + [
+    line
+    for pt, codec in ((96, "VP8"), (98, "VP9"), (100, "VP9"), (102, "H264"), (104, "H264"), (106, "H264"),
+                      (108, "H264"), (127, "H264"), (39, "H264"), (45, "AV1"), (112, "H264"), (116, "red"))
+    for line in (
+        f"a=rtpmap:{pt} {codec}/90000",
+        f"a=rtcp-fb:{pt} goog-remb",
+        f"a=rtcp-fb:{pt} transport-cc",
+        f"a=rtcp-fb:{pt} ccm fir",
+        f"a=rtcp-fb:{pt} nack",
+        f"a=rtcp-fb:{pt} nack pli",
+        f"a=rtpmap:{pt + 1} rtx/90000",
+        f"a=fmtp:{pt + 1} apt={pt}",
+    )
+] + [
+    "a=ssrc-group:FID 2882400001 2882400002",
+    "a=ssrc:2882400001 cname:Zx1yW2vU3tS4rQ5p",
+    "a=ssrc:2882400001 msid:7b5f4e0e-3c1d-4f8e-9a55-2d8c7b1f0a11 9c3e1b7a-2f4d-4e86-a0c5-6d1b8e3f7a22",
+    "a=ssrc:2882400002 cname:Zx1yW2vU3tS4rQ5p",
+    "a=ssrc:2882400002 msid:7b5f4e0e-3c1d-4f8e-9a55-2d8c7b1f0a11 9c3e1b7a-2f4d-4e86-a0c5-6d1b8e3f7a22",
+    "m=application 9 UDP/DTLS/SCTP webrtc-datachannel",
+    "c=IN IP4 0.0.0.0",
+    "a=ice-ufrag:Xk2P",
+    "a=ice-pwd:Q8v1w0dFvPjz3gYgH1n3Kc5c",
+    "a=ice-options:trickle",
+    "a=fingerprint:sha-256 3C:4A:9E:2B:7F:11:D0:56:8A:EE:41:90:2C:6B:FA:73:1D:05:B8:CC:62:94:E7:3A:0F:58:D2:19:AB:46:C3:8E",
+    "a=setup:actpass",
+    "a=mid:2",
+    "a=sctp-port:5000",
+    "a=max-message-size:262144",
+    "",
+])
+
+PEER = "5f0c2d3e-8a41-4b7e-9c26-1d3f5a7b9e80"
+ME = "a1b2c3d4-e5f6-4789-8abc-def012345678"
+
+
+def ice_candidate(n):
+    return {
+        "candidate": f"candidate:{1467250027 + n} 1 udp 2122260223 192.168.1.{10 + n} {54400 + n} typ host generation 0 ufrag Xk2P network-id 1",
+        "sdpMid": "0",
+        "sdpMLineIndex": 0,
+        "usernameFragment": "Xk2P",
+    }
+
+
+MESSAGES = {
+    "offer": {"type": "offer", "payload": {"target": PEER, "sdp": {"type": "offer", "sdp": SDP_OFFER}, "call_type": "private"}, "from": ME},
+    "ice-candidate": {"type": "ice-candidate", "payload": {"target": PEER, "candidate": ice_candidate(0)}, "from": ME},
+    "ice-candidates x8": {"type": "ice-candidates", "payload": {"target": PEER, "candidates": [ice_candidate(n) for n in range(8)]}, "from": ME},
+}
+
+
+class Command(BaseCommand):
+    help = 'Compares JSON and msgpack signaling frame size and encode/decode cost on realistic SDP payloads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        number = options['number']
+        for name, message in MESSAGES.items():
+            for codec_name, codec in (("json", JSON_CODEC), ("msgpack", MSGPACK_CODEC)):
+                frame = codec.encode(message)
+                key, data = next(iter(frame.items()))
+                decode_kwargs = {key: data}
+                encode_us = timeit.timeit(lambda: codec.encode(message), number=number) / number * 1e6
+                decode_us = timeit.timeit(lambda: codec.decode(**decode_kwargs), number=number) / number * 1e6
+                size = len(data.encode('utf-8') if isinstance(data, str) else data)
+                self.stdout.write(
+                    f"{name:18s} {codec_name:8s} size={size:6d}B encode={encode_us:7.2f}us decode={decode_us:7.2f}us"
+                )
@@ -0,0 +1,93 @@
+import asyncio
+import random
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from signaling.consumers import SignalingConsumer
+
+
+class CountingConsumer(SignalingConsumer):
+    relayed = 0
+
+    async def forward_message_to_target(self, target_uuid, message_type, payload):
+        CountingConsumer.relayed += 1
+        await super().forward_message_to_target(target_uuid, message_type, payload)
+
+
+def candidate_schedule(rng):
+    """
+    1回の接続で発生するICE候補の送信タイミング(秒)。
+    host候補は即座に数件、srflx候補はSTUN(5サーバー)の応答を待って数十〜百数十ms後に届く。
+    """
+    times = [rng.uniform(0, 0.005) for _ in range(rng.randint(2, 6))]
+    times += [rng.uniform(0.03, 0.15) for _ in range(rng.randint(2, 10))]
+    return sorted(times)
+
+
+class Command(BaseCommand):
+    help = 'Reports signaling message counts per call setup with and without ICE candidate coalescing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=20)
+        parser.add_argument('--window-ms', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            for window in (0, options['window_ms']):
+                with override_settings(SIGNALING_ICE_COALESCE_MS=window):
+                    relayed, frames = asyncio.run(self._run(options))
+                calls = options['calls']
+                self.stdout.write(
+                    f"coalesce={window:3d}ms relayed/call={relayed / calls:6.1f} "
+                    f"frames-delivered/call={frames / calls:6.1f}"
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    async def _run(self, options):
+        rng = random.Random(options['seed'])
+        app = CountingConsumer.as_asgi()
+        CountingConsumer.relayed = 0
+        frames = 0
+        for i in range(options['calls']):
+            caller_uuid, callee_uuid = f"bench-caller-{i}", f"bench-callee-{i}"
+            caller = WebsocketCommunicator(app, "/ws/signaling/")
+            callee = WebsocketCommunicator(app, "/ws/signaling/")
+            await caller.connect()
+            await callee.connect()
+            for comm, uuid in ((caller, caller_uuid), (callee, callee_uuid)):
+                await comm.send_json_to({"type": "register", "payload": {"uuid": uuid, "features": ["ice-batch"]}})
+                await comm.receive_json_from()
+
+            await caller.send_json_to({"type": "offer", "payload": {"target": callee_uuid, "sdp": "v=0"}})
+            await callee.send_json_to({"type": "answer", "payload": {"target": caller_uuid, "sdp": "v=0"}})
+            await asyncio.gather(
+                self._trickle(caller, callee_uuid, candidate_schedule(rng)),
+                self._trickle(callee, caller_uuid, candidate_schedule(rng)),
+            )
+            await asyncio.sleep(0.05)
+            for comm in (caller, callee):
+                while not await comm.receive_nothing(timeout=0.01):
+                    await comm.receive_from()
+                    frames += 1
+            await caller.disconnect()
+            await callee.disconnect()
+        return CountingConsumer.relayed, frames
+
+    async def _trickle(self, comm, target_uuid, schedule):
+        elapsed = 0.0
+        for n, at in enumerate(schedule):
+            await asyncio.sleep(at - elapsed)
+            elapsed = at
+            candidate = {
+                "candidate": f"candidate:{n} 1 udp 2122260223 192.0.2.1 {50000 + n} typ host",
+                "sdpMid": "0",
+                "sdpMLineIndex": 0,
+            }
+            await comm.send_json_to({"type": "ice-candidate", "payload": {"target": target_uuid, "candidate": candidate}})
+        await comm.send_json_to({"type": "ice-candidate", "payload": {"target": target_uuid, "candidate": None}})
@@ -0,0 +1,82 @@
+import asyncio
+import random
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from signaling.consumers import SignalingConsumer
+from signaling.presence import (
+    BROADCAST_GROUP_NAME, PRESENCE_MODE_BROADCAST, PRESENCE_MODE_SUBSCRIPTION, use_broadcast_presence,
+)
+
+
+class CountingChannelLayer(InMemoryChannelLayer):
+    """チャネルへの配送回数を数えるだけのインメモリレイヤー"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.deliveries = 0
+
+    async def send(self, channel, message):
+        self.deliveries += 1
+        # メッセージは溜めずに捨てる（配送数だけを計測する）
+
+
+def make_friend_graph(num_users, friends_per_user, seed):
+    """相互フォローのランダムな友達グラフを作る"""
+    rng = random.Random(seed)
+    uuids = [f"user-{i:06d}" for i in range(num_users)]
+    friends = {uuid: set() for uuid in uuids}
+    for uuid in uuids:
+        while len(friends[uuid]) < friends_per_user:
+            other = rng.choice(uuids)
+            if other != uuid:
+                friends[uuid].add(other)
+                friends[other].add(uuid)
+    return uuids, friends
+
+
+class Command(BaseCommand):
+    help = 'Compares presence messages delivered per join in broadcast and subscription modes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, nargs='+', default=[1000, 10000])
+        parser.add_argument('--friends', type=int, default=50, help='Average friends per user')
+        parser.add_argument('--joins', type=int, default=100, help='Number of joins to sample')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        for num_users in options['connections']:
+            uuids, friends = make_friend_graph(num_users, options['friends'], options['seed'])
+            for mode in (PRESENCE_MODE_BROADCAST, PRESENCE_MODE_SUBSCRIPTION):
+                with override_settings(SIGNALING_PRESENCE_MODE=mode):
+                    per_join = asyncio.run(self._run(uuids, friends, options['joins']))
+                # 全員が1回ずつ接続し直した場合（デプロイ直後など）の総配送数も出す
+                self.stdout.write(
+                    f"connections={num_users:6d} mode={mode:12s} "
+                    f"messages/join={per_join:9.1f} messages/full-reconnect={per_join * num_users:14,.0f}"
+                )
+
+    async def _run(self, uuids, friends, joins):
+        layer = CountingChannelLayer()
+        consumers = []
+        for uuid in uuids:
+            consumer = SignalingConsumer()
+            consumer.channel_layer = layer
+            consumer.channel_name = await layer.new_channel()
+            consumer.user_uuid = uuid
+            consumer.presence_subscriptions = set()
+            consumer.broadcast_group_name = BROADCAST_GROUP_NAME
+            if use_broadcast_presence():
+                await layer.group_add(consumer.broadcast_group_name, consumer.channel_name)
+            else:
+                await consumer.subscribe_presence(list(friends[uuid]))
+            consumers.append(consumer)
+
+        sample = random.Random(0).sample(consumers, min(joins, len(consumers)))
+        layer.deliveries = 0
+        for consumer in sample:
+            await consumer.publish_presence('user_joined')
+        # broadcastモードでは送信者自身も一度受け取り、signal_messageで捨てている
+        return layer.deliveries / len(sample)
@@ -0,0 +1,148 @@
+import asyncio
+import base64
+import os
+import threading
+import time
+
+from aiohttp import web
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from pywebpush import webpush
+
+from cnc.models import PushSubscription
+from signaling.metrics import percentiles
+from signaling.push import PushDispatcher, VAPID_SUB
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).strip(b"=").decode()
+
+
+def make_subscription_keys():
+    """ブラウザが発行するのと同じ形式の p256dh / auth を生成する"""
+    key = ec.generate_private_key(ec.SECP256R1())
+    p256dh = key.public_key().public_bytes(
+        serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+    )
+    return b64url(p256dh), b64url(os.urandom(16))
+
+
+class FakePushService:
+    """一定の遅延で201を返すPush Service。別スレッドのイベントループで動かす。"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.port = None
+        self.requests = 0
+        self._ready = threading.Event()
+        self._loop = None
+
+    async def handle(self, request):
+        await request.read()
+        await asyncio.sleep(self.latency)
+        self.requests += 1
+        return web.Response(status=201)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        self._ready.wait()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post("/push/{id}", self.handle)
+        runner = web.AppRunner(app)
+        self._loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+
+async def probe_loop_lag(stop, interval, samples):
+    """interval毎に起きて、予定時刻からの遅れ(=イベントループの詰まり)を記録する"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - start - interval)
+
+
+class Command(BaseCommand):
+    help = 'Measures event-loop latency while a burst of missed-call pushes is delivered'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pushes', type=int, default=200, help='Number of pushes in the burst')
+        parser.add_argument('--service-latency', type=float, default=0.05, help='Fake push service latency (seconds)')
+        parser.add_argument('--probe-interval', type=float, default=0.005, help='Loop lag probe interval (seconds)')
+
+    def handle(self, *args, **options):
+        # ベンチマーク用のテストDBを作成する（本番DBには触れない）
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self._run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _run(self, options):
+        service = FakePushService(options['service_latency'])
+        service.start()
+
+        vapid_key = ec.generate_private_key(ec.SECP256R1())
+        settings.VAPID_PRIVATE_KEY = b64url(vapid_key.private_numbers().private_value.to_bytes(32, "big"))
+
+        user_uuids = [f"bench-user-{i:05d}" for i in range(options['pushes'])]
+        PushSubscription.objects.bulk_create([
+            PushSubscription(
+                user_uuid=uuid,
+                endpoint=f"http://127.0.0.1:{service.port}/push/{i}",
+                p256dh=p256dh,
+                auth=auth,
+            )
+            for i, uuid in enumerate(user_uuids)
+            for p256dh, auth in [make_subscription_keys()]
+        ])
+        subscriptions = list(PushSubscription.objects.all())
+        payload = '{"title": "Missed Call", "body": "You have a missed call from bench"}'
+
+        async def legacy():
+            # 旧実装: コンシューマー内で同期のwebpush()を直接呼ぶ
+            for sub in subscriptions:
+                webpush(
+                    {"endpoint": sub.endpoint, "keys": {"p256dh": sub.p256dh, "auth": sub.auth}},
+                    payload,
+                    vapid_private_key=settings.VAPID_PRIVATE_KEY,
+                    vapid_claims={"sub": VAPID_SUB},
+                )
+
+        async def dispatched():
+            dispatcher = PushDispatcher()
+            for uuid in user_uuids:
+                dispatcher.enqueue([uuid], {"title": "Missed Call", "body": "bench"})
+            await dispatcher.join()
+            await dispatcher.close()
+
+        for name, burst in (("legacy webpush()", legacy), ("PushDispatcher", dispatched)):
+            service.requests = 0
+            samples = []
+            elapsed = asyncio.run(self._measure(burst, options['probe_interval'], samples))
+            lag = percentiles(samples or [0.0], scale=1000)
+            self.stdout.write(
+                f"{name:18s} pushes={service.requests:5d} wall={elapsed:7.2f}s "
+                f"loop-lag mean={lag['mean']:8.2f}ms "
+                f"p99={lag['p99']:8.2f}ms max={lag['max']:8.2f}ms"
+            )
+
+    async def _measure(self, burst, interval, samples):
+        stop = asyncio.Event()
+        probe = asyncio.create_task(probe_loop_lag(stop, interval, samples))
+        await asyncio.sleep(interval * 2)
+        start = time.perf_counter()
+        await burst()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await probe
+        return elapsed
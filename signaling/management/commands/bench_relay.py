@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+import redis.asyncio as redis
+from channels.layers import InMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from signaling.channel_routes import route_cache
+from signaling.consumers import SignalingConsumer
+from signaling.presence import LocalPresenceRegistry, RedisPresenceRegistry
+
+
+class Command(BaseCommand):
+    help = 'Measures relayed signaling messages per second with group routing and direct channel routing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000, help='Messages relayed per run')
+        parser.add_argument('--background-users', type=int, default=1000, help='Other registered users in the layer')
+        parser.add_argument('--redis-url', default=None, help='Use RedisChannelLayer and Redis leases at this URL')
+
+    def handle(self, *args, **options):
+        for direct in (False, True):
+            with override_settings(SIGNALING_DIRECT_ROUTING=direct):
+                rate = asyncio.run(self._run(options))
+            name = "direct channel send" if direct else "group_send (user_<uuid>)"
+            self.stdout.write(f"{name:26s} {rate:10,.0f} msg/s")
+
+    async def _run(self, options):
+        route_cache.clear()
+        if options['redis_url']:
+            layer = RedisChannelLayer(hosts=[options['redis_url']])
+            redis_conn = redis.Redis.from_url(options['redis_url'], decode_responses=True)
+            registry = RedisPresenceRegistry(redis_conn)
+        else:
+            layer = InMemoryChannelLayer(capacity=options['messages'] + 10)
+            registry = LocalPresenceRegistry()
+
+        async def register(uuid):
+            consumer = SignalingConsumer()
+            consumer.channel_layer = layer
+            consumer.channel_name = await layer.new_channel()
+            consumer.user_uuid = uuid
+            consumer.presence_registry = registry
+            # connect() を通さないので、そこで作る属性をここで決める（溜めずに経路だけを測る）
+            consumer.signal_buffer = None
+            consumer.resume_tokens = None
+            consumer.call_sessions = None
+            await layer.group_add(f"user_{uuid}", consumer.channel_name)
+            await registry.acquire(uuid, consumer.channel_name)
+            return consumer
+
+        for i in range(options['background_users']):
+            await register(f"bench-bg-{i:06d}")
+        sender = await register("bench-sender")
+        target = await register("bench-target")
+
+        try:
+            count = options['messages']
+            payload = {
+                'target': target.user_uuid,
+                'candidate': {
+                    'candidate': 'candidate:1 1 udp 2122260223 192.0.2.1 54321 typ host',
+                    'sdpMid': '0',
+                    'sdpMLineIndex': 0,
+                },
+            }
+
+            async def drain():
+                for _ in range(count):
+                    await layer.receive(target.channel_name)
+
+            receiver = asyncio.create_task(drain())
+            start = time.perf_counter()
+            for _ in range(count):
+                await sender.forward_message_to_target(target.user_uuid, 'ice-candidate', payload)
+            await receiver
+            return count / (time.perf_counter() - start)
+        finally:
+            if options['redis_url']:
+                await layer.flush()
+                await redis_conn.aclose()
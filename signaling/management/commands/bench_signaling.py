@@ -0,0 +1,207 @@
+import asyncio
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from signaling.channel_routes import route_cache
+from signaling.consumers import SignalingConsumer
+from signaling.metrics import percentiles
+
+
+def current_rss():
+    """プロセスの現在のRSS（バイト）。/proc がない環境ではNone。"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class SimulatedClient:
+    """1つのブラウザタブを模したWebSocketクライアント"""
+
+    def __init__(self, app, uuid):
+        self.uuid = uuid
+        self.comm = WebsocketCommunicator(app, "/ws/signaling/")
+
+    async def connect(self):
+        connected, _ = await self.comm.connect(timeout=30)
+        if not connected:
+            raise RuntimeError(f"Could not connect {self.uuid}")
+
+    async def register(self):
+        start = time.perf_counter()
+        await self.comm.send_json_to({"type": "register", "payload": {"uuid": self.uuid}})
+        while (await self.comm.receive_json_from(timeout=30))['type'] != 'registered':
+            pass
+        return time.perf_counter() - start
+
+    async def send(self, message_type, payload):
+        payload['bench_sent_at'] = time.perf_counter()
+        await self.comm.send_json_to({"type": message_type, "payload": payload})
+
+    async def expect(self, message_type, timeout):
+        """指定の種類のメッセージが届くまで待ち、送信からの経過時間を返す"""
+        while True:
+            message = await self.comm.receive_json_from(timeout=timeout)
+            if message.get('type') == message_type:
+                return time.perf_counter() - message['payload']['bench_sent_at']
+
+
+class Command(BaseCommand):
+    help = 'Load-tests SignalingConsumer with simulated clients and records throughput, latency and memory as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000, help='Simulated clients (paired into calls)')
+        parser.add_argument('--candidates', type=int, default=8, help='ICE candidates trickled by each side')
+        parser.add_argument('--concurrency', type=int, default=200, help='Clients connecting or calling at the same time')
+        parser.add_argument('--timeout', type=float, default=30.0, help='Seconds to wait for a relayed message')
+        parser.add_argument('--redis-url', default=None, help='Use RedisChannelLayer at this URL instead of the InMemory layer')
+        parser.add_argument('--output', default=None, help='Write the results as JSON to this path')
+        parser.add_argument('--compare', default=None, help='Previous results JSON to compare against')
+
+    def handle(self, *args, **options):
+        if options['redis_url']:
+            layers = {"default": {"BACKEND": "channels_redis.core.RedisChannelLayer",
+                                  "CONFIG": {"hosts": [options['redis_url']], "capacity": 1000}}}
+        else:
+            layers = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer",
+                                  "CONFIG": {"capacity": 1000}}}
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(CHANNEL_LAYERS=layers):
+                results = asyncio.run(self._run(options))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results.update({
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'layer': layers['default']['BACKEND'],
+            'config': {k: options[k] for k in ('clients', 'candidates', 'concurrency')},
+        })
+        self._report(results)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+        if options['compare']:
+            with open(options['compare']) as f:
+                self._compare(json.load(f), results)
+
+    async def _run(self, options):
+        route_cache.clear()
+        app = SignalingConsumer.as_asgi()
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        clients = [SimulatedClient(app, f"bench-{i:06d}") for i in range(options['clients'] - options['clients'] % 2)]
+
+        rss_before = current_rss()
+
+        async def connect_and_register(client):
+            async with semaphore:
+                await client.connect()
+                return await client.register()
+
+        start = time.perf_counter()
+        register_latencies = await asyncio.gather(*[connect_and_register(c) for c in clients])
+        register_elapsed = time.perf_counter() - start
+        rss_after = current_rss()
+
+        relay_latencies = {}
+
+        def record(message_type, latency):
+            relay_latencies.setdefault(message_type, []).append(latency)
+
+        async def call(caller, callee):
+            """call-request → offer/answer → ICEトリクル を1通話分行う"""
+            timeout = options['timeout']
+            async with semaphore:
+                await caller.send('call-request', {'target': callee.uuid, 'uuid': caller.uuid})
+                record('call-request', await callee.expect('call-request', timeout))
+                await caller.send('offer', {'target': callee.uuid, 'sdp': {'type': 'offer', 'sdp': 'v=0'}})
+                record('offer', await callee.expect('offer', timeout))
+                await callee.send('answer', {'target': caller.uuid, 'sdp': {'type': 'answer', 'sdp': 'v=0'}})
+                record('answer', await caller.expect('answer', timeout))
+                for n in range(options['candidates']):
+                    candidate = {
+                        'candidate': f"candidate:{n} 1 udp 2122260223 192.0.2.1 {50000 + n} typ host",
+                        'sdpMid': '0',
+                        'sdpMLineIndex': 0,
+                    }
+                    await caller.send('ice-candidate', {'target': callee.uuid, 'candidate': candidate})
+                    await callee.send('ice-candidate', {'target': caller.uuid, 'candidate': candidate})
+                    record('ice-candidate', await callee.expect('ice-candidate', timeout))
+                    record('ice-candidate', await caller.expect('ice-candidate', timeout))
+
+        pairs = list(zip(clients[0::2], clients[1::2]))
+        start = time.perf_counter()
+        await asyncio.gather(*[call(caller, callee) for caller, callee in pairs])
+        call_elapsed = time.perf_counter() - start
+
+        await asyncio.gather(*[c.comm.disconnect() for c in clients])
+
+        relayed = sum(len(samples) for samples in relay_latencies.values())
+        return {
+            'connections': len(clients),
+            'register_latency_ms': percentiles(register_latencies, scale=1000),
+            'registers_per_second': round(len(clients) / register_elapsed, 1),
+            'relay_latency_ms': percentiles([s for samples in relay_latencies.values() for s in samples], scale=1000),
+            'relay_latency_ms_by_type': {t: percentiles(samples, scale=1000) for t, samples in relay_latencies.items()},
+            'relayed_messages': relayed,
+            'throughput_msgs_per_second': round(relayed / call_elapsed, 1),
+            'call_setups_per_second': round(len(pairs) / call_elapsed, 1),
+            'rss_per_connection_bytes': (
+                round((rss_after - rss_before) / len(clients)) if rss_before is not None and clients else None
+            ),
+        }
+
+    def _report(self, results):
+        reg, relay = results['register_latency_ms'], results['relay_latency_ms']
+        self.stdout.write(f"connections           {results['connections']}")
+        self.stdout.write(
+            f"register              {results['registers_per_second']:10,.1f}/s "
+            f"p50={reg['p50']:.2f}ms p95={reg['p95']:.2f}ms p99={reg['p99']:.2f}ms"
+        )
+        self.stdout.write(
+            f"relay                 {results['throughput_msgs_per_second']:10,.1f} msg/s "
+            f"p50={relay['p50']:.2f}ms p95={relay['p95']:.2f}ms p99={relay['p99']:.2f}ms"
+        )
+        for message_type, summary in results['relay_latency_ms_by_type'].items():
+            self.stdout.write(f"  {message_type:18s}  p50={summary['p50']:.2f}ms p99={summary['p99']:.2f}ms (n={summary['count']})")
+        if results['rss_per_connection_bytes'] is not None:
+            self.stdout.write(f"memory/connection     {results['rss_per_connection_bytes'] / 1024:.1f} KiB RSS")
+
+    def _compare(self, baseline, results):
+        """前回の結果との差分を表示する（latencyは増加、throughputは減少が悪化）"""
+        self.stdout.write(f"Compared with {baseline.get('commit')} ({baseline.get('timestamp')}):")
+        rows = [
+            ('register p95 ms', baseline['register_latency_ms']['p95'], results['register_latency_ms']['p95']),
+            ('relay p50 ms', baseline['relay_latency_ms']['p50'], results['relay_latency_ms']['p50']),
+            ('relay p99 ms', baseline['relay_latency_ms']['p99'], results['relay_latency_ms']['p99']),
+            ('throughput msg/s', baseline['throughput_msgs_per_second'], results['throughput_msgs_per_second']),
+            ('rss/connection B', baseline.get('rss_per_connection_bytes'), results.get('rss_per_connection_bytes')),
+        ]
+        for name, before, after in rows:
+            if before in (None, 0) or after is None:
+                continue
+            self.stdout.write(f"  {name:18s} {before:12,.2f} -> {after:12,.2f} ({(after - before) / before:+.1%})")
@@ -0,0 +1,64 @@
+import json
+
+import redis
+from django.core.management.base import BaseCommand
+
+from signaling.call_tracing import SPANS_KEY, phase_breakdown
+from signaling.metrics import percentiles
+from signaling.redis_pool import get_sync_redis_connection
+
+
+class Command(BaseCommand):
+    help = 'Shows time-to-connect percentiles and a per-phase breakdown of recently traced call setups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=1000, help='Most recent spans to include')
+        parser.add_argument('--redis-url', help='Redis to read the spans from (defaults to the configured pool)')
+        parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+
+    def handle(self, *args, **options):
+        if options['redis_url']:
+            redis_conn = redis.Redis.from_url(options['redis_url'], decode_responses=True)
+        else:
+            redis_conn = get_sync_redis_connection()
+        if redis_conn is None:
+            # ローカル開発ではスパンは各プロセスのメモリにしかない
+            self.stdout.write(self.style.WARNING("Redis is not available; spans are only kept in the worker's memory."))
+            return
+        spans = [json.loads(raw) for raw in redis_conn.lrange(SPANS_KEY, 0, options['limit'] - 1)]
+        summary = self.summarize(spans)
+        if options['json']:
+            self.stdout.write(json.dumps(summary, indent=2))
+            return
+        self.report(summary)
+
+    def summarize(self, spans):
+        outcomes = {}
+        for span in spans:
+            outcomes[span['outcome']] = outcomes.get(span['outcome'], 0) + 1
+        connected = [span for span in spans if span['time_to_connect_ms'] is not None]
+        breakdowns = [phase_breakdown(span) for span in connected]
+        return {
+            'spans': len(spans),
+            'outcomes': outcomes,
+            'time_to_connect_ms': percentiles([span['time_to_connect_ms'] for span in connected]),
+            'phases_ms': {
+                name: percentiles([b[name] for b in breakdowns if name in b])
+                for name in ('ringing', 'offer', 'answer', 'ice')
+            },
+            'signaling_ms': percentiles([span['signaling_ms'] for span in connected]),
+        }
+
+    def report(self, summary):
+        self.stdout.write(f"spans: {summary['spans']}  outcomes: {summary['outcomes']}")
+        rows = [('time to connect', summary['time_to_connect_ms'])]
+        rows += [(f"  {name}", stats) for name, stats in summary['phases_ms'].items()]
+        rows.append(('signaling (server)', summary['signaling_ms']))
+        for name, stats in rows:
+            if stats is None:
+                self.stdout.write(f"{name:20s} -")
+                continue
+            self.stdout.write(
+                f"{name:20s} p50={stats['p50']:9.1f}ms p95={stats['p95']:9.1f}ms "
+                f"p99={stats['p99']:9.1f}ms (n={stats['count']})"
+            )
@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+
+from signaling.sharded_layer import ShardedRedisChannelLayer
+
+
+class Command(BaseCommand):
+    help = (
+        'Checks key distribution and rebalancing cost of the sharded channel layer, and optionally '
+        'runs send/group_send round trips against real Redis hosts (e.g. several local redis-server processes)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hosts', nargs='+', required=True, help='Redis URLs, e.g. redis://localhost:6379 redis://localhost:6380')
+        parser.add_argument('--groups', type=int, default=100000, help='Synthetic user_<uuid> groups for the distribution check')
+        parser.add_argument('--live', action='store_true', help='Also send messages through the layer')
+        parser.add_argument('--messages', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        hosts = options['hosts']
+        groups = [f"user_{i:08x}-0000-4000-8000-000000000000" for i in range(options['groups'])]
+
+        layer = ShardedRedisChannelLayer(hosts=hosts, pinned_groups={"signaling_broadcast": 0})
+        counts = [0] * len(hosts)
+        for group in groups:
+            counts[layer.consistent_hash(group)] += 1
+        for url, count in zip(hosts, counts):
+            self.stdout.write(f"{url:40s} {count:8d} groups ({count / len(groups):6.1%})")
+
+        if len(hosts) > 1:
+            # 最後のホストを追加したときに、既存のホスト間で移動してしまうグループの割合
+            smaller = ShardedRedisChannelLayer(hosts=hosts[:-1])
+            moved = sum(
+                1 for group in groups
+                if layer.consistent_hash(group) != smaller.consistent_hash(group)
+                and layer.consistent_hash(group) != len(hosts) - 1
+            )
+            to_new = counts[-1]
+            self.stdout.write(
+                f"adding {hosts[-1]}: {to_new / len(groups):.1%} of groups move to it, "
+                f"{moved / len(groups):.1%} move between existing hosts"
+            )
+
+        if options['live']:
+            rate = asyncio.run(self._live(layer, options['messages']))
+            self.stdout.write(f"live round trips: {rate:,.0f} msg/s through {len(hosts)} host(s)")
+
+    async def _live(self, layer, count):
+        channels = [await layer.new_channel() for _ in range(4)]
+        for i, channel in enumerate(channels):
+            await layer.group_add(f"user_check-{i}", channel)
+        try:
+            start = time.perf_counter()
+            for n in range(count):
+                channel = channels[n % len(channels)]
+                if n % 2:
+                    await layer.send(channel, {'type': 'check', 'n': n})
+                else:
+                    await layer.group_send(f"user_check-{n % len(channels)}", {'type': 'check', 'n': n})
+                message = await layer.receive(channel)
+                assert message['n'] == n, message
+            return count / (time.perf_counter() - start)
+        finally:
+            for i, channel in enumerate(channels):
+                await layer.group_discard(f"user_check-{i}", channel)
+            await layer.flush()
@@ -0,0 +1,56 @@
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from signaling.sharded_layer import ShardedRedisChannelLayer
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves channel-layer groups to the hosts that own them after the Redis host list changed. '
+        'Deploy the new CHANNEL_REDIS_URLS first, then run this with the previous list as --from.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='old_hosts', nargs='+', required=True, help='Previous Redis host URLs, in order')
+        parser.add_argument('--to', dest='new_hosts', nargs='+', help='New Redis host URLs (defaults to the configured layer)')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the groups that would move')
+
+    def handle(self, *args, **options):
+        config = settings.CHANNEL_LAYERS['default'].get('CONFIG', {})
+        new_hosts = options['new_hosts'] or config.get('hosts')
+        if not new_hosts:
+            raise CommandError("No target hosts: pass --to or configure CHANNEL_REDIS_URLS.")
+        prefix = config.get('prefix', 'asgi')
+        pinned_groups = config.get('pinned_groups')
+        old_hosts = options['old_hosts']
+
+        # 接続はしない。ハッシュの計算にだけ使う。
+        new_layer = ShardedRedisChannelLayer(hosts=new_hosts, prefix=prefix, pinned_groups=pinned_groups)
+        clients = {url: redis.Redis.from_url(url) for url in dict.fromkeys(old_hosts + new_hosts)}
+        group_prefix = f"{prefix}:group:".encode('utf8')
+
+        moved = scanned = 0
+        for url in old_hosts:
+            source = clients[url]
+            for key in source.scan_iter(match=group_prefix + b"*", count=500):
+                scanned += 1
+                group = key[len(group_prefix):].decode('utf8')
+                target_url = new_hosts[new_layer.consistent_hash(group)]
+                if target_url == url:
+                    continue
+                moved += 1
+                if options['dry_run']:
+                    continue
+                members = source.zrange(key, 0, -1, withscores=True)
+                ttl = source.pttl(key)
+                target = clients[target_url]
+                if members:
+                    # 新しいホストで既に更新されたメンバーは新しい時刻を残す
+                    target.zadd(key, dict(members), gt=True)
+                if ttl > 0:
+                    target.pexpire(key, ttl)
+                source.delete(key)
+
+        action = "would move" if options['dry_run'] else "moved"
+        self.stdout.write(self.style.SUCCESS(f"Scanned {scanned} group(s), {action} {moved}."))
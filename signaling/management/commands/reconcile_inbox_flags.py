@@ -0,0 +1,25 @@
+import redis
+from django.core.management.base import BaseCommand
+
+from cnc.inbox import iter_pending_inbox_uuids
+from signaling.inbox_flags import rebuild_inbox_flags
+from signaling.redis_pool import get_sync_redis_connection
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the Redis pending-inbox flags from undelivered notifications and unread mails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--redis-url', help='Redis to rebuild (defaults to the configured pool)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options['redis_url']:
+            redis_conn = redis.Redis.from_url(options['redis_url'], decode_responses=True)
+        else:
+            redis_conn = get_sync_redis_connection()
+        if redis_conn is None:
+            self.stdout.write(self.style.WARNING("Redis is not available; registers always read the database."))
+            return
+        count = rebuild_inbox_flags(redis_conn, iter_pending_inbox_uuids(), batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Flagged {count} user(s) with a pending inbox."))
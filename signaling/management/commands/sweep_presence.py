@@ -0,0 +1,29 @@
+import asyncio
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from signaling.presence import get_presence_registry, publish_presence_event
+
+
+class Command(BaseCommand):
+    help = 'Removes expired presence leases and announces users who went offline'
+
+    def handle(self, *args, **options):
+        gone = asyncio.run(self._sweep())
+        self.stdout.write(self.style.SUCCESS(f"Expired {len(gone)} stale user(s)."))
+
+    async def _sweep(self):
+        registry = get_presence_registry()
+        if registry is None:
+            self.stdout.write(self.style.WARNING("Presence registry is not available."))
+            return []
+        channel_layer = get_channel_layer()
+        gone_total = []
+        while True:
+            gone = await registry.sweep()
+            for user_uuid in gone:
+                await publish_presence_event(channel_layer, user_uuid, 'user_left')
+            gone_total.extend(gone)
+            if not gone:
+                return gone_total
@@ -0,0 +1,171 @@
+import functools
+import statistics
+import time
+from prometheus_client import Counter, Gauge, Histogram
+
+# --- Prometheus メトリクス ---
+#
+# 値はプロセスごとに集計される（Daphneのワーカーごとに /metrics を取得する）。
+# ラベルの値はクライアントから自由に送れるので、既知の種類以外は "other" にまとめる。
+
+# シグナリングの処理はほぼミリ秒未満なので、細かめのバケットにする
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+KNOWN_MESSAGE_TYPES = frozenset({
+    'register', 'heartbeat', 'presence-subscribe', 'call-request', 'offer', 'answer',
+    'ice-candidate', 'call-accepted', 'call-rejected', 'call-busy', 'call-ended',
+})
+
+SIGNALING_MESSAGES = Counter(
+    'cnc_signaling_messages_total', 'Signaling frames received, by message type', ['type']
+)
+SIGNALING_RECEIVE_SECONDS = Histogram(
+    'cnc_signaling_receive_seconds', 'Time spent in SignalingConsumer.receive, by message type',
+    ['type'], buckets=LATENCY_BUCKETS
+)
+SIGNALING_ERRORS = Counter(
+    'cnc_signaling_errors_total', 'Frames that failed to decode or raised while being handled', ['reason']
+)
+SIGNALING_CONNECTIONS = Gauge(
+    'cnc_signaling_connections', 'Open signaling WebSocket connections'
+)
+SIGNALING_REGISTERED_CONNECTIONS = Gauge(
+    'cnc_signaling_registered_connections', 'Open signaling WebSocket connections that have registered a UUID'
+)
+SIGNALING_REGISTRATIONS = Counter(
+    'cnc_signaling_registrations_total', 'Register messages handled, by full or resumed path', ['path']
+)
+HANDLER_SECONDS = Histogram(
+    'cnc_signaling_handler_seconds', 'Time spent in signaling handlers', ['handler'], buckets=LATENCY_BUCKETS
+)
+DB_SECONDS = Histogram(
+    'cnc_db_call_seconds', 'Time spent in database_sync_to_async helpers, including the thread hop',
+    ['operation'], buckets=LATENCY_BUCKETS
+)
+PRESENCE_SECONDS = Histogram(
+    'cnc_presence_call_seconds', 'Time spent in presence registry calls', ['operation'], buckets=LATENCY_BUCKETS
+)
+PRESENCE_CACHE_HITS = Counter(
+    'cnc_presence_cache_hits_total', 'Presence checks answered from the in-process near-cache'
+)
+PRESENCE_CACHE_MISSES = Counter(
+    'cnc_presence_cache_misses_total', 'Presence checks that had to read Redis'
+)
+PRESENCE_CACHE_INVALIDATIONS = Counter(
+    'cnc_presence_cache_invalidations_total', 'Presence change notifications received from Redis pub/sub'
+)
+CHANNEL_LAYER_SECONDS = Histogram(
+    'cnc_channel_layer_send_seconds', 'Time spent sending to the channel layer', ['method'], buckets=LATENCY_BUCKETS
+)
+CALL_SETUP_SECONDS = Histogram(
+    'cnc_call_setup_seconds', 'Time from call-request to call-accepted, answer and the last ICE candidate',
+    ['phase'], buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0, 60.0)
+)
+CALL_SETUP_SIGNALING_SECONDS = Histogram(
+    'cnc_call_setup_signaling_seconds', 'Server-side relay time spent on the messages of one call setup',
+    buckets=LATENCY_BUCKETS
+)
+CALL_SETUP_OUTCOMES = Counter(
+    'cnc_call_setup_total', 'Traced call setups, by outcome', ['outcome']
+)
+SIGNAL_BUFFER_MESSAGES = Counter(
+    'cnc_signal_buffer_messages_total', 'Signaling frames held for offline peers, by result', ['result']
+)
+MAINTENANCE_RUNS = Counter(
+    'cnc_maintenance_runs_total', 'Scheduled maintenance jobs on this worker, by job and result', ['job', 'result']
+)
+MAINTENANCE_SECONDS = Histogram(
+    'cnc_maintenance_seconds', 'Time spent in scheduled maintenance jobs run by this worker', ['job']
+)
+HTTP_REQUESTS = Counter(
+    'cnc_http_requests_total', 'HTTP requests, by route, method and status', ['route', 'method', 'status']
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'cnc_http_request_seconds', 'HTTP request latency, by route and method', ['route', 'method']
+)
+
+_message_children = {
+    label: (SIGNALING_MESSAGES.labels(label), SIGNALING_RECEIVE_SECONDS.labels(label))
+    for label in KNOWN_MESSAGE_TYPES | {'other'}
+}
+
+
+def observe_message(message_type, seconds):
+    """受信したフレーム1件分のカウンターとヒストグラムを更新する"""
+    if not isinstance(message_type, str) or message_type not in KNOWN_MESSAGE_TYPES:
+        message_type = 'other'
+    counter, histogram = _message_children[message_type]
+    counter.inc()
+    histogram.observe(seconds)
+
+
+def timed(histogram, label):
+    """非同期関数の実行時間を histogram に記録するデコレーター（ラベルは定義時に解決しておく）"""
+    child = histogram.labels(label)
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class timer:
+    """with文のブロックの実行時間を記録する"""
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+# よく使うラベルは毎回 labels() を引かないように先に解決しておく
+CHANNEL_SEND = CHANNEL_LAYER_SECONDS.labels('send')
+CHANNEL_GROUP_SEND = CHANNEL_LAYER_SECONDS.labels('group_send')
+PRESENCE_ACQUIRE = PRESENCE_SECONDS.labels('acquire')
+PRESENCE_RENEW = PRESENCE_SECONDS.labels('renew')
+PRESENCE_RELEASE = PRESENCE_SECONDS.labels('release')
+PRESENCE_IS_ONLINE = PRESENCE_SECONDS.labels('is_online')
+PRESENCE_FILTER_ONLINE = PRESENCE_SECONDS.labels('filter_online')
+DECODE_ERRORS = SIGNALING_ERRORS.labels('decode')
+HANDLER_ERRORS = SIGNALING_ERRORS.labels('handler')
+REGISTER_FULL = SIGNALING_REGISTRATIONS.labels('full')
+REGISTER_RESUMED = SIGNALING_REGISTRATIONS.labels('resumed')
+SIGNAL_BUFFER_BUFFERED = SIGNAL_BUFFER_MESSAGES.labels('buffered')
+SIGNAL_BUFFER_REPLAYED = SIGNAL_BUFFER_MESSAGES.labels('replayed')
+SIGNAL_BUFFER_DUPLICATES = SIGNAL_BUFFER_MESSAGES.labels('duplicate')
+
+
+def percentiles(values, scale=1):
+    """
+    値のリスト（None は除く）に scale を掛けて count/mean/p50/p95/p99/max を求める（空ならNone）。
+    ベンチマークと通話開始の計測のレポートで共通に使う（秒の値は scale=1000 でミリ秒にする）。
+    """
+    values = sorted(v * scale for v in values if v is not None)
+    if not values:
+        return None
+    if len(values) == 1:
+        cuts = values * 99
+    else:
+        cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return {
+        'count': len(values),
+        'mean': round(statistics.fmean(values), 3),
+        'p50': round(cuts[49], 3),
+        'p95': round(cuts[94], 3),
+        'p99': round(cuts[98], 3),
+        'max': round(values[-1], 3),
+    }
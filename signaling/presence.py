@@ -0,0 +1,327 @@
+import logging
+import re
+import time
+from channels.layers import BaseChannelLayer
+from django.conf import settings
+from .redis_pool import get_redis_connection
+from .codecs import frame_event
+from .metrics import timer, CHANNEL_GROUP_SEND
+from .presence_cache import PresenceNearCache, PRESENCE_CHANGES_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+# 全体通知用グループ（legacyモードでのみ使用）
+BROADCAST_GROUP_NAME = "signaling_broadcast"
+
+PRESENCE_MODE_SUBSCRIPTION = "subscription"
+PRESENCE_MODE_BROADCAST = "broadcast"
+
+
+def presence_group_name(user_uuid):
+    """user_uuid のオンライン/オフラインを購読するチャネルのグループ名"""
+    return f"presence_{user_uuid}"
+
+
+def use_broadcast_presence():
+    """旧来の全体ブロードキャストでプレゼンスを配信するかどうか"""
+    return settings.SIGNALING_PRESENCE_MODE == PRESENCE_MODE_BROADCAST
+
+
+# Channelsのグループ名に使える文字（ASCIIの英数字と - _ .）
+GROUP_NAME_CHARS = re.compile(r"[A-Za-z0-9\-_.]+")
+
+
+def is_valid_friend_uuid(uuid):
+    """プレゼンスグループの名前にできるUUIDか（グループ名全体が MAX_NAME_LENGTH 未満）"""
+    return (
+        isinstance(uuid, str) and GROUP_NAME_CHARS.fullmatch(uuid) is not None
+        and len(presence_group_name(uuid)) < BaseChannelLayer.MAX_NAME_LENGTH
+    )
+
+
+def clean_friend_uuids(friends_list, my_uuid, limit=None):
+    """文字列でない値・グループ名にできない値・自分自身・重複を除いた友達UUIDのリストを返す"""
+    if not isinstance(friends_list, (list, tuple)):
+        return []
+    # 重複を除く（dict.fromkeys）前に絞り込むので、リストや辞書が混じっていても TypeError にならない
+    friend_uuids = list(dict.fromkeys(
+        uuid for uuid in friends_list if is_valid_friend_uuid(uuid) and uuid != my_uuid
+    ))
+    if limit is not None:
+        friend_uuids = friend_uuids[:limit]
+    return friend_uuids
+
+
+async def publish_presence_event(channel_layer, user_uuid, event_type, sender_channel=None):
+    """user_uuid の 'user_joined' / 'user_left' を購読者（legacyモードでは全員）に配信する"""
+    group = BROADCAST_GROUP_NAME if use_broadcast_presence() else presence_group_name(user_uuid)
+    with timer(CHANNEL_GROUP_SEND):
+        await channel_layer.group_send(
+            group,
+            frame_event({
+                'type': event_type,
+                'uuid': user_uuid
+            }, sender_channel=sender_channel)
+        )
+
+
+# --- 接続ごとのリースで管理するプレゼンスレジストリ ---
+#
+# presence:lease:<uuid>  ZSET  member=channel_name, score=リースの期限
+# presence:online        ZSET  member=uuid,         score=そのユーザーの最も遅いリース期限
+#
+# リースが1つでも有効ならオンライン。期限切れのリースは読み取り時に無視されるので、
+# ワーカーがクラッシュしても最長 PRESENCE_LEASE_SECONDS でオフラインになる。
+# オンライン/オフラインや接続（リースのチャネル）が変わったときはスクリプト内で presence:changes に
+# UUIDをPUBLISHし、各ワーカーのニアキャッシュ（presence_cache.py）とルートキャッシュを無効化する。
+
+LEASE_KEY_PREFIX = "presence:lease:"
+ONLINE_KEY = "presence:online"
+
+# KEYS[1]=lease key, KEYS[2]=online key / ARGV: channel, expires_at, now, ttl, uuid, changes channel
+ACQUIRE_SCRIPT = """
+local previous = redis.call('ZSCORE', KEYS[2], ARGV[5])
+local expired = redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+local added = redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('ZADD', KEYS[2], 'GT', ARGV[2], ARGV[5])
+if not previous or tonumber(previous) <= tonumber(ARGV[3]) or added > 0 or expired > 0 then
+    redis.call('PUBLISH', ARGV[6], ARGV[5])
+end
+return redis.call('ZCARD', KEYS[1])
+"""
+
+# KEYS[1]=lease key, KEYS[2]=online key / ARGV: channel, now, uuid, changes channel
+RELEASE_SCRIPT = """
+local removed = redis.call('ZREM', KEYS[1], ARGV[1]) + redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+local top = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+if #top == 0 then
+    redis.call('DEL', KEYS[1])
+    redis.call('ZREM', KEYS[2], ARGV[3])
+    redis.call('PUBLISH', ARGV[4], ARGV[3])
+    return 0
+end
+redis.call('ZADD', KEYS[2], top[2], ARGV[3])
+if removed > 0 then
+    redis.call('PUBLISH', ARGV[4], ARGV[3])
+end
+return redis.call('ZCARD', KEYS[1])
+"""
+
+# KEYS[1]=online key / ARGV: now, limit, lease key prefix, changes channel
+SWEEP_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local gone = {}
+for _, uuid in ipairs(expired) do
+    local key = ARGV[3] .. uuid
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', ARGV[1])
+    local top = redis.call('ZRANGE', key, -1, -1, 'WITHSCORES')
+    if #top == 0 then
+        redis.call('ZREM', KEYS[1], uuid)
+        redis.call('PUBLISH', ARGV[4], uuid)
+        table.insert(gone, uuid)
+    else
+        redis.call('ZADD', KEYS[1], top[2], uuid)
+    end
+end
+return gone
+"""
+
+
+class RedisPresenceRegistry:
+    """Redisのソート済みセットでリースを管理する（本番用）"""
+
+    def __init__(self, redis_conn, near_cache=None):
+        self.redis_conn = redis_conn
+        self.near_cache = near_cache
+        self._acquire = redis_conn.register_script(ACQUIRE_SCRIPT)
+        self._release = redis_conn.register_script(RELEASE_SCRIPT)
+        self._sweep = redis_conn.register_script(SWEEP_SCRIPT)
+
+    async def acquire(self, user_uuid, channel_name):
+        """リースを取得（または延長）し、そのユーザーの有効なリース数を返す"""
+        now = time.time()
+        ttl = settings.PRESENCE_LEASE_SECONDS
+        result = await self._acquire(
+            keys=[LEASE_KEY_PREFIX + user_uuid, ONLINE_KEY],
+            args=[channel_name, now + ttl, now, ttl, user_uuid, PRESENCE_CHANGES_CHANNEL],
+        )
+        # 自分のワーカーのキャッシュはpub/subを待たずに無効化する
+        if self.near_cache is not None:
+            self.near_cache.invalidate(user_uuid)
+        return result
+
+    renew = acquire
+
+    async def release(self, user_uuid, channel_name):
+        """リースを返却し、残っている有効なリース数を返す（0ならオフライン）"""
+        result = await self._release(
+            keys=[LEASE_KEY_PREFIX + user_uuid, ONLINE_KEY],
+            args=[channel_name, time.time(), user_uuid, PRESENCE_CHANGES_CHANNEL],
+        )
+        # 自分のワーカーのキャッシュはpub/subを待たずに無効化する
+        if self.near_cache is not None:
+            self.near_cache.invalidate(user_uuid)
+        return result
+
+    async def is_online(self, user_uuid):
+        """ニアキャッシュにあればそれを使い、なければRedisを読む"""
+        now = time.time()
+        cache = self.near_cache
+        if cache is not None:
+            cache.ensure_listener(self.redis_conn)
+            cached = cache.get(user_uuid, now)
+            if cached is not None:
+                return cached
+            epoch = cache.epoch
+        expires_at = await self.redis_conn.zscore(ONLINE_KEY, user_uuid)
+        if cache is not None:
+            cache.put(user_uuid, expires_at, now, epoch)
+        return expires_at is not None and expires_at > now
+
+    async def filter_online(self, user_uuids):
+        """指定されたUUIDのうちオンラインのものだけを返す（キャッシュにないものだけ ZMSCORE 1回で判定）"""
+        if not user_uuids:
+            return set()
+        now = time.time()
+        cache = self.near_cache
+        online, missing = set(), list(user_uuids)
+        if cache is not None:
+            cache.ensure_listener(self.redis_conn)
+            online, missing = cache.lookup_many(user_uuids, now)
+            if not missing:
+                return online
+            epoch = cache.epoch
+        scores = await self.redis_conn.zmscore(ONLINE_KEY, missing)
+        for uuid, expires_at in zip(missing, scores):
+            if cache is not None:
+                cache.put(uuid, expires_at, now, epoch)
+            if expires_at is not None and expires_at > now:
+                online.add(uuid)
+        return online
+
+    def watch_routes(self, route_cache):
+        """route_cache をニアキャッシュの無効化に繋ぎ、今キャッシュを使ってよいか（購読中か）を返す"""
+        cache = self.near_cache
+        if cache is None:
+            return False
+        cache.watch(route_cache)
+        cache.ensure_listener(self.redis_conn)
+        return cache.active
+
+    async def channels_for(self, user_uuid):
+        """有効なリースを持つチャネル名（＝そのユーザーの接続）のリストを返す"""
+        return await self.redis_conn.zrangebyscore(LEASE_KEY_PREFIX + user_uuid, time.time(), '+inf')
+
+    async def sweep(self, limit=None):
+        """期限切れのリースを掃除し、オフラインになったUUIDのリストを返す"""
+        return await self._sweep(
+            keys=[ONLINE_KEY],
+            args=[time.time(), limit or settings.PRESENCE_SWEEP_BATCH, LEASE_KEY_PREFIX, PRESENCE_CHANGES_CHANNEL],
+        )
+
+
+class LocalPresenceRegistry:
+    """プロセス内の辞書でリースを管理する（ローカル開発用: DEBUG=True）"""
+
+    def __init__(self):
+        self.leases = {}  # uuid -> {channel_name: expires_at}
+
+    def _live(self, user_uuid, now):
+        """有効なリースだけを返す（期限切れのリースを消すのは acquire/release/sweep だけ）"""
+        return {c: expires_at for c, expires_at in self.leases.get(user_uuid, {}).items() if expires_at > now}
+
+    def _store(self, user_uuid, leases):
+        if leases:
+            self.leases[user_uuid] = leases
+        else:
+            self.leases.pop(user_uuid, None)
+
+    async def acquire(self, user_uuid, channel_name):
+        now = time.time()
+        leases = self._live(user_uuid, now)
+        leases[channel_name] = now + settings.PRESENCE_LEASE_SECONDS
+        self._store(user_uuid, leases)
+        return len(leases)
+
+    renew = acquire
+
+    async def release(self, user_uuid, channel_name):
+        leases = self._live(user_uuid, time.time())
+        leases.pop(channel_name, None)
+        self._store(user_uuid, leases)
+        return len(leases)
+
+    async def is_online(self, user_uuid):
+        return bool(self._live(user_uuid, time.time()))
+
+    async def filter_online(self, user_uuids):
+        now = time.time()
+        return {uuid for uuid in user_uuids if self._live(uuid, now)}
+
+    def watch_routes(self, route_cache):
+        # 1プロセスだけなので、接続・切断時の consumers.py の無効化で足りる
+        return True
+
+    async def channels_for(self, user_uuid):
+        return list(self._live(user_uuid, time.time()))
+
+    async def sweep(self, limit=None):
+        """期限切れのリースを消し、有効なリースが残らなかったUUIDのリストを返す"""
+        now = time.time()
+        gone = []
+        for user_uuid in list(self.leases):
+            leases = self._live(user_uuid, now)
+            self._store(user_uuid, leases)
+            if not leases:
+                gone.append(user_uuid)
+        return gone
+
+
+local_presence_registry = LocalPresenceRegistry()
+redis_presence_registry = None
+
+
+def get_presence_registry():
+    """環境に応じたプレゼンスレジストリを返す。Redisが使えない場合はNone。"""
+    global redis_presence_registry
+    if settings.DEBUG:
+        return local_presence_registry
+    if redis_presence_registry is None:
+        redis_conn = get_redis_connection()
+        if redis_conn is None:
+            return None
+        near_cache = None
+        if settings.PRESENCE_CACHE_ENABLED:
+            near_cache = PresenceNearCache(settings.PRESENCE_CACHE_MAX_ENTRIES, settings.PRESENCE_CACHE_TTL_SECONDS)
+        redis_presence_registry = RedisPresenceRegistry(redis_conn, near_cache)
+    return redis_presence_registry
+
+
+_last_sweep_at = 0.0
+
+
+async def maybe_sweep_presence(channel_layer):
+    """
+    前回から PRESENCE_SWEEP_INTERVAL_SECONDS 以上経っていれば期限切れリースを掃除し、
+    クラッシュしたワーカーに残されたユーザーの 'user_left' を配信する。
+    """
+    global _last_sweep_at
+    now = time.time()
+    if now - _last_sweep_at < settings.PRESENCE_SWEEP_INTERVAL_SECONDS:
+        return []
+    _last_sweep_at = now
+    return await sweep_presence(channel_layer)
+
+
+async def sweep_presence(channel_layer):
+    """期限切れリースを1回掃除し、オフラインになったユーザーの 'user_left' を配信する"""
+    registry = get_presence_registry()
+    if registry is None:
+        return []
+    gone = await registry.sweep()
+    for user_uuid in gone:
+        await publish_presence_event(channel_layer, user_uuid, 'user_left')
+    if gone:
+        logger.info(f"Presence sweeper expired {len(gone)} stale user(s).")
+    return gone
@@ -0,0 +1,118 @@
+import asyncio
+import collections
+import logging
+import random
+from .metrics import PRESENCE_CACHE_HITS, PRESENCE_CACHE_MISSES, PRESENCE_CACHE_INVALIDATIONS
+
+logger = logging.getLogger(__name__)
+
+# オンライン状態が変わったUUIDを流すチャネル（presence.py のLuaスクリプトがPUBLISHする）
+PRESENCE_CHANGES_CHANNEL = "presence:changes"
+
+
+class PresenceNearCache:
+    """
+    ワーカー内に置くプレゼンスのLRUキャッシュ。
+    presence:changes の購読中だけ使い、購読が切れている間は常にミスとしてRedisを読む。
+    エントリは (オンラインか, 有効期限) で、オンラインの期限はリースの期限を超えない。
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # uuid -> (online, expires_at)
+        self.active = False
+        # 無効化の回数。Redisを読んでいる間に無効化が来たら、読んだ値はキャッシュしない。
+        self.epoch = 0
+        self._listener = None
+        # 同じ無効化を受け取る他のキャッシュ（channel_routes.py のルートキャッシュ）
+        self.dependents = []
+
+    def get(self, user_uuid, now):
+        """キャッシュにあれば True/False、なければ None を返す"""
+        if not self.active:
+            PRESENCE_CACHE_MISSES.inc()
+            return None
+        entry = self.entries.get(user_uuid)
+        if entry is None or entry[1] <= now:
+            if entry is not None:
+                del self.entries[user_uuid]
+            PRESENCE_CACHE_MISSES.inc()
+            return None
+        self.entries.move_to_end(user_uuid)
+        PRESENCE_CACHE_HITS.inc()
+        return entry[0]
+
+    def put(self, user_uuid, lease_expires_at, now, epoch):
+        """Redisから読んだ値を入れる。lease_expires_at は presence:online のスコア（なければNone）。"""
+        if not self.active or epoch != self.epoch:
+            return
+        online = lease_expires_at is not None and lease_expires_at > now
+        expires_at = now + self.ttl
+        if online:
+            expires_at = min(expires_at, lease_expires_at)
+        self.entries[user_uuid] = (online, expires_at)
+        self.entries.move_to_end(user_uuid)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_uuid):
+        self.epoch += 1
+        self.entries.pop(user_uuid, None)
+        for dependent in self.dependents:
+            dependent.invalidate(user_uuid)
+
+    def clear(self):
+        self.epoch += 1
+        self.entries.clear()
+        for dependent in self.dependents:
+            dependent.clear()
+
+    def watch(self, cache):
+        """cache（invalidate/clear を持つもの）にも presence:changes の無効化を伝える"""
+        if cache not in self.dependents:
+            self.dependents.append(cache)
+
+    def ensure_listener(self, redis_conn):
+        """無効化チャネルの購読タスクを（まだなければ）このイベントループで起動する"""
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.get_running_loop().create_task(self._listen(redis_conn))
+
+    async def _listen(self, redis_conn):
+        backoff = 1.0
+        while True:
+            pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(PRESENCE_CHANGES_CHANNEL)
+                # 購読を始める前の変更は届かないので、空の状態から使い始める
+                self.clear()
+                self.active = True
+                backoff = 1.0
+                async for message in pubsub.listen():
+                    if message.get('type') == 'message':
+                        PRESENCE_CACHE_INVALIDATIONS.inc()
+                        self.invalidate(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Presence invalidation channel lost, bypassing near-cache: {e}")
+            finally:
+                self.active = False
+                self.clear()
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+            await asyncio.sleep(backoff + random.uniform(0, backoff))
+            backoff = min(backoff * 2, 30.0)
+
+    def lookup_many(self, user_uuids, now):
+        """キャッシュで分かるものは結果に、分からないものはミスのリストに分ける"""
+        online, missing = set(), []
+        for user_uuid in user_uuids:
+            cached = self.get(user_uuid, now)
+            if cached is None:
+                missing.append(user_uuid)
+            elif cached:
+                online.add(user_uuid)
+        return online, missing
@@ -0,0 +1,249 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+from channels.db import database_sync_to_async
+from django.conf import settings
+from py_vapid import Vapid
+from pywebpush import WebPusher, WebPushException
+
+from cnc.models import PushSubscription
+
+logger = logging.getLogger(__name__)
+
+VAPID_SUB = "mailto:admin@example.com" # 適切なメールアドレスに変更してください
+# VAPIDトークンの有効期限（pywebpushと同じ12時間）。期限の少し前に再署名する。
+VAPID_TOKEN_LIFETIME = 12 * 60 * 60
+VAPID_TOKEN_REFRESH_MARGIN = 10 * 60
+# Push Serviceが購読の失効を示すステータス
+GONE_STATUSES = (404, 410)
+# 再試行する価値のあるステータス
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class InvalidSubscription(ValueError):
+    """購読の鍵（p256dh/auth）で暗号化できなかった"""
+
+
+class PushDispatcher:
+    """
+    Web Push を非同期で配信するディスパッチャ。
+    コンシューマーは enqueue() でジョブを積むだけで、実際の送信はバックグラウンドで行う。
+    """
+
+    def __init__(self, max_concurrency=None, timeout=None, max_retries=None,
+                 backoff_base=None, queue_size=None):
+        self.max_concurrency = max_concurrency or settings.PUSH_MAX_CONCURRENCY
+        self.timeout = timeout or settings.PUSH_TIMEOUT_SECONDS
+        self.max_retries = settings.PUSH_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base = backoff_base or settings.PUSH_BACKOFF_BASE_SECONDS
+        self.queue = asyncio.Queue(maxsize=queue_size or settings.PUSH_QUEUE_SIZE)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.loop = asyncio.get_running_loop()
+        self._sessions = {}  # origin -> aiohttp.ClientSession
+        self._vapid = None
+        self._vapid_headers = {}  # origin -> (expires_at, headers)
+        self._inflight = set()
+        self._pump_task = self.loop.create_task(self._pump())
+
+    # --- 公開API ---
+
+    def enqueue(self, user_uuids, payload):
+        """ユーザー群へのPush通知ジョブを積む。キューが満杯なら破棄してFalseを返す。"""
+        if isinstance(user_uuids, str):
+            user_uuids = [user_uuids]
+        user_uuids = list(user_uuids)
+        if not user_uuids:
+            return True
+        try:
+            self.queue.put_nowait((user_uuids, json.dumps(payload)))
+            return True
+        except asyncio.QueueFull:
+            logger.warning(f"Push queue is full. Dropping push for {len(user_uuids)} user(s).")
+            return False
+
+    async def join(self):
+        """キューと送信中のジョブが全て完了するまで待つ（ベンチマーク・シャットダウン用）"""
+        await self.queue.join()
+        while self._inflight:
+            await asyncio.gather(*list(self._inflight), return_exceptions=True)
+
+    async def close(self):
+        self._pump_task.cancel()
+        for task in list(self._inflight):
+            task.cancel()
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+    # --- 内部処理 ---
+
+    async def _pump(self):
+        while True:
+            user_uuids, data = await self.queue.get()
+            try:
+                subscriptions = await get_subscriptions_for_users(user_uuids)
+                if not subscriptions:
+                    logger.info(f"No push subscriptions found for {len(user_uuids)} user(s).")
+                for sub in subscriptions:
+                    # 同時送信数をセマフォで制限する。空くまでここで待つ。
+                    await self.semaphore.acquire()
+                    task = self.loop.create_task(self._deliver(sub, data))
+                    self._inflight.add(task)
+                    task.add_done_callback(self._on_delivered)
+            except Exception as e:
+                logger.exception(f"Failed to dispatch push job for {len(user_uuids)} user(s): {e}")
+            finally:
+                self.queue.task_done()
+
+    def _on_delivered(self, task):
+        self._inflight.discard(task)
+        self.semaphore.release()
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Push delivery task failed: {task.exception()!r}")
+
+    async def _deliver(self, sub, data):
+        """1つの購読に送信する。一時的なエラーはバックオフ付きで再試行する。"""
+        endpoint = sub["endpoint"]
+        for attempt in range(self.max_retries + 1):
+            try:
+                body, headers = await asyncio.to_thread(self._build_request, sub, data)
+                session = self._session_for(endpoint)
+                async with session.post(endpoint, data=body, headers=headers) as resp:
+                    status = resp.status
+                    if status <= 202:
+                        logger.debug(f"Push delivered to user {sub['user_uuid'][:8]} ({status}).")
+                        return
+                    if status in GONE_STATUSES:
+                        logger.info(f"Push subscription for user {sub['user_uuid'][:8]} is gone ({status}). Deleting.")
+                        await _forget_subscription(endpoint)
+                        return
+                    if status not in RETRY_STATUSES:
+                        text = await resp.text()
+                        logger.error(f"Push failed for user {sub['user_uuid'][:8]}: {status} {text}")
+                        return
+                    retry_after = _parse_retry_after(resp.headers.get("Retry-After"))
+            except InvalidSubscription as e:
+                # 鍵が壊れている購読は何度送っても暗号化できない
+                logger.warning(f"Push subscription for user {sub['user_uuid'][:8]} has invalid keys ({e}). Deleting.")
+                await _forget_subscription(endpoint)
+                return
+            except WebPushException as ex:
+                logger.error(f"WebPushException for user {sub['user_uuid'][:8]}: {ex}")
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Push request to {_origin(endpoint)} failed (attempt {attempt + 1}): {e!r}")
+                retry_after = None
+            except Exception as e:
+                logger.exception(f"Push to user {sub['user_uuid'][:8]} failed (attempt {attempt + 1}): {e!r}")
+                retry_after = None
+            if attempt < self.max_retries:
+                # 指数バックオフ + ジッター。Retry-Afterがあればそちらを優先。
+                delay = retry_after or self.backoff_base * (2 ** attempt) * (1 + random.random())
+                await asyncio.sleep(delay)
+        logger.error(f"Giving up push to user {sub['user_uuid'][:8]} after {self.max_retries + 1} attempts.")
+
+    def _build_request(self, sub, data):
+        """暗号化とVAPID署名を行う（CPU処理なのでスレッドプールで実行される）"""
+        subscription_info = {
+            "endpoint": sub["endpoint"],
+            "keys": {"p256dh": sub["p256dh"], "auth": sub["auth"]},
+        }
+        try:
+            encoded = WebPusher(subscription_info).encode(data.encode("utf8"), "aes128gcm")
+        except Exception as e:
+            # 鍵の形が不正だと WebPushException / ValueError / binascii.Error / IndexError などになる
+            raise InvalidSubscription(repr(e)) from e
+        headers = {
+            "content-encoding": "aes128gcm",
+            "ttl": str(settings.PUSH_TTL_SECONDS),
+        }
+        headers.update(self._vapid_headers_for(sub["endpoint"]))
+        return encoded["body"], headers
+
+    def _vapid_headers_for(self, endpoint):
+        """オリジンごとにVAPIDヘッダーをキャッシュし、毎回のES256署名を避ける"""
+        origin = _origin(endpoint)
+        now = time.time()
+        cached = self._vapid_headers.get(origin)
+        if cached and cached[0] - VAPID_TOKEN_REFRESH_MARGIN > now:
+            return cached[1]
+        if self._vapid is None:
+            if not settings.VAPID_PRIVATE_KEY:
+                raise WebPushException("VAPID_PRIVATE_KEY is not configured")
+            self._vapid = Vapid.from_string(private_key=settings.VAPID_PRIVATE_KEY)
+        expires_at = int(now) + VAPID_TOKEN_LIFETIME
+        headers = self._vapid.sign({"sub": VAPID_SUB, "aud": origin, "exp": expires_at})
+        self._vapid_headers[origin] = (expires_at, headers)
+        return headers
+
+    def _session_for(self, endpoint):
+        """Push Serviceのオリジンごとにkeep-aliveのセッションを使い回す"""
+        origin = _origin(endpoint)
+        session = self._sessions.get(origin)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.max_concurrency,
+                keepalive_timeout=settings.PUSH_KEEPALIVE_SECONDS,
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self._sessions[origin] = session
+        return session
+
+
+def _origin(endpoint):
+    url = urlparse(endpoint)
+    return f"{url.scheme}://{url.netloc}"
+
+
+def _parse_retry_after(value):
+    try:
+        return min(float(value), 60.0) if value else None
+    except ValueError:
+        return None
+
+
+@database_sync_to_async
+def get_subscriptions_for_users(user_uuids):
+    """複数ユーザーのPush購読情報を1クエリで取得する"""
+    return list(
+        PushSubscription.objects.filter(user_uuid__in=user_uuids)
+        .values("user_uuid", "endpoint", "p256dh", "auth")
+    )
+
+
+@database_sync_to_async
+def delete_subscription(endpoint):
+    """失効した購読をDBから削除する"""
+    PushSubscription.objects.filter(endpoint=endpoint).delete()
+
+
+async def _forget_subscription(endpoint):
+    """購読を削除する。失敗しても送信タスクは落とさない（次に送るときにまた削除を試みる）。"""
+    try:
+        await delete_subscription(endpoint)
+    except Exception as e:
+        logger.error(f"Failed to delete push subscription for {_origin(endpoint)}: {e!r}")
+
+
+_dispatchers = {}
+
+
+def get_push_dispatcher():
+    """実行中のイベントループに紐づくディスパッチャを返す（なければ作成する）"""
+    loop = asyncio.get_running_loop()
+    dispatcher = _dispatchers.get(loop)
+    if dispatcher is None:
+        # 閉じられたループのディスパッチャは捨てる
+        for old_loop in [l for l in _dispatchers if l.is_closed()]:
+            del _dispatchers[old_loop]
+        dispatcher = PushDispatcher()
+        _dispatchers[loop] = dispatcher
+    return dispatcher
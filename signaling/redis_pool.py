@@ -0,0 +1,52 @@
+import logging
+from django.conf import settings
+import redis as redis_sync
+import redis.asyncio as redis
+
+logger = logging.getLogger(__name__)
+
+# --- Global Redis Connection Pool for Production ---
+# This is created once when the Daphne worker process starts.
+redis_pool = None
+if not settings.DEBUG:
+    try:
+        # from_url is a synchronous method that creates a pool.
+        redis_pool = redis.ConnectionPool.from_url(
+            settings.REDIS_URL,
+            max_connections=20,
+            decode_responses=True # This is important for getting strings back
+        )
+        logger.info("Successfully created Redis connection pool.")
+    except Exception as e:
+        # If this fails, the app will still run, but Redis features will be disabled.
+        # The error will be in the logs.
+        logger.exception(f"CRITICAL: Failed to create Redis connection pool: {e}")
+        redis_pool = None
+
+# 同期コード（Djangoのビューや管理コマンド）用のプール。接続は使うときに作られる。
+sync_redis_pool = None
+if not settings.DEBUG:
+    try:
+        sync_redis_pool = redis_sync.ConnectionPool.from_url(
+            settings.REDIS_URL,
+            max_connections=10,
+            decode_responses=True
+        )
+    except Exception as e:
+        logger.exception(f"Failed to create synchronous Redis connection pool: {e}")
+        sync_redis_pool = None
+
+
+def get_redis_connection():
+    """プールからRedisクライアントを作る。プールがなければNoneを返す。"""
+    if redis_pool is None:
+        return None
+    # Creating the client from the pool is synchronous.
+    return redis.Redis(connection_pool=redis_pool)
+
+
+def get_sync_redis_connection():
+    """同期版のRedisクライアントを作る。プールがなければNoneを返す。"""
+    if sync_redis_pool is None:
+        return None
+    return redis_sync.Redis(connection_pool=sync_redis_pool)
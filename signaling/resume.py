@@ -0,0 +1,78 @@
+import logging
+import secrets
+import time
+from django.conf import settings
+from .redis_pool import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# --- 再接続時のセッション再開 ---
+#
+# register の応答で再開トークンを渡し、切断時に resume:<token> = uuid を
+# RESUME_GRACE_SECONDS だけ保存する。その間に同じトークンで register し直した接続は
+# 受信箱の読み込みや user_joined の配信、友達への通知を省き、グループに入り直すだけにする。
+# トークンは1回使うと消える（再接続のたびに新しいものを渡す）。
+
+TOKEN_KEY_PREFIX = "resume:"
+
+
+def new_resume_token():
+    return secrets.token_urlsafe(24)
+
+
+class RedisResumeTokens:
+    """再開トークンをRedisに置く（本番用）"""
+
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+
+    async def park(self, token, user_uuid):
+        """切断時に呼び、猶予の間だけトークンを有効にする"""
+        try:
+            await self.redis_conn.set(TOKEN_KEY_PREFIX + token, user_uuid, ex=settings.RESUME_GRACE_SECONDS)
+        except Exception as e:
+            logger.warning(f"Could not store resume token for {user_uuid[:8]}: {e}")
+
+    async def claim(self, token, user_uuid):
+        """トークンを消費し、user_uuid のものとして有効だったかを返す"""
+        try:
+            return await self.redis_conn.getdel(TOKEN_KEY_PREFIX + token) == user_uuid
+        except Exception as e:
+            logger.warning(f"Could not check resume token for {user_uuid[:8]}: {e}")
+            return False
+
+
+class LocalResumeTokens:
+    """プロセス内の辞書に再開トークンを置く（ローカル開発用: DEBUG=True）"""
+
+    def __init__(self):
+        self.tokens = {}  # token -> (uuid, expires_at)
+
+    async def park(self, token, user_uuid):
+        now = time.time()
+        for expired in [t for t, (_, expires_at) in self.tokens.items() if expires_at <= now]:
+            del self.tokens[expired]
+        self.tokens[token] = (user_uuid, now + settings.RESUME_GRACE_SECONDS)
+
+    async def claim(self, token, user_uuid):
+        entry = self.tokens.pop(token, None)
+        return entry is not None and entry[0] == user_uuid and entry[1] > time.time()
+
+
+local_resume_tokens = LocalResumeTokens()
+redis_resume_tokens = None
+
+
+def get_resume_tokens():
+    """環境に応じたトークンの置き場所を返す。無効（猶予0秒）またはRedisが使えない場合はNone。"""
+    global redis_resume_tokens
+    if settings.RESUME_GRACE_SECONDS <= 0:
+        return None
+    if settings.DEBUG:
+        return local_resume_tokens
+    if redis_resume_tokens is None:
+        redis_conn = get_redis_connection()
+        if redis_conn is None:
+            return None
+        redis_resume_tokens = RedisResumeTokens(redis_conn)
+    return redis_resume_tokens
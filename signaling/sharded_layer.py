@@ -0,0 +1,76 @@
+import bisect
+import hashlib
+from channels_redis.core import RedisChannelLayer
+
+
+class HashRing:
+    """
+    仮想ノードを使うコンシステントハッシュのリング。
+    ノードの識別子（Redisのアドレス）から位置を決めるので、ホストを追加しても
+    既存のホストの位置は変わらず、移動するキーはおよそ 1/(ホスト数) で済む。
+    """
+
+    def __init__(self, node_ids, replicas=160):
+        points = []
+        for index, node_id in enumerate(node_ids):
+            for replica in range(replicas):
+                points.append((self.hash(f"{node_id}#{replica}"), index))
+        points.sort()
+        self._points = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    @staticmethod
+    def hash(value):
+        if isinstance(value, str):
+            value = value.encode('utf8')
+        return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'big')
+
+    def index_for(self, value):
+        position = bisect.bisect(self._points, self.hash(value))
+        if position == len(self._points):
+            position = 0
+        return self._indexes[position]
+
+
+def host_id(host):
+    """decode_hosts() 後のホスト設定から、リング上の位置を決める識別子を作る"""
+    if 'address' in host:
+        return host['address']
+    return ",".join(f"{key}={host[key]}" for key in sorted(host))
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    複数のRedisにグループとチャネルを分散する RedisChannelLayer。
+
+    - user_<uuid> などのグループと、プロセスごとのチャネル（specific.xxx!）をリングで振り分ける
+    - pinned_groups に指定したグループ（全体通知用など）は決まったホストに置く
+    - 送信と受信で同じホストを選ぶよう、プロセスごとのチャネルは常に "!" までの部分でハッシュする
+      （channels_redis は send() ではチャネル名全体、receive() では "!" までをハッシュするため、
+      ホストが複数あると直接送信したメッセージが届かない）
+    """
+
+    def __init__(self, hosts=None, pinned_groups=None, virtual_nodes=160, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        self.ring = HashRing([host_id(host) for host in self.hosts], replicas=virtual_nodes)
+        self.pinned_groups = dict(pinned_groups or {})
+        for group, index in self.pinned_groups.items():
+            if not 0 <= index < self.ring_size:
+                raise ValueError(f"Pinned group {group!r} points at host {index}, but there are only {self.ring_size} hosts")
+        # チャネルのプレフィックスやグループ名はプロセス内で何度も使うのでキャッシュする
+        self._hash_cache = {}
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        if "!" in value:
+            value = self.non_local_name(value)
+        index = self._hash_cache.get(value)
+        if index is None:
+            index = self.pinned_groups.get(value)
+            if index is None:
+                index = self.ring.index_for(value)
+            if len(self._hash_cache) >= 100000:
+                self._hash_cache.clear()
+            self._hash_cache[value] = index
+        return index
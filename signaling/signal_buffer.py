@@ -0,0 +1,132 @@
+import collections
+import hashlib
+import json
+import logging
+import time
+from django.conf import settings
+from .redis_pool import get_redis_connection
+from .metrics import SIGNAL_BUFFER_BUFFERED, SIGNAL_BUFFER_DUPLICATES
+
+logger = logging.getLogger(__name__)
+
+# --- 一時的にオフラインの相手へのシグナリングの保管 ---
+#
+# signal:buffer:<uuid>  STREAM  field m=メッセージ(JSON), h=重複判定用のハッシュ
+#
+# 相手の接続が1つもないときに転送できなかったメッセージを溜めておき、
+# 相手が register したときに順番通りに送り直す（ネゴシエーションの途中で再接続した場合など）。
+# ストリームのIDはミリ秒の時刻なので、SIGNAL_BUFFER_TTL_SECONDS より古いものは
+# 追加のたびに XTRIM MINID で落とす。ユーザーごとの件数は MAXLEN で抑える。
+
+# 溜めておく種類（call-request は通話セッションで不在着信になるので含めない）
+BUFFERED_TYPES = frozenset({
+    'offer', 'answer', 'ice-candidate', 'ice-candidates', 'call-accepted', 'call-rejected', 'call-busy',
+})
+
+STREAM_KEY_PREFIX = "signal:buffer:"
+
+# KEYS[1]=stream key / ARGV: 最小のID
+DRAIN_SCRIPT = """
+local entries = redis.call('XRANGE', KEYS[1], ARGV[1], '+')
+redis.call('DEL', KEYS[1])
+return entries
+"""
+
+
+def message_digest(text):
+    return hashlib.blake2b(text.encode('utf8'), digest_size=8).hexdigest()
+
+
+def dedupe(entries):
+    """(digest, message) のリストから、同じ内容の2回目以降を除いてメッセージだけを返す"""
+    seen = set()
+    messages = []
+    for digest, message in entries:
+        if digest in seen:
+            SIGNAL_BUFFER_DUPLICATES.inc()
+            continue
+        seen.add(digest)
+        messages.append(message)
+    return messages
+
+
+class RedisSignalBuffer:
+    """Redis Streams にユーザーごとのメッセージを溜める（本番用）"""
+
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+        self._drain = redis_conn.register_script(DRAIN_SCRIPT)
+
+    async def append(self, user_uuid, message):
+        """転送できなかったメッセージを溜める。失敗してもメッセージを捨てるだけ。"""
+        ttl = settings.SIGNAL_BUFFER_TTL_SECONDS
+        key = STREAM_KEY_PREFIX + user_uuid
+        try:
+            text = json.dumps(message)
+            pipe = self.redis_conn.pipeline(transaction=False)
+            pipe.xadd(key, {'m': text, 'h': message_digest(text)},
+                      maxlen=settings.SIGNAL_BUFFER_MAX_MESSAGES, approximate=False)
+            pipe.xtrim(key, minid=int((time.time() - ttl) * 1000), approximate=False)
+            pipe.expire(key, ttl)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not buffer '{message.get('type')}' for {user_uuid[:8]}: {e}")
+            return
+        SIGNAL_BUFFER_BUFFERED.inc()
+
+    async def drain(self, user_uuid):
+        """溜まっているメッセージを取り出して（消して）古い順に返す"""
+        min_id = int((time.time() - settings.SIGNAL_BUFFER_TTL_SECONDS) * 1000)
+        try:
+            entries = await self._drain(keys=[STREAM_KEY_PREFIX + user_uuid], args=[min_id])
+        except Exception as e:
+            logger.warning(f"Could not replay buffered signaling for {user_uuid[:8]}: {e}")
+            return []
+        decoded = []
+        for _, fields in entries:
+            fields = dict(zip(fields[::2], fields[1::2]))
+            decoded.append((fields['h'], json.loads(fields['m'])))
+        return dedupe(decoded)
+
+
+class LocalSignalBuffer:
+    """プロセス内の辞書にメッセージを溜める（ローカル開発用: DEBUG=True）"""
+
+    def __init__(self):
+        self.streams = {}  # uuid -> deque[(buffered_at, digest, message)]
+
+    async def append(self, user_uuid, message):
+        try:
+            digest = message_digest(json.dumps(message))
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Could not buffer '{message.get('type')}' for {user_uuid[:8]}: {e}")
+            return
+        stream = self.streams.get(user_uuid)
+        if stream is None:
+            stream = self.streams[user_uuid] = collections.deque(maxlen=settings.SIGNAL_BUFFER_MAX_MESSAGES)
+        stream.append((time.time(), digest, message))
+        SIGNAL_BUFFER_BUFFERED.inc()
+
+    async def drain(self, user_uuid):
+        oldest = time.time() - settings.SIGNAL_BUFFER_TTL_SECONDS
+        stream = self.streams.pop(user_uuid, ())
+        return dedupe([(digest, message) for buffered_at, digest, message in stream if buffered_at >= oldest])
+
+
+local_signal_buffer = LocalSignalBuffer()
+redis_signal_buffer = None
+
+
+def get_signal_buffer():
+    """環境に応じたバッファを返す。無効またはRedisが使えない場合はNone。"""
+    global redis_signal_buffer
+    if not settings.SIGNAL_BUFFER_ENABLED:
+        return None
+    if settings.DEBUG:
+        return local_signal_buffer
+    if redis_signal_buffer is None:
+        redis_conn = get_redis_connection()
+        if redis_conn is None:
+            return None
+        redis_signal_buffer = RedisSignalBuffer(redis_conn)
+    return redis_signal_buffer
@@ -0,0 +1,640 @@
+import asyncio
+import base64
+import os
+from unittest import mock
+
+import msgpack
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from channels.testing import WebsocketCommunicator
+
+from django.test import SimpleTestCase, override_settings
+
+from .codecs import (
+    CodecError, JSON_CODEC, MAX_FRAME_BYTES, MSGPACK_CODEC, MSGPACK_SUBPROTOCOL, frame_event, negotiate_codec,
+)
+from .consumers import SignalingConsumer
+from .channel_routes import resolve_channels, route_cache
+from .presence import LocalPresenceRegistry, RedisPresenceRegistry
+from .presence_cache import PresenceNearCache
+from .push import PushDispatcher
+from .sharded_layer import HashRing, ShardedRedisChannelLayer
+from .ice import IceCandidateCoalescer
+from .metrics import percentiles
+from .inbox_flags import DIRTY_KEY, RedisInboxFlags, rebuild_inbox_flags
+from .signal_buffer import LocalSignalBuffer, RedisSignalBuffer
+from .call_sessions import (
+    LocalCallSessionRegistry, RedisCallSessionRegistry, REQUEST_BUSY, REQUEST_DUPLICATE, REQUEST_GLARE,
+    REQUEST_RINGING, STATE_ACCEPTED, STATE_REJECTED,
+)
+
+try:
+    import fakeredis
+except ImportError:  # Lua のスクリプトは fakeredis（と lupa）があるときだけ確かめる
+    fakeredis = None
+
+
+async def wait_until(condition):
+    """pub/sub の購読タスクが進むのを待つ"""
+    for _ in range(100):
+        if condition():
+            return True
+        await asyncio.sleep(0.01)
+    return False
+
+
+class CallSessionTests(SimpleTestCase):
+    """通話セッションの状態遷移（LocalCallSessionRegistry）"""
+
+    def make_registry(self):
+        return LocalCallSessionRegistry()
+
+    def setUp(self):
+        self.sessions = self.make_registry()
+
+    async def test_request_rings_once(self):
+        self.assertEqual(await self.sessions.request('alice', 'bob'), REQUEST_RINGING)
+        self.assertEqual(await self.sessions.request('alice', 'bob'), REQUEST_DUPLICATE)
+        self.assertEqual(await self.sessions.active_session('bob'), ('alice', 'bob'))
+
+    async def test_accepted_call_makes_both_sides_busy(self):
+        await self.sessions.request('alice', 'bob')
+        self.assertTrue(await self.sessions.answer('alice', 'bob', STATE_ACCEPTED))
+        self.assertEqual(await self.sessions.request('alice', 'bob'), REQUEST_DUPLICATE)
+        self.assertEqual(await self.sessions.request('carol', 'bob'), REQUEST_BUSY)
+        self.assertEqual(await self.sessions.request('carol', 'alice'), REQUEST_BUSY)
+        # 通話中の発信者が別の相手を呼び出しても、自分の通話中キーは上書きされない
+        self.assertEqual(await self.sessions.request('alice', 'carol'), REQUEST_BUSY)
+        self.assertEqual(await self.sessions.active_session('alice'), ('alice', 'bob'))
+
+    async def test_rejected_call_frees_both_sides(self):
+        await self.sessions.request('alice', 'bob')
+        self.assertTrue(await self.sessions.answer('alice', 'bob', STATE_REJECTED))
+        self.assertFalse(await self.sessions.answer('alice', 'bob', STATE_ACCEPTED))
+        self.assertIsNone(await self.sessions.active_session('alice'))
+        self.assertEqual(await self.sessions.request('carol', 'bob'), REQUEST_RINGING)
+
+    async def test_time_out_succeeds_once(self):
+        await self.sessions.request('alice', 'bob')
+        self.assertTrue(await self.sessions.time_out('alice', 'bob'))
+        self.assertFalse(await self.sessions.time_out('alice', 'bob'))
+        # 呼び出しの再送で不在着信が増えないよう、timed-out はしばらく重複として扱う
+        self.assertEqual(await self.sessions.request('alice', 'bob'), REQUEST_DUPLICATE)
+        self.assertIsNone(await self.sessions.active_session('bob'))
+
+    async def test_crossed_requests_are_glare(self):
+        await self.sessions.request('alice', 'bob')
+        self.assertEqual(await self.sessions.request('bob', 'alice'), REQUEST_GLARE)
+        self.assertTrue(await self.sessions.answer('alice', 'bob', STATE_ACCEPTED))
+        self.assertEqual(await self.sessions.request('bob', 'alice'), REQUEST_BUSY)
+
+    async def test_end_accepted_call(self):
+        await self.sessions.request('alice', 'bob')
+        await self.sessions.answer('alice', 'bob', STATE_ACCEPTED)
+        self.assertEqual(await self.sessions.end('alice', 'bob'), STATE_ACCEPTED)
+        self.assertIsNone(await self.sessions.end('alice', 'bob'))
+        self.assertEqual(await self.sessions.request('carol', 'alice'), REQUEST_RINGING)
+
+    @override_settings(CALL_RING_TIMEOUT_SECONDS=0)
+    async def test_expired_rings(self):
+        await self.sessions.request('alice', 'bob')
+        self.assertEqual(await self.sessions.expired_rings(), [('alice', 'bob')])
+        await self.sessions.time_out('alice', 'bob')
+        self.assertEqual(await self.sessions.expired_rings(), [])
+
+
+class RedisCallSessionTests(CallSessionTests):
+    """同じ遷移を REQUEST_SCRIPT / TRANSITION_SCRIPT で確かめる"""
+
+    def make_registry(self):
+        if fakeredis is None:
+            self.skipTest("fakeredis is not installed")
+        return RedisCallSessionRegistry(fakeredis.aioredis.FakeRedis(decode_responses=True))
+
+
+class RingTimerTests(SimpleTestCase):
+
+    @override_settings(CALL_RING_TIMEOUT_SECONDS=0.05)
+    async def test_disconnect_cancels_ring_timers(self):
+        """閉じた接続のタイマーは call-timeout を送らない（期限切れは生きている接続の掃除が拾う）"""
+        consumer = SignalingConsumer()
+        consumer.channel_name = 'test.worker!ring'
+        consumer.user_uuid = None
+        consumer.call_tracker = None
+        consumer.call_sessions = LocalCallSessionRegistry()
+        await consumer.call_sessions.request('alice', 'bob')
+        consumer.ring_timers = {asyncio.get_running_loop().create_task(consumer.ring_timeout('alice', 'bob'))}
+        with mock.patch.object(SignalingConsumer, 'finish_timed_out_call') as finish:
+            await consumer.disconnect(1000)
+            await asyncio.sleep(0.1)
+        finish.assert_not_called()
+        self.assertEqual(await consumer.call_sessions.expired_rings(), [('alice', 'bob')])
+
+
+class RouteCacheTests(SimpleTestCase):
+    """ルートキャッシュは他のワーカーでの接続・切断を presence:changes で知る"""
+
+    def setUp(self):
+        if fakeredis is None:
+            self.skipTest("fakeredis is not installed")
+        route_cache.clear()
+        self.addCleanup(route_cache.clear)
+
+    def make_worker(self, server):
+        return RedisPresenceRegistry(
+            fakeredis.aioredis.FakeRedis(server=server, decode_responses=True), PresenceNearCache(100, 30.0)
+        )
+
+    async def test_lease_on_another_worker_invalidates_routes(self):
+        server = fakeredis.FakeServer()
+        this_worker, other_worker = self.make_worker(server), self.make_worker(server)
+        await this_worker.acquire('bob', 'worker1!a')
+        await resolve_channels('bob', this_worker)
+        self.addCleanup(this_worker.near_cache._listener.cancel)
+        self.assertTrue(await wait_until(lambda: this_worker.near_cache.active))
+        self.assertEqual(await resolve_channels('bob', this_worker), ['worker1!a'])
+        self.assertEqual(route_cache.get('bob'), ['worker1!a'])
+
+        await other_worker.acquire('bob', 'worker2!b')
+        self.assertTrue(await wait_until(lambda: route_cache.get('bob') is None))
+        self.assertCountEqual(await resolve_channels('bob', this_worker), ['worker1!a', 'worker2!b'])
+
+        await other_worker.release('bob', 'worker2!b')
+        self.assertTrue(await wait_until(lambda: route_cache.get('bob') is None))
+        self.assertEqual(await resolve_channels('bob', this_worker), ['worker1!a'])
+
+    async def test_routes_are_not_cached_without_listener(self):
+        registry = self.make_worker(fakeredis.FakeServer())
+        registry.near_cache = None
+        await registry.acquire('bob', 'worker1!a')
+        self.assertEqual(await resolve_channels('bob', registry), ['worker1!a'])
+        self.assertIsNone(route_cache.get('bob'))
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class FakeResponse:
+    def __init__(self, status):
+        self.status = status
+        self.headers = {}
+
+    async def text(self):
+        return ''
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeSession:
+    """Push Serviceの代わりに決まったステータスを返す"""
+    closed = False
+
+    def __init__(self, status):
+        self.status = status
+        self.posts = []
+
+    def post(self, endpoint, data=None, headers=None):
+        self.posts.append(endpoint)
+        return FakeResponse(self.status)
+
+
+class PushDeliveryTests(SimpleTestCase):
+    """1件の配信で何が起きても _deliver（送信タスク）は例外で終わらない"""
+
+    def make_subscription(self, **keys):
+        public_key = ec.generate_private_key(ec.SECP256R1()).public_key().public_bytes(
+            serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+        )
+        sub = {
+            'user_uuid': 'alice-uuid', 'endpoint': 'https://push.example.com/send/1',
+            'p256dh': b64url(public_key), 'auth': b64url(os.urandom(16)),
+        }
+        sub.update(keys)
+        return sub
+
+    async def deliver(self, sub, session, delete=None):
+        dispatcher = PushDispatcher(max_retries=1, backoff_base=0.001)
+        try:
+            with mock.patch.object(dispatcher, '_session_for', return_value=session), \
+                    mock.patch.object(dispatcher, '_vapid_headers_for', return_value={}), \
+                    mock.patch('signaling.push.delete_subscription', delete or mock.AsyncMock()) as delete_mock:
+                await dispatcher._deliver(sub, '{"type": "test"}')
+        finally:
+            await dispatcher.close()
+        return delete_mock
+
+    async def test_unencodable_keys_delete_subscription(self):
+        session = FakeSession(201)
+        for keys in ({'p256dh': '@@@', 'auth': 'xyz'}, {'auth': '!!'}):
+            with self.subTest(keys=keys), self.assertLogs('signaling.push', 'WARNING'):
+                delete = await self.deliver(self.make_subscription(**keys), session)
+                delete.assert_awaited_once_with('https://push.example.com/send/1')
+        self.assertEqual(session.posts, [])
+
+    async def test_delivered(self):
+        session = FakeSession(201)
+        delete = await self.deliver(self.make_subscription(), session)
+        self.assertEqual(session.posts, ['https://push.example.com/send/1'])
+        delete.assert_not_awaited()
+
+    async def test_failed_delete_does_not_escape(self):
+        delete = mock.AsyncMock(side_effect=RuntimeError("database is locked"))
+        with self.assertLogs('signaling.push', 'ERROR'):
+            await self.deliver(self.make_subscription(), FakeSession(410), delete)
+        delete.assert_awaited_once()
+
+
+class SignalBufferTests(SimpleTestCase):
+    """JSONにできないメッセージは溜めずに捨てる（転送する側には例外を返さない）"""
+
+    def make_buffer(self):
+        return LocalSignalBuffer()
+
+    async def test_unserializable_message_is_dropped(self):
+        buffer = self.make_buffer()
+        with self.assertLogs('signaling.signal_buffer', 'WARNING'):
+            await buffer.append('bob', {'type': 'offer', 'payload': {'sdp': object()}})
+        await buffer.append('bob', {'type': 'offer', 'payload': {'sdp': 'v=0'}})
+        self.assertEqual(await buffer.drain('bob'), [{'type': 'offer', 'payload': {'sdp': 'v=0'}}])
+
+
+class RedisSignalBufferTests(SignalBufferTests):
+
+    def make_buffer(self):
+        if fakeredis is None:
+            self.skipTest("fakeredis is not installed")
+        return RedisSignalBuffer(fakeredis.aioredis.FakeRedis(decode_responses=True))
+
+
+@override_settings(DEBUG=True)
+class ResumeInboxTests(SimpleTestCase):
+    """再開トークンでの register でも、切断している間に届いた通知を配る"""
+
+    async def register(self, **payload):
+        communicator = WebsocketCommunicator(SignalingConsumer.as_asgi(), "/ws/signaling/")
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'register', 'payload': {'uuid': 'alice', **payload}})
+        while True:
+            message = await communicator.receive_json_from()
+            if message['type'] == 'registered':
+                return communicator, message['payload']
+
+    async def test_notification_created_while_parked_is_delivered_on_resume(self):
+        if fakeredis is None:
+            self.skipTest("fakeredis is not installed")
+        inbox_flags = RedisInboxFlags(fakeredis.aioredis.FakeRedis(decode_responses=True))
+        await inbox_flags.redis_conn.sadd('inbox:dirty', '!ready')
+        missed_call = {'type': 'missed_call_notification', 'sender': 'bob'}
+        snapshot = mock.AsyncMock(return_value=[])
+        with mock.patch('signaling.consumers.get_inbox_flags', return_value=inbox_flags), \
+                mock.patch.object(SignalingConsumer, 'get_inbox_snapshot', snapshot):
+            communicator, registered = await self.register()
+            await communicator.disconnect()
+
+            # 何も届いていなければ再開時にDBは読まない
+            communicator, registered = await self.register(resume_token=registered['resume_token'])
+            self.assertEqual(registered['notifications'], [])
+            self.assertEqual(snapshot.await_count, 0)
+            await communicator.disconnect()
+
+            # 切断中に通知が保存されてフラグが立った
+            snapshot.return_value = [missed_call]
+            await inbox_flags.mark(['alice'])
+            communicator, registered = await self.register(resume_token=registered['resume_token'])
+            self.assertEqual(registered['notifications'], [missed_call])
+            await communicator.disconnect()
+
+
+class PresenceLeaseTests(SimpleTestCase):
+    """接続ごとのリース（LocalPresenceRegistry）。有効なリースが1つでもあればオンライン。"""
+
+    def make_registry(self):
+        return LocalPresenceRegistry()
+
+    def setUp(self):
+        self.registry = self.make_registry()
+        self.now = 1_000_000.0
+        patcher = mock.patch('signaling.presence.time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_lease_counts(self):
+        self.assertEqual(await self.registry.acquire('alice', 'worker!a'), 1)
+        self.assertEqual(await self.registry.acquire('alice', 'worker!b'), 2)
+        self.assertEqual(await self.registry.renew('alice', 'worker!a'), 2)
+        self.assertCountEqual(await self.registry.channels_for('alice'), ['worker!a', 'worker!b'])
+        self.assertEqual(await self.registry.release('alice', 'worker!a'), 1)
+        self.assertTrue(await self.registry.is_online('alice'))
+        self.assertEqual(await self.registry.release('alice', 'worker!b'), 0)
+        self.assertFalse(await self.registry.is_online('alice'))
+        self.assertEqual(await self.registry.channels_for('alice'), [])
+
+    async def test_release_of_unknown_channel_keeps_other_leases(self):
+        await self.registry.acquire('alice', 'worker!a')
+        self.assertEqual(await self.registry.release('alice', 'worker!gone'), 1)
+        self.assertEqual(await self.registry.filter_online(['alice', 'bob']), {'alice'})
+
+    @override_settings(PRESENCE_LEASE_SECONDS=90)
+    async def test_expired_leases_are_not_counted_and_swept(self):
+        await self.registry.acquire('alice', 'worker!crashed')
+        await self.registry.acquire('bob', 'worker!b')
+        self.now += 60
+        await self.registry.renew('bob', 'worker!b')
+        self.now += 31
+        self.assertFalse(await self.registry.is_online('alice'))
+        self.assertEqual(await self.registry.filter_online(['alice', 'bob']), {'bob'})
+        self.assertEqual(await self.registry.sweep(), ['alice'])
+        self.assertEqual(await self.registry.acquire('alice', 'worker!a'), 1)
+
+
+class RedisPresenceLeaseTests(PresenceLeaseTests):
+
+    def make_registry(self):
+        if fakeredis is None:
+            self.skipTest("fakeredis is not installed")
+        return RedisPresenceRegistry(fakeredis.aioredis.FakeRedis(decode_responses=True))
+
+
+class IceCoalescerTests(SimpleTestCase):
+    """ICE候補のまとめは、宛先ごとに届いた順を保って送る"""
+
+    def setUp(self):
+        self.sent = []
+
+    async def record(self, target_uuid, candidates):
+        self.sent.append((target_uuid, candidates))
+
+    def make_coalescer(self, window=0.02, max_batch=3):
+        return IceCandidateCoalescer(window=window, max_batch=max_batch, flush_callback=self.record)
+
+    async def test_window_flushes_in_arrival_order(self):
+        coalescer = self.make_coalescer()
+        for candidate in ('c1', 'c2'):
+            await coalescer.add('bob', {'candidate': candidate})
+        await coalescer.add('carol', {'candidate': 'x1'})
+        self.assertEqual(self.sent, [])
+        await asyncio.sleep(0.05)
+        self.assertCountEqual(self.sent, [('bob', ['c1', 'c2']), ('carol', ['x1'])])
+        self.assertEqual(coalescer.timers, {})
+
+    async def test_max_batch_and_end_of_candidates_flush_immediately(self):
+        coalescer = self.make_coalescer(window=10)
+        for candidate in ('c1', 'c2', 'c3', 'c4'):
+            await coalescer.add('bob', {'candidate': candidate})
+        self.assertEqual(self.sent, [('bob', ['c1', 'c2', 'c3'])])
+        await coalescer.add('bob', {'candidate': None})
+        self.assertEqual(self.sent, [('bob', ['c1', 'c2', 'c3']), ('bob', ['c4'])])
+        self.assertEqual(coalescer.timers, {})
+
+    async def test_flush_before_other_message_keeps_order(self):
+        """answer などを送る前の flush で、溜まっていた候補が先に出る（タイマーは二重に送らない）"""
+        coalescer = self.make_coalescer()
+        await coalescer.add('bob', {'candidate': 'c1'})
+        await coalescer.flush('bob')
+        self.sent.append(('bob', 'answer'))
+        await coalescer.add('bob', {'candidate': 'c2'})
+        await coalescer.flush_all()
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent, [('bob', ['c1']), ('bob', 'answer'), ('bob', ['c2'])])
+
+
+class FrameCodecTests(SimpleTestCase):
+    """JSON（サブプロトコルなし）と msgpack（cnc.msgpack.v1）のフレームの往復"""
+
+    message = {
+        'type': 'offer',
+        'payload': {'target': 'bob', 'sdp': 'v=0\r\no=- 1 2 IN IP4 127.0.0.1', 'note': 'こんにちは', 'candidate': None},
+        'from': 'alice',
+    }
+
+    def test_negotiation(self):
+        self.assertIs(negotiate_codec(None), JSON_CODEC)
+        self.assertIs(negotiate_codec(['other']), JSON_CODEC)
+        self.assertIs(negotiate_codec(['other', MSGPACK_SUBPROTOCOL]), MSGPACK_CODEC)
+
+    def test_round_trip(self):
+        for codec in (JSON_CODEC, MSGPACK_CODEC):
+            with self.subTest(codec=type(codec).__name__):
+                self.assertEqual(codec.decode(**codec.encode(self.message)), self.message)
+                # 送信側で両方の形式にしておいたフレームも同じメッセージに戻る
+                self.assertEqual(codec.decode(**codec.frame(frame_event(self.message))), self.message)
+
+    def test_frame_kinds(self):
+        self.assertEqual(set(JSON_CODEC.encode(self.message)), {'text_data'})
+        self.assertEqual(set(MSGPACK_CODEC.encode(self.message)), {'bytes_data'})
+        # msgpack のクライアントからのテキストフレームはJSONとして読む
+        self.assertEqual(MSGPACK_CODEC.decode(text_data='{"type": "heartbeat"}'), {'type': 'heartbeat'})
+
+    def test_invalid_frames(self):
+        cases = [
+            (JSON_CODEC, {'bytes_data': b'{}'}),
+            (JSON_CODEC, {'text_data': '{"type":'}),
+            (MSGPACK_CODEC, {'bytes_data': b'\xc1'}),
+            (MSGPACK_CODEC, {'bytes_data': msgpack.packb({'type': 'x'}) + b'\x00'}),
+            (MSGPACK_CODEC, {'bytes_data': b'\x00' * (MAX_FRAME_BYTES + 1)}),
+        ]
+        for codec, frame in cases:
+            with self.subTest(codec=type(codec).__name__, frame=repr(frame)[:40]):
+                with self.assertRaises(CodecError):
+                    codec.decode(**frame)
+
+    @override_settings(DEBUG=True)
+    async def test_msgpack_connection(self):
+        communicator = WebsocketCommunicator(
+            SignalingConsumer.as_asgi(), "/ws/signaling/", subprotocols=[MSGPACK_SUBPROTOCOL]
+        )
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+        with mock.patch('signaling.consumers.get_inbox_flags', return_value=None), \
+                mock.patch.object(SignalingConsumer, 'get_inbox_snapshot', mock.AsyncMock(return_value=[])):
+            await communicator.send_to(bytes_data=msgpack.packb({'type': 'register', 'payload': {'uuid': 'alice'}}))
+            response = await communicator.receive_output()
+        self.assertIsNone(response.get('text'))
+        registered = msgpack.unpackb(response['bytes'])
+        self.assertEqual((registered['type'], registered['payload']['uuid']), ('registered', 'alice'))
+        await communicator.disconnect()
+
+
+class InboxFlagTests(SimpleTestCase):
+    """受信箱の未処理フラグ。印（READY_MEMBER）がない間やRedisに届かないときは、必ずDBを読ませる。"""
+
+    def setUp(self):
+        if fakeredis is None:
+            self.skipTest("fakeredis is not installed")
+        server = fakeredis.FakeServer()
+        self.sync_redis = fakeredis.FakeRedis(server=server, decode_responses=True)
+        self.flags = RedisInboxFlags(fakeredis.aioredis.FakeRedis(server=server, decode_responses=True))
+
+    async def test_flags_are_untrusted_until_rebuilt(self):
+        self.assertTrue(await self.flags.claim('alice'))
+        self.assertTrue(await self.flags.claim('alice'))
+        self.assertEqual(rebuild_inbox_flags(self.sync_redis, iter(['alice', 'bob']), batch_size=1), 2)
+        self.assertTrue(await self.flags.claim('alice'))
+        self.assertFalse(await self.flags.claim('alice'))
+        self.assertFalse(await self.flags.claim('carol'))
+
+    async def test_mark_and_claim(self):
+        rebuild_inbox_flags(self.sync_redis, iter([]))
+        await self.flags.mark(['alice', 'bob'])
+        self.assertTrue(await self.flags.claim('alice'))
+        self.assertFalse(await self.flags.claim('alice'))
+        self.assertTrue(await self.flags.claim('bob'))
+
+    async def test_rebuild_keeps_flags_marked_meanwhile(self):
+        await self.flags.mark(['carol'])
+        rebuild_inbox_flags(self.sync_redis, iter(['alice']))
+        self.assertTrue(await self.flags.claim('carol'))
+        self.assertTrue(await self.flags.claim('alice'))
+        self.assertFalse(self.sync_redis.exists(f"{DIRTY_KEY}:rebuild"))
+
+    async def test_failed_mark_invalidates_every_flag(self):
+        rebuild_inbox_flags(self.sync_redis, iter([]))
+        with mock.patch.object(self.flags.redis_conn, 'sadd', side_effect=ConnectionError("down")), \
+                self.assertLogs('signaling.inbox_flags', 'WARNING'):
+            await self.flags.mark(['alice'])
+        self.assertTrue(await self.flags.claim('alice'))
+        self.assertTrue(await self.flags.claim('bob'))
+
+    async def test_unreachable_redis_reads_the_database(self):
+        rebuild_inbox_flags(self.sync_redis, iter([]))
+        with mock.patch.object(self.flags, '_claim', side_effect=ConnectionError("down")), \
+                self.assertLogs('signaling.inbox_flags', 'WARNING'):
+            self.assertTrue(await self.flags.claim('alice'))
+
+    async def test_unread_mail_keeps_the_flag(self):
+        """未読メールは既読になるまで register のたびに返すので、フラグを立て直す"""
+        rebuild_inbox_flags(self.sync_redis, iter(['alice']))
+        consumer = SignalingConsumer()
+        consumer.user_uuid = 'alice'
+        snapshot = mock.AsyncMock(return_value=[{'type': 'new_mail_notification', 'id': 'mail-1'}])
+        with mock.patch('signaling.consumers.get_inbox_flags', return_value=self.flags), \
+                mock.patch.object(SignalingConsumer, 'get_inbox_snapshot', snapshot):
+            self.assertEqual(len(await consumer.get_pending_inbox()), 1)
+            self.assertEqual(len(await consumer.get_pending_inbox()), 1)
+            snapshot.return_value = []
+            self.assertEqual(await consumer.get_pending_inbox(), [])
+            self.assertEqual(await consumer.get_pending_inbox(), [])
+        self.assertEqual(snapshot.await_count, 3)
+
+
+class PresenceNearCacheTests(SimpleTestCase):
+    """ワーカー内のプレゼンスのキャッシュ（presence:changes の購読中だけ使う）"""
+
+    def make_cache(self, max_entries=100, ttl=30.0):
+        cache = PresenceNearCache(max_entries, ttl)
+        cache.active = True
+        return cache
+
+    def test_inactive_cache_always_misses(self):
+        cache = self.make_cache()
+        cache.active = False
+        cache.put('alice', 200.0, 100.0, cache.epoch)
+        self.assertIsNone(cache.get('alice', 100.0))
+
+    def test_online_entry_expires_with_the_lease(self):
+        cache = self.make_cache(ttl=30.0)
+        cache.put('alice', 110.0, 100.0, cache.epoch)
+        cache.put('bob', None, 100.0, cache.epoch)
+        self.assertTrue(cache.get('alice', 105.0))
+        self.assertIsNone(cache.get('alice', 110.0))
+        self.assertIs(cache.get('bob', 125.0), False)
+        self.assertIsNone(cache.get('bob', 130.0))
+
+    def test_invalidation_during_read_is_not_cached(self):
+        cache = self.make_cache()
+        epoch = cache.epoch
+        cache.invalidate('carol')
+        cache.put('alice', 200.0, 100.0, epoch)
+        self.assertIsNone(cache.get('alice', 100.0))
+
+    def test_lru_eviction_and_lookup_many(self):
+        cache = self.make_cache(max_entries=2)
+        cache.put('alice', 200.0, 100.0, cache.epoch)
+        cache.put('bob', None, 100.0, cache.epoch)
+        cache.get('alice', 100.0)
+        cache.put('carol', 200.0, 100.0, cache.epoch)
+        self.assertEqual(cache.lookup_many(['alice', 'bob', 'carol', 'dave'], 100.0), ({'alice', 'carol'}, ['bob', 'dave']))
+
+    async def test_change_on_another_worker_invalidates(self):
+        if fakeredis is None:
+            self.skipTest("fakeredis is not installed")
+        server = fakeredis.FakeServer()
+        this_worker = RedisPresenceRegistry(
+            fakeredis.aioredis.FakeRedis(server=server, decode_responses=True), PresenceNearCache(100, 30.0)
+        )
+        other_worker = RedisPresenceRegistry(fakeredis.aioredis.FakeRedis(server=server, decode_responses=True))
+        self.assertFalse(await this_worker.is_online('bob'))
+        self.addCleanup(this_worker.near_cache._listener.cancel)
+        self.assertTrue(await wait_until(lambda: this_worker.near_cache.active))
+        self.assertFalse(await this_worker.is_online('bob'))
+        self.assertIs(this_worker.near_cache.get('bob', 0), False)
+
+        await other_worker.acquire('bob', 'worker2!b')
+        self.assertTrue(await wait_until(lambda: 'bob' not in this_worker.near_cache.entries))
+        self.assertTrue(await this_worker.is_online('bob'))
+        self.assertEqual(await this_worker.filter_online(['bob', 'carol']), {'bob'})
+
+
+class ShardedLayerTests(SimpleTestCase):
+    """グループとチャネルのRedisホストへの振り分け"""
+
+    hosts = ['redis://redis-a:6379', 'redis://redis-b:6379', 'redis://redis-c:6379']
+    keys = [f"user_{n:08x}" for n in range(3000)]
+
+    def place(self, hosts):
+        ring = HashRing(hosts)
+        return [hosts[ring.index_for(key)] for key in self.keys]
+
+    def test_ring_is_stable_and_moves_few_keys(self):
+        before = self.place(self.hosts)
+        self.assertEqual(before, self.place(list(self.hosts)))
+        # 並び順ではなくアドレスで位置が決まる
+        self.assertEqual(before, self.place(self.hosts[::-1]))
+        for host in self.hosts:
+            self.assertGreater(before.count(host), len(self.keys) / 6)
+
+        after = self.place(self.hosts + ['redis://redis-d:6379'])
+        moved = [new for old, new in zip(before, after) if old != new]
+        self.assertEqual(set(moved), {'redis://redis-d:6379'})
+        self.assertLess(len(moved), len(self.keys) * 0.4)
+
+    def test_process_channels_hash_on_their_prefix(self):
+        """send() はチャネル名全体、receive() は "!" までを渡すので、どちらも同じホストになる"""
+        layer = ShardedRedisChannelLayer(hosts=self.hosts)
+        placements = set()
+        for n in range(200):
+            prefix = f"specific.{n:04x}abcd!"
+            index = layer.consistent_hash(prefix)
+            for suffix in ('', 'ZQxYwV', 'other-client'):
+                self.assertEqual(layer.consistent_hash(prefix + suffix), index)
+            placements.add(index)
+        self.assertEqual(placements, {0, 1, 2})
+
+    def test_pinned_groups_and_single_host(self):
+        layer = ShardedRedisChannelLayer(hosts=self.hosts, pinned_groups={'signaling_broadcast': 2})
+        self.assertEqual(layer.consistent_hash('signaling_broadcast'), 2)
+        with self.assertRaises(ValueError):
+            ShardedRedisChannelLayer(hosts=self.hosts, pinned_groups={'signaling_broadcast': 3})
+        single = ShardedRedisChannelLayer(hosts=self.hosts[:1])
+        self.assertEqual(single.consistent_hash('specific.abcd!efgh'), 0)
+
+
+class PercentilesTests(SimpleTestCase):
+    """ベンチマークと通話計測のレポートで共通のパーセンタイル"""
+
+    def test_summary(self):
+        self.assertIsNone(percentiles([]))
+        self.assertIsNone(percentiles([None]))
+        self.assertEqual(
+            percentiles([0.002], scale=1000),
+            {'count': 1, 'mean': 2.0, 'p50': 2.0, 'p95': 2.0, 'p99': 2.0, 'max': 2.0},
+        )
+        summary = percentiles([None] + list(range(100, 0, -1)))
+        self.assertEqual((summary['count'], summary['p50'], summary['max']), (100, 50.5, 100))
+        self.assertLessEqual(summary['p95'], summary['p99'])